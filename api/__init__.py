@@ -2,8 +2,12 @@
 import os
 
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from api import api, db
+from api import (
+    admission, api, archive, cache, compression, db, ingest, journal, metrics, profiling, reconcile, shards, slowlog,
+    tracing, writer,
+)
 
 
 def create_app(test_config=None):
@@ -13,6 +17,69 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY='the-key',
         DATABASE=os.path.join(app.instance_path, 'phone_bills.sqlite'),
+        DATABASE_CACHED_STATEMENTS=256,
+        DATABASE_PERSISTENT=True,
+        DATABASE_READONLY=True,
+        DATABASE_JOURNAL_MODE='WAL',
+        DATABASE_SYNCHRONOUS='NORMAL',
+        DATABASE_CACHE_SIZE=-65536,
+        DATABASE_MMAP_SIZE=268435456,
+        DATABASE_TEMP_STORE='MEMORY',
+        DATABASE_BUSY_TIMEOUT=5000,
+        DATABASE_SHARDS=0,
+        DATABASE_SHARD_CACHE_SIZE=10000,
+        DATABASE_CHECK_INTERVAL=30,
+        DATABASE_QUERY_LOG=False,
+        DATABASE_REPEATED_STATEMENTS=20,
+        DATABASE_QUERY_BUDGETS={},
+        MODEL_CACHE_SIZE=0,
+        PHONE_BILL_PERSIST=True,
+        PHONE_BILL_SPOOL_SIZE=1024 * 1024,
+        WRITE_COORDINATOR=False,
+        WRITE_QUEUE_SIZE=1000,
+        WRITE_TIMEOUT=10,
+        WRITE_RETRIES=5,
+        WRITE_BACKOFF=0.05,
+        INGEST_ASYNC=False,
+        INGEST_FLUSH_RECORDS=500,
+        INGEST_FLUSH_INTERVAL=50,
+        INGEST_STATUS_SIZE=10000,
+        JOURNAL=False,
+        JOURNAL_DIRECTORY=None,
+        JOURNAL_SEGMENT_SIZE=64 * 1024 * 1024,
+        JOURNAL_FSYNC=True,
+        ARCHIVE_DIRECTORY=None,
+        ARCHIVE_CACHE_SIZE=2,
+        ASGI_THREADS=8,
+        ASGI_SPOOL_SIZE=1024 * 1024,
+        COMPRESS_ENCODINGS=('br', 'zstd', 'gzip'),
+        COMPRESS_LEVELS={'br': 5, 'zstd': 3, 'gzip': 6},
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_CACHE_SIZE=64,
+        ADMISSION_MAX_RECORDS=10000,
+        ADMISSION_RATE=0,
+        ADMISSION_BURST=0,
+        ADMISSION_CLIENTS=10000,
+        ADMISSION_CAPACITY=0,
+        ADMISSION_WRITE_BUDGET=0,
+        ADMISSION_SLOTS_FILE=None,
+        MAX_CONTENT_LENGTH=4 * 1024 * 1024,
+        PROXY_COUNT=0,
+        METRICS=False,
+        METRICS_DIRECTORY=None,
+        METRICS_FLUSH_INTERVAL=5,
+        PROFILE=False,
+        PROFILE_SAMPLE=0,
+        PROFILE_INTERVAL=0.005,
+        PROFILE_TOKEN_MAX_AGE=3600,
+        PROFILE_DIRECTORY=None,
+        TRACING=False,
+        TRACING_SAMPLE=1,
+        TRACING_BUFFER_SIZE=10000,
+        TRACING_FILE=None,
+        SLOW_REQUEST_THRESHOLD=0,
+        SLOW_REQUEST_FILE=None,
+        SLOW_REQUEST_TRACEMALLOC=False,
     )
     db.init_app(app)
 
@@ -29,6 +96,24 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    if app.config['PROXY_COUNT']:
+        # the address of the client is the one added by the proxies, e.g. the router of heroku
+        count = app.config['PROXY_COUNT']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=count, x_proto=count)
+
+    metrics.init_app(app)
+    cache.init_app(app)
+    compression.init_app(app)
+    admission.init_app(app)
+    shards.init_app(app)
+    writer.init_app(app)
+    ingest.init_app(app)
+    journal.init_app(app)
+    archive.init_app(app)
+    reconcile.init_app(app)
+    profiling.init_app(app)
+    tracing.init_app(app)
+    slowlog.init_app(app)
     app.register_blueprint(api.blueprint)
 
     return app
@@ -0,0 +1,246 @@
+"""Admission control of the requests, used to keep the api responsive under bursts of ingestion.
+
+The requests are refused with 429 and a Retry-After header, before they wait on the locks of the database:
+
+- Each client has a token bucket of ADMISSION_BURST records, refilled with ADMISSION_RATE records by second,
+  and each phone_call request takes one token by record.
+- The workers run at most ADMISSION_CAPACITY requests at the same time, and at most ADMISSION_WRITE_BUDGET of
+  them are phone_call requests, so the rest of the capacity is reserved to the phone bills. The slots are locks
+  on a file shared by the workers of the host.
+
+The phone_call requests with more than ADMISSION_MAX_RECORDS records are refused with 413, as the bodies bigger
+than MAX_CONTENT_LENGTH, before they are parsed. The clients are told apart by their address, that is the one of
+the proxy unless PROXY_COUNT is set. The token buckets are by process, as the other caches of the api.
+"""
+import fcntl
+import math
+import os
+import threading
+import time
+
+from flask import current_app, g, request
+
+from api import constants, metrics
+from api.cache import MISSING, LRUCache
+from api.serializers import json_response
+
+
+WRITE_ENDPOINTS = ('api.phone_call',)
+
+
+class TokenBucket:
+    """Bucket of tokens refilled at a constant rate, up to its capacity."""
+
+    def __init__(self, rate, capacity, now):
+        """Constructor used to create a full bucket."""
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, cost, now):
+        """
+        Take the tokens of the cost from the bucket, if there are enough tokens.
+
+        A cost bigger than the capacity is admitted when the bucket is full, and all of it is taken, leaving the
+        bucket in debt until it is refilled, so the big requests are not a way around the rate.
+
+        Args:
+            cost (int): Number of tokens.
+            now (float): Current monotonic time, in seconds.
+
+        Returns:
+            (float): 0 when the tokens were taken, or the seconds to wait until there are enough tokens.
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(cost, self.capacity)
+        if self.tokens >= needed:
+            self.tokens -= cost
+            return 0
+
+        return (needed - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """Token buckets of the clients, keeping only the most recent clients."""
+
+    def __init__(self, rate, burst, clients):
+        """Constructor used to create the limiter without buckets."""
+        self.rate = rate
+        self.burst = burst
+        self.buckets = LRUCache(clients)
+        self._lock = threading.Lock()
+
+    def take(self, client, cost):
+        """Take the cost from the bucket of the client, returning the seconds to wait or 0 if admitted."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.buckets.get(client)
+            if bucket is MISSING:
+                bucket = TokenBucket(self.rate, self.burst, now)
+                self.buckets.put(client, bucket)
+
+            return bucket.take(cost, now)
+
+
+class ConcurrencyLimiter:
+    """
+    Slots of the requests in progress of all the workers, with a budget for the writes inside the total capacity.
+
+    Each slot is one byte of a file locked with fcntl by the process of the request, so the workers of the server
+    (e.g. the sync workers of gunicorn) share the limits, and the slots of a worker that died are released by the
+    system. The locks of a process do not exclude its own threads, so the slots taken by the process are also
+    kept on a set.
+    """
+
+    def __init__(self, path, capacity, write_budget):
+        """Constructor used to create the limiter without requests in progress, the file is opened on first use."""
+        self.path = path
+        self.capacity = capacity
+        self.write_budget = min(write_budget, capacity) if write_budget else capacity
+        self.in_flight = 0
+        self.writes = 0
+        self._fd = None
+        self._slots = set()
+        self._lock = threading.Lock()
+
+    def _take(self, start, count):
+        """Lock the first slot of the range free on all the processes, returning its offset or None."""
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        for offset in range(start, start + count):
+            if offset in self._slots:
+                continue
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, offset)
+            except OSError:
+                continue
+            self._slots.add(offset)
+            return offset
+
+        return None
+
+    def _release(self, slots):
+        """Unlock the slots taken by the process."""
+        for offset in slots:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+            self._slots.discard(offset)
+
+    def acquire(self, write):
+        """
+        Reserve a slot for the request, and a slot of the write budget for the writes.
+
+        Returns:
+            (tuple/None): Slots of the request, or None when the capacity or the write budget is used.
+        """
+        with self._lock:
+            slots = []
+            # the write slots are the first bytes of the file, followed by the slots of the capacity
+            if write:
+                offset = self._take(0, self.write_budget)
+                if offset is None:
+                    return None
+                slots.append(offset)
+
+            offset = self._take(self.write_budget, self.capacity)
+            if offset is None:
+                self._release(slots)
+                return None
+            slots.append(offset)
+
+            self.in_flight += 1
+            if write:
+                self.writes += 1
+            return tuple(slots)
+
+    def release(self, slots):
+        """Release the slots of a request that finished."""
+        with self._lock:
+            self._release(slots)
+            self.in_flight -= 1
+            if len(slots) > 1:
+                self.writes -= 1
+
+
+def too_many_requests(retry_after):
+    """Return the 429 response, with the seconds to wait before sending the request again."""
+    return json_response({
+        'success': False,
+        'errors': constants.MESSAGE_TOO_MANY_REQUESTS
+    }), 429, {'Retry-After': str(max(1, int(math.ceil(retry_after))))}
+
+
+def payload_too_large(error):
+    """Return the 413 response of the bodies bigger than the MAX_CONTENT_LENGTH config."""
+    return json_response({
+        'success': False,
+        'errors': constants.MESSAGE_PAYLOAD_TOO_LARGE.format(current_app.config['MAX_CONTENT_LENGTH'])
+    }), 413
+
+
+def admit_request():
+    """Reserve a slot for the request on the concurrency limiter, refusing it when there is no slot."""
+    limiter = current_app.extensions.get('admission_concurrency')
+    if limiter is None:
+        return None
+
+    slots = limiter.acquire(request.endpoint in WRITE_ENDPOINTS)
+    if slots is None:
+        return too_many_requests(1)
+
+    g.admission_slots = slots
+    return None
+
+
+def release_request(exception=None):
+    """Release the slots of the request, if it was admitted."""
+    if 'admission_slots' in g:
+        current_app.extensions['admission_concurrency'].release(g.pop('admission_slots'))
+
+
+def admit_records(count):
+    """
+    Check if the records of a phone_call request can be received from the client.
+
+    Args:
+        count (int): Number of records of the request.
+
+    Returns:
+        (tuple/None): The error response, or None when the records are admitted.
+    """
+    max_records = current_app.config['ADMISSION_MAX_RECORDS']
+    if max_records and count > max_records:
+        metrics.inc(metrics.RECORDS_REJECTED, count, ('too_many_records', ''))
+        return json_response({
+            'success': False,
+            'errors': constants.MESSAGE_TOO_MANY_RECORDS.format(max_records)
+        }), 413
+
+    rate_limiter = current_app.extensions.get('admission_rate')
+    if rate_limiter is not None:
+        retry_after = rate_limiter.take(request.remote_addr, count)
+        if retry_after:
+            metrics.inc(metrics.RECORDS_REJECTED, count, ('rate_limited', ''))
+            return too_many_requests(retry_after)
+
+    return None
+
+
+def init_app(app):
+    """
+    Create the limiters enabled by the ADMISSION_RATE and the ADMISSION_CAPACITY configs, the slots of the
+    requests on the ADMISSION_SLOTS_FILE, or on the instance folder when not given.
+    """
+    rate = app.config.get('ADMISSION_RATE')
+    app.extensions['admission_rate'] = RateLimiter(
+        rate, app.config['ADMISSION_BURST'] or rate, app.config['ADMISSION_CLIENTS']
+    ) if rate else None
+
+    capacity = app.config.get('ADMISSION_CAPACITY')
+    app.extensions['admission_concurrency'] = ConcurrencyLimiter(
+        app.config['ADMISSION_SLOTS_FILE'] or os.path.join(app.instance_path, 'admission.slots'),
+        capacity,
+        app.config['ADMISSION_WRITE_BUDGET'],
+    ) if capacity else None
@@ -1,11 +1,39 @@
 """API for olist technical test."""
-from flask import Blueprint, jsonify, render_template, request
+import tempfile
 
-from api import constants
+from flask import Blueprint, current_app, render_template, request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from api import constants, metrics, pairs, profiling, querylog, slowlog, tracing
+from api.admission import admit_records, admit_request, payload_too_large, release_request
+from api.compression import compress_response
+from api.db import get_db
+from api.ingest import DuplicatedRecordError, get_batch_status, record_key
 from api.models import CallRecord, PhoneBill
+from api.reconcile import find_orphans
+from api.serializers import BillWriter, file_response, json_response
+from api.utils import get_int_or_none
+from api.writer import WriteError
 
 
 blueprint = Blueprint('api', __name__, url_prefix='/')
+blueprint.before_request(profiling.start_profile)
+blueprint.teardown_request(profiling.finish_profile)
+blueprint.before_request(tracing.start_request)
+blueprint.teardown_request(tracing.finish_request)
+blueprint.after_request(tracing.add_trace_header)
+blueprint.before_request(slowlog.start_request)
+blueprint.after_request(slowlog.save_status)
+blueprint.teardown_request(slowlog.finish_request)
+blueprint.before_request(metrics.start_request)
+blueprint.before_request(querylog.start_request)
+blueprint.before_request(admit_request)
+blueprint.after_request(metrics.save_status)
+blueprint.teardown_request(metrics.finish_request)
+blueprint.teardown_request(release_request)
+blueprint.after_request(querylog.finish_request)
+blueprint.after_request(compress_response)
+blueprint.register_error_handler(RequestEntityTooLarge, payload_too_large)
 
 
 @blueprint.route('/', methods=['GET'])
@@ -19,50 +47,145 @@ def phone_call():
     """Endpoint to receive the telephone calls records and save it on the database."""
     data = request.json
     if not data:
-        return jsonify({
+        return json_response({
             'success': False,
             'errors': constants.MESSAGE_INVALID_DATA_REQUEST
         })
 
-    all_records = []
-    for item in data:
-        record = CallRecord(
-            item.get('id'),
-            item.get('type'),
-            item.get('timestamp'),
-            item.get('call_id'),
-            item.get('source'),
-            item.get('destination'),
-        )
-
-        errors = record.validate()
-        if errors:
-            return jsonify({
+    # the big payloads and the clients over their rate are refused before any record is validated or written
+    refused = admit_records(len(data))
+    if refused is not None:
+        return refused
+    slowlog.note(records=len(data))
+
+    ingest_queue = current_app.extensions.get('ingest_queue')
+    journal = current_app.extensions.get('journal')
+    records = []
+    keys = set()
+    # each stage of the request is one span, with the number of records, not one span by record
+    with tracing.span('records.validate', records=len(data)):
+        for item in data:
+            record = CallRecord(
+                item.get('id'),
+                item.get('type'),
+                item.get('timestamp'),
+                item.get('call_id'),
+                item.get('source'),
+                item.get('destination'),
+            )
+
+            errors = record.validate()
+            # the records of the request are not on the database yet, the duplicates among them are refused here
+            key = record_key(record)
+            if not errors and key in keys:
+                errors = [constants.MESSAGE_DUPLICATED_CALL_ID.format(*key)]
+            keys.add(key)
+            if errors:
+                metrics.count_rejected(errors)
+                return json_response({
+                    'success': False,
+                    'errors': errors
+                })
+            records.append(record)
+
+    try:
+        # the batch is journaled once, before it is applied, so the database can be rebuilt from the journal
+        token = journal.append(records) if journal is not None else None
+    except WriteError:
+        return json_response({
+            'success': False,
+            'errors': constants.MESSAGE_ERROR_SAVE
+        }), 503
+
+    # async ingestion: the records are committed in groups by the ingest queue
+    if ingest_queue is not None:
+        try:
+            token = ingest_queue.append(records, token)
+        except DuplicatedRecordError as error:
+            abort_journal(journal, token)
+            metrics.count_rejected([str(error)])
+            return json_response({
                 'success': False,
-                'errors': errors
+                'errors': [str(error)]
             })
+        except WriteError:
+            abort_journal(journal, token)
+            return json_response({
+                'success': False,
+                'errors': constants.MESSAGE_ERROR_SAVE
+            }), 503
+
+        metrics.inc(metrics.RECORDS_INGESTED, len(records))
+        return json_response({
+            'success': True,
+            'accepted': len(records),
+            'batch': token
+        }), 202
+
+    all_records = []
+    unsaved = []
+    with tracing.span('records.save', records=len(records)):
+        for index, record in enumerate(records):
+            try:
+                saved = record.save()
+            except WriteError:
+                abort_journal(journal, token, unsaved + list(range(index, len(records))))
+                return json_response({
+                    'success': False,
+                    'errors': constants.MESSAGE_ERROR_SAVE
+                }), 503
+
+            if saved:
+                all_records.append(record)
+            else:
+                unsaved.append(index)
 
-        if record.save():
-            all_records.append(record)
+    if unsaved:
+        abort_journal(journal, token, unsaved)
 
     if all_records:
-        return jsonify({
+        metrics.inc(metrics.RECORDS_INGESTED, len(all_records))
+        return json_response({
             'success': True,
             'processed': len(all_records)
         })
 
-    return jsonify({
+    return json_response({
         'success': False,
         'errors': constants.MESSAGE_INVALID_DATA_REQUEST
     })
 
 
+def abort_journal(journal, token, indexes=None):
+    """Mark the records of the batch that were not saved on the journal, when it is enabled."""
+    if journal is None:
+        return
+
+    try:
+        journal.abort(token, indexes)
+    except WriteError:
+        current_app.logger.exception('Error aborting the batch %s on the journal.', token)
+
+
+@blueprint.route('/api/v1/phone_call/batch/<token>', methods=['GET'])
+def phone_call_batch(token):
+    """Endpoint to check if a batch of records accepted by the async ingestion was already committed."""
+    status = get_batch_status(current_app.extensions.get('ingest_queue'), get_db(readonly=True), token)
+    if status is None:
+        return json_response({
+            'success': False,
+            'errors': constants.MESSAGE_BATCH_NOT_FOUND.format(token)
+        }), 404
+
+    return json_response(dict(status, success=True, batch=token))
+
+
 @blueprint.route('/api/v1/phone_bill', methods=['GET'])
 def phone_bill():
     """Endpoint to return the telephone bills."""
     data = request.args
     if not data:
-        return jsonify({
+        return json_response({
             'success': False,
             'errors': constants.MESSAGE_INVALID_DATA_REQUEST
         })
@@ -70,19 +193,96 @@ def phone_bill():
     phone_bill = PhoneBill(data.get('subscriber'), data.get('period'))
     errors = phone_bill.validate()
     if errors:
-        return jsonify({
+        return json_response({
             'success': False,
             'errors': errors
         })
 
-    phone_bill.calculate_phone_bill()
-    if phone_bill.save():
-        return jsonify({
-            'success': True,
-            'data': phone_bill.to_dict()
+    # query only mode: the bill is read from the read only connection and nothing is written
+    persist = current_app.config['PHONE_BILL_PERSIST']
+    spool_size = current_app.config['PHONE_BILL_SPOOL_SIZE']
+    # each chunk of calls is saved and encoded before the next one is rated, so only the encoded body of the bill
+    # is kept, spooled to a temporary file when it is big
+    body = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    writer = BillWriter(body, phone_bill)
+    try:
+        for phone_bill_calls in phone_bill.iter_rated_chunks():
+            if persist and not phone_bill.save_calls(phone_bill_calls):
+                body.close()
+                return json_response({
+                    'success': False,
+                    'errors': constants.MESSAGE_INVALID_DATA_REQUEST
+                })
+            writer.write_calls(phone_bill_calls)
+    except WriteError:
+        body.close()
+        return json_response({
+            'success': False,
+            'errors': constants.MESSAGE_ERROR_SAVE
+        }), 503
+
+    writer.finish()
+    return file_response(body, spool_size)
+
+
+@blueprint.route('/api/v1/reconcile', methods=['GET'])
+def reconcile():
+    """Endpoint to list the call records whose start or end record was not received, the oldest first."""
+    errors = []
+    values = {}
+    for name, default in (('min_age', pairs.RECONCILE_MIN_AGE), ('limit', pairs.RECONCILE_LIMIT)):
+        value = request.args.get(name)
+        values[name] = get_int_or_none(value) if value is not None else default
+        if values[name] is None or values[name] < 0:
+            errors.append(constants.MESSAGE_INVALID_FIELD.format(name))
+
+    if errors:
+        return json_response({
+            'success': False,
+            'errors': errors
         })
 
-    return jsonify({
-        'success': False,
-        'errors': constants.MESSAGE_INVALID_DATA_REQUEST
+    return json_response({
+        'success': True,
+        'orphans': find_orphans(values['min_age'], values['limit'])
+    })
+
+
+@blueprint.route('/metrics', methods=['GET'])
+def expose_metrics():
+    """Endpoint to return the metrics of all the processes of the api, on the text format of Prometheus."""
+    registry = current_app.extensions.get('metrics')
+    if registry is None:
+        return json_response({
+            'success': False,
+            'errors': constants.MESSAGE_METRICS_DISABLED
+        }), 404
+
+    return current_app.response_class(
+        metrics.expose(metrics.add_hit_ratios(registry.collect())),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
+
+
+@blueprint.route('/api/v1/traces', methods=['GET'])
+def traces():
+    """Endpoint to list the last spans traced by the process, of all the traces or of the trace_id."""
+    tracer = current_app.extensions.get('tracer')
+    if tracer is None:
+        return json_response({
+            'success': False,
+            'errors': constants.MESSAGE_TRACING_DISABLED
+        }), 404
+
+    limit = request.args.get('limit')
+    limit = get_int_or_none(limit) if limit is not None else constants.TRACES_LIMIT
+    if limit is None or limit < 0:
+        return json_response({
+            'success': False,
+            'errors': [constants.MESSAGE_INVALID_FIELD.format('limit')]
+        })
+
+    return json_response({
+        'success': True,
+        'spans': tracer.list_spans(request.args.get('trace_id'), limit)
     })
@@ -0,0 +1,395 @@
+"""Cold archive of the call records and the rated calls of the closed periods.
+
+Each archived period is stored on one zip file compressed with LZMA, with one member by column: the
+integer columns are stored as typed arrays and the text columns as json lists, so the archive of a
+month is small and each column can be read without the others. The archives read by the bills are kept
+parsed on the ARCHIVE_CACHE_SIZE cache of the process.
+"""
+import json
+import os
+import sys
+import zipfile
+from array import array
+from datetime import datetime
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+
+from api import constants, partitions, queries, shards
+from api.cache import LRUCache
+from api.db import fetch_chunks, get_db, use_shard
+from api.records import CallBatch, from_epoch_seconds, to_epoch_seconds
+from api.utils import get_int_or_none, normalize_phone_number
+from api.writer import run_write
+
+
+ARCHIVE_NAME = '{:04d}{:02d}.zip'
+MANIFEST_NAME = 'manifest.json'
+
+# columns of the call records stored by CallBatch, and their types
+RECORD_COLUMNS = (
+    ('record_ids', 'q'),
+    ('call_identifiers', 'q'),
+    ('timestamps', 'q'),
+    ('origin_numbers', 'json'),
+    ('destination_numbers', 'json'),
+)
+
+# columns of the phone_bill_call table, with the subscriber of the bill, and their types
+BILL_CALL_COLUMNS = (
+    ('id', 'q'),
+    ('bill_id', 'q'),
+    ('phone_key', 'json'),
+    ('call_identifier', 'q'),
+    ('destination_number', 'json'),
+    ('call_start', 'q'),
+    ('call_end', 'q'),
+    ('duration', 'json'),
+    ('price', 'd'),
+)
+
+TIMESTAMP_COLUMNS = ('call_start', 'call_end')
+
+
+def parse_period(period):
+    """
+    Return the month and the year of the period.
+
+    Args:
+        period (str): Period in the format month/year.
+
+    Returns:
+        (tuple/None): Month and year as integers, or None if the period is not valid.
+    """
+    splitted = (period or '').split('/')
+    if len(splitted) != 2:
+        return None
+
+    month, year = get_int_or_none(splitted[0]), get_int_or_none(splitted[1])
+    if not month or not year or not 1 <= month <= 12:
+        return None
+
+    return month, year
+
+
+def get_directory(app):
+    """Return the directory of the archives of the app."""
+    return app.config['ARCHIVE_DIRECTORY'] or os.path.join(app.instance_path, 'archive')
+
+
+def archive_path(directory, month, year):
+    """Return the path of the archive of the period."""
+    return os.path.join(directory, ARCHIVE_NAME.format(year, month))
+
+
+class PeriodArchive:
+    """
+    Reader of the archive of a period.
+
+    Each column is decompressed and parsed once, on its first use, and the subscribers of the start records
+    and of the rated calls are indexed, so a cached archive answers the next bills without reading the file.
+    The values returned are shared by the bills and must not be changed.
+    """
+
+    def __init__(self, path):
+        """Constructor used to open the archive of the path and read its manifest."""
+        self.path = path
+        with zipfile.ZipFile(path) as zip_file:
+            self.manifest = json.loads(zip_file.read(MANIFEST_NAME).decode('utf8'))
+        self._columns = {}
+        self._start_index = None
+        self._bill_index = None
+
+    def columns(self, prefix, columns):
+        """Return a dict with the values of the columns stored with the prefix, read once by archive."""
+        values = self._columns.get(prefix)
+        if values is None:
+            with zipfile.ZipFile(self.path) as zip_file:
+                values = self._columns[prefix] = self._read_columns(zip_file, prefix, columns)
+
+        return values
+
+    def _read_columns(self, zip_file, prefix, columns):
+        """Return a dict with the values of the columns stored with the prefix."""
+        values = {}
+        for name, column_type in columns:
+            data = zip_file.read('{}/{}'.format(prefix, name))
+            if column_type == 'json':
+                values[name] = json.loads(data.decode('utf8'))
+                continue
+
+            column = array(column_type)
+            column.frombytes(data)
+            if self.manifest['byteorder'] != sys.byteorder:
+                column.byteswap()
+            values[name] = column
+
+        return values
+
+    def records(self, record_type):
+        """Return the archived call records of the type as a CallBatch."""
+        batch = CallBatch(record_type)
+        for name, value in self.columns(record_type, RECORD_COLUMNS).items():
+            setattr(batch, name, value)
+
+        return batch
+
+    def start_records(self, phone_key):
+        """Return the archived start records of the subscriber as a CallBatch."""
+        records = self.records(constants.RECORD_TYPE_START)
+        if self._start_index is None:
+            index = {}
+            for position, origin_number in enumerate(records.origin_numbers):
+                index.setdefault(normalize_phone_number(origin_number), []).append(position)
+            self._start_index = index
+
+        batch = CallBatch(constants.RECORD_TYPE_START)
+        for position in self._start_index.get(phone_key, ()):
+            batch.append(
+                records.record_ids[position], from_epoch_seconds(records.timestamps[position]),
+                records.call_identifiers[position], records.origin_numbers[position],
+                records.destination_numbers[position]
+            )
+
+        return batch
+
+    def bill_calls(self, bill_id, phone_key):
+        """
+        Return the archived rated calls of the bill, as dicts with the fields of the phone_bill_call table.
+
+        The bill is identified by its id and its subscriber, because the ids are only unique on one shard.
+        """
+        columns = self.columns('bill_calls', BILL_CALL_COLUMNS)
+        if self._bill_index is None:
+            index = {}
+            for position, key in enumerate(zip(columns['bill_id'], columns['phone_key'])):
+                index.setdefault(key, []).append(position)
+            self._bill_index = index
+
+        rows = []
+        for position in self._bill_index.get((bill_id, phone_key), ()):
+            row = {name: columns[name][position] for name, _ in BILL_CALL_COLUMNS}
+            for name in TIMESTAMP_COLUMNS:
+                row[name] = from_epoch_seconds(row[name])
+            rows.append(row)
+
+        return rows
+
+    def missing(self, end_records, start_records, bill_calls):
+        """
+        Return the records and the rated calls read from the database that are not on the archive.
+
+        Used to resume an archive interrupted after the archive was written: the rows still on the database
+        can only be deleted when all of them were archived.
+
+        Returns:
+            (int): Number of rows that are not on the archive.
+        """
+        missing = 0
+        for batch in (end_records, start_records):
+            archived = set(self.columns(batch.record_type, RECORD_COLUMNS)['call_identifiers'])
+            missing += sum(1 for value in batch.call_identifiers if value not in archived)
+
+        columns = self.columns('bill_calls', BILL_CALL_COLUMNS)
+        archived = set(zip(columns['phone_key'], columns['call_identifier']))
+        missing += sum(1 for row in bill_calls if (row['phone_key'], row['call_identifier']) not in archived)
+
+        return missing
+
+    def is_valid(self):
+        """Check the checksums of all the members of the archive."""
+        with zipfile.ZipFile(self.path) as zip_file:
+            return zip_file.testzip() is None
+
+
+def open_period(period):
+    """
+    Return the archive of the period, or None when the period was not archived.
+
+    Args:
+        period (str): Period in the format month/year.
+
+    Returns:
+        (PeriodArchive/None): Reader of the archive.
+    """
+    parsed = parse_period(period)
+    if not parsed or not has_app_context():
+        return None
+
+    path = archive_path(get_directory(current_app), *parsed)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    archive_cache = current_app.extensions.get('archive_cache')
+    if archive_cache is None:
+        return PeriodArchive(path)
+
+    # the file of a period is only replaced by a new archive of it, that has other modification time
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    period_archive = archive_cache.get(key, None)
+    if period_archive is None:
+        period_archive = PeriodArchive(path)
+        archive_cache.put(key, period_archive)
+
+    return period_archive
+
+
+def write_columns(zip_file, prefix, columns, values, manifest):
+    """Write the values of the columns as members of the archive."""
+    for name, column_type in columns:
+        if column_type == 'json':
+            data = json.dumps(values[name], separators=(',', ':')).encode('utf8')
+        else:
+            data = array(column_type, values[name]).tobytes()
+
+        zip_file.writestr('{}/{}'.format(prefix, name), data)
+        manifest['columns']['{}/{}'.format(prefix, name)] = column_type
+
+
+def write_archive(path, period, end_records, start_records, bill_calls):
+    """
+    Write the archive of the period, replacing the file only after all its content is on the disk.
+
+    Args:
+        path (str): Path of the archive.
+        period (str): Period of the records.
+        end_records (CallBatch): End records of the period.
+        start_records (CallBatch): Start records of the calls ended on the period.
+        bill_calls (list): Rows of the phone_bill_call table of the bills of the period.
+    """
+    manifest = {
+        'period': period,
+        'byteorder': sys.byteorder,
+        'created_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        'records': {constants.RECORD_TYPE_END: len(end_records), constants.RECORD_TYPE_START: len(start_records)},
+        'bill_calls': len(bill_calls),
+        'columns': {},
+    }
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as archive_file:
+        with zipfile.ZipFile(archive_file, 'w', compression=zipfile.ZIP_LZMA) as zip_file:
+            for batch in (end_records, start_records):
+                values = {name: getattr(batch, name) for name, _ in RECORD_COLUMNS}
+                write_columns(zip_file, batch.record_type, RECORD_COLUMNS, values, manifest)
+
+            values = {name: [row[name] for row in bill_calls] for name, _ in BILL_CALL_COLUMNS}
+            for name in TIMESTAMP_COLUMNS:
+                values[name] = [to_epoch_seconds(value) for value in values[name]]
+            write_columns(zip_file, 'bill_calls', BILL_CALL_COLUMNS, values, manifest)
+
+            zip_file.writestr(MANIFEST_NAME, json.dumps(manifest, indent=2))
+
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+
+    os.replace(temporary_path, path)
+
+
+def read_period(db, month, year):
+    """
+    Read the records and the rated calls of the period from the database.
+
+    Returns:
+        (tuple): End records (CallBatch), start records of the calls ended on the period (CallBatch) and the rows
+            of the phone_bill_call table of the bills of the period (list).
+    """
+    end_records = CallBatch(constants.RECORD_TYPE_END)
+    for table_name in partitions.end_tables(db, year, month):
+        result = db.execute(
+            queries.select_end_records(table_name), ['end', '%m', '{:02}'.format(month), '%Y', '{:04}'.format(year)]
+        )
+        for rows in fetch_chunks(result):
+            end_records.append_rows(rows)
+
+    start_records = CallBatch(constants.RECORD_TYPE_START)
+    db.execute(queries.CREATE_TEMP_CALL_IDS)
+    try:
+        db.executemany(queries.INSERT_TEMP_CALL_IDS, ((call_id,) for call_id in end_records.call_identifiers))
+        for table_name in partitions.start_tables(db, year, month):
+            result = db.execute(queries.select_records_temp_table(table_name), ['start'])
+            for rows in fetch_chunks(result):
+                start_records.append_rows(rows)
+    finally:
+        db.execute(queries.CLEAR_TEMP_CALL_IDS)
+
+    period = '{:02}/{:04}'.format(month, year)
+    bill_calls = [dict(row) for row in db.execute(queries.SELECT_PERIOD_BILL_CALLS, [period])]
+
+    return end_records, start_records, bill_calls
+
+
+def delete_period(db, month, year, end_records, start_records, bill_calls):
+    """Delete the archived records and rated calls from the database, without committing."""
+    for table_name in partitions.end_tables(db, year, month):
+        db.executemany(queries.delete_by_id(table_name, 'record_id'), ((value,) for value in end_records.record_ids))
+
+    for table_name in partitions.start_tables(db, year, month):
+        db.executemany(queries.delete_by_id(table_name, 'record_id'), ((value,) for value in start_records.record_ids))
+
+    db.executemany(queries.delete_by_id('phone_bill_call', 'id'), ((row['id'],) for row in bill_calls))
+    # the archived end records without start record are not pending on the database anymore
+    db.executemany(
+        queries.DELETE_PENDING_PAIR, ((value, constants.RECORD_TYPE_END) for value in end_records.call_identifiers)
+    )
+    db.executemany(queries.DELETE_CALL_PAIR, ((value,) for value in end_records.call_identifiers))
+
+
+@click.command('archive-period')
+@click.argument('period')
+@with_appcontext
+def archive_period_command(period):
+    """Move the records and the rated calls of a closed PERIOD (month/year) to the archive."""
+    parsed = parse_period(period)
+    today = datetime.today()
+    if not parsed or (parsed[1], parsed[0]) >= (today.year, today.month):
+        raise click.BadParameter(constants.MESSAGE_INVALID_PERIOD, param_hint='period')
+
+    month, year = parsed
+    directory = get_directory(current_app)
+    path = archive_path(directory, month, year)
+
+    # the period of all the shards is stored on one archive, and deleted from each shard after it is written
+    shard_periods = shards.scatter(lambda db: read_period(db, month, year))
+    end_records, start_records = CallBatch(constants.RECORD_TYPE_END), CallBatch(constants.RECORD_TYPE_START)
+    bill_calls = []
+    for shard_end_records, shard_start_records, shard_bill_calls in shard_periods:
+        end_records.extend(shard_end_records)
+        start_records.extend(shard_start_records)
+        bill_calls.extend(shard_bill_calls)
+
+    if os.path.exists(path):
+        # a run stopped after the archive was written leaves rows on the database, they are deleted now when
+        # the archive is sound and has all of them
+        if not end_records and not start_records and not bill_calls:
+            raise click.ClickException('The period {:02}/{:04} is already archived.'.format(month, year))
+        period_archive = PeriodArchive(path)
+        if not period_archive.is_valid():
+            raise click.ClickException('The archive {} is corrupted.'.format(path))
+        missing = period_archive.missing(end_records, start_records, bill_calls)
+        if missing:
+            raise click.ClickException(
+                'The archive {} does not have {} rows of the database, move it to archive again.'.format(path, missing)
+            )
+        click.echo('Resuming the archive of the period {:02}/{:04} already written on {}.'.format(month, year, path))
+    else:
+        os.makedirs(directory, exist_ok=True)
+        write_archive(path, '{:02}/{:04}'.format(month, year), end_records, start_records, bill_calls)
+
+    for name, shard_period in zip(shards.get_shard_names(), shard_periods):
+        with use_shard(name):
+            run_write(lambda connection: delete_period(connection, month, year, *shard_period), get_db)
+
+    click.echo('Archived {} end records, {} start records and {} rated calls on {}.'.format(
+        len(end_records), len(start_records), len(bill_calls), path
+    ))
+
+
+def init_app(app):
+    """Create the cache of the parsed archives when it is enabled by the ARCHIVE_CACHE_SIZE config."""
+    size = app.config.get('ARCHIVE_CACHE_SIZE')
+    app.extensions['archive_cache'] = LRUCache(size) if size else None
+    app.cli.add_command(archive_period_command)
@@ -0,0 +1,166 @@
+"""ASGI serving mode of the api.
+
+The same Flask app, with the same routes and responses, is served by an ASGI server (e.g. uvicorn). The
+request bodies are received on the event loop, so slow or large uploads do not hold a thread, and only the
+complete requests are dispatched to a bounded pool of ASGI_THREADS threads, where the views and the
+database work run. The responses are streamed chunk by chunk, each chunk produced on the pool and sent
+from the event loop. The phone bills are encoded by the BillWriter of serializers.py chunk by chunk of rated
+calls into a spooled file, and the bills bigger than PHONE_BILL_SPOOL_SIZE are sent in blocks of that file, so
+a large bill is not held in memory as one body; the other responses are small json bodies sent as one chunk.
+"""
+import asyncio
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BodyTooLarge(Exception):
+    """The request body is bigger than the MAX_CONTENT_LENGTH config."""
+
+
+def build_environ(scope, body):
+    """
+    Return the WSGI environ of the ASGI request.
+
+    Args:
+        scope (dict): Scope of the http connection.
+        body (file): File with the complete body of the request, at the start position.
+
+    Returns:
+        (dict): WSGI environ of the request.
+    """
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        # the body was read until its end, so it is read by the app even without a Content-Length (chunked)
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'asgi.scope': scope,
+    }
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        # the repeated headers are joined as one value, as on the WSGI servers
+        environ[name] = '{},{}'.format(environ[name], value) if name in environ else value
+
+    return environ
+
+
+class AsgiApp:
+    """ASGI application that serves the WSGI app of Flask with a bounded thread pool."""
+
+    def __init__(self, app, threads=None):
+        """Constructor used to create the pool of the app, with the ASGI_THREADS config if not given."""
+        self.app = app
+        self.threads = threads or app.config['ASGI_THREADS']
+        self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        """Handle the ASGI connection."""
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        """Handle the startup and the shutdown of the server, releasing the pool on the shutdown."""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        """
+        Receive the body of the request, without blocking a thread while the client sends it.
+
+        The bodies bigger than the ASGI_SPOOL_SIZE config are spooled to a temporary file.
+
+        Returns:
+            (file/None): File with the body at the start position, or None if the client disconnected.
+
+        Raises:
+            BodyTooLarge: The body is bigger than the MAX_CONTENT_LENGTH config.
+        """
+        max_length = self.app.config.get('MAX_CONTENT_LENGTH')
+        body = tempfile.SpooledTemporaryFile(max_size=self.app.config['ASGI_SPOOL_SIZE'])
+        length = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+
+            chunk = message.get('body', b'')
+            length += len(chunk)
+            if max_length is not None and length > max_length:
+                body.close()
+                raise BodyTooLarge()
+            body.write(chunk)
+
+            if not message.get('more_body', False):
+                body.seek(0)
+                return body
+
+    async def http(self, scope, receive, send):
+        """Handle the http request, running the WSGI app and the iteration of its response on the pool."""
+        try:
+            body = await self.read_body(receive)
+        except BodyTooLarge:
+            await send({'type': 'http.response.start', 'status': 413, 'headers': [(b'content-length', b'0')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        if body is None:
+            return
+
+        loop = asyncio.get_running_loop()
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [
+                (name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers
+            ]
+
+        try:
+            iterable = await loop.run_in_executor(self.executor, self.app, build_environ(scope, body), start_response)
+            iterator = iter(iterable)
+            try:
+                await send({
+                    'type': 'http.response.start',
+                    'status': response['status'],
+                    'headers': response['headers'],
+                })
+                while True:
+                    chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                    if chunk is None:
+                        break
+                    if chunk:
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(iterable, 'close'):
+                    await loop.run_in_executor(self.executor, iterable.close)
+        finally:
+            body.close()
@@ -0,0 +1,197 @@
+"""Cache of the rows read by id, used to avoid repeated lookups on the database.
+
+The rows written by the process are removed from the cache when they are written. The writes of the other
+processes (e.g. the other gunicorn workers) are noticed by the data_version of sqlite, that changes when other
+connection commits on the database file: it is read once by request, and the whole process cache is discarded
+when it changed, so the cache never serves a row older than the start of the request.
+"""
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app, g, has_app_context
+
+from api.db import get_db
+
+
+MISSING = object()
+
+
+class LRUCache:
+    """Size bounded cache that discards the least recently used entries."""
+
+    def __init__(self, maxsize):
+        """Constructor used to create an empty cache with the maximum number of entries."""
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=MISSING):
+        """Return the value of the key, marking it as the most recently used one."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store the value of the key, discarding the oldest entry when the cache is full."""
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """Remove the key from the cache, if exists."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def discard(self):
+        """Remove all the entries, keeping the counters."""
+        with self._lock:
+            self._data.clear()
+
+    def clear(self):
+        """Remove all the entries and reset the counters."""
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the size and the counters of the cache."""
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+def get_identity_map():
+    """Return the identity map of the current request, or None when there is no app context."""
+    if not has_app_context():
+        return None
+
+    if 'identity_map' not in g:
+        g.identity_map = {}
+
+    return g.identity_map
+
+
+def get_process_cache():
+    """Return the cache shared by the requests of the process, or None when it is disabled."""
+    if not has_app_context():
+        return None
+
+    return current_app.extensions.get('model_cache')
+
+
+def check_process_cache(process_cache):
+    """
+    Discard the process cache when other connection committed on the database since the last check.
+
+    The check is made once by request and by shard, with the connection of the request.
+    """
+    checked = g.setdefault('model_cache_checked', set())
+    shard = g.get('shard_database')
+    if shard in checked:
+        return
+
+    checked.add(shard)
+    db = get_db()
+    data_version = db.execute('PRAGMA data_version').fetchone()[0]
+    if data_version != db.cache_data_version:
+        # the connections opened now have no previous version, the rows cached before them may be stale
+        process_cache.discard()
+        db.cache_data_version = data_version
+
+
+def get_key(table_name, id_field, id_value):
+    """Return the key of the id, including the shard selected on the request because the ids are per shard."""
+    return (g.get('shard_database'), table_name, id_field, id_value)
+
+
+def lookup(table_name, id_field, id_value):
+    """
+    Return the cached row of the id.
+
+    Args:
+        table_name (str): Name of the table of the row.
+        id_field (str): Name of the id field used on the lookup.
+        id_value (int): Value of the id.
+
+    Returns:
+        (dict/None/MISSING): A dict with the known fields of the row, None when it is known that the row
+            does not exist, or MISSING when there is nothing cached about the id.
+    """
+    identity_map = get_identity_map()
+    if identity_map is None:
+        return MISSING
+
+    key = get_key(table_name, id_field, id_value)
+
+    value = identity_map.get(key, MISSING)
+    if value is not MISSING:
+        return value
+
+    process_cache = get_process_cache()
+    if process_cache is not None:
+        check_process_cache(process_cache)
+        value = process_cache.get(key)
+        if value is not MISSING:
+            identity_map[key] = value
+
+    return value
+
+
+def store(table_name, id_field, id_value, row):
+    """
+    Store the row of the id, merging the fields already known.
+
+    Args:
+        table_name (str): Name of the table of the row.
+        id_field (str): Name of the id field used on the lookup.
+        id_value (int): Value of the id.
+        row (dict/None): Fields of the row or None if the row does not exist.
+    """
+    identity_map = get_identity_map()
+    if identity_map is None:
+        return
+
+    key = get_key(table_name, id_field, id_value)
+    current = identity_map.get(key)
+    if row is not None and current:
+        row = dict(current, **row)
+    identity_map[key] = row
+
+    # only the existent rows are shared with other requests, the new ones can be created by other workers
+    process_cache = get_process_cache()
+    if process_cache is not None and row is not None:
+        process_cache.put(key, row)
+
+
+def invalidate(table_name, id_field, id_value):
+    """Remove the row of the id from the identity map and from the process cache."""
+    identity_map = get_identity_map()
+    if identity_map is None:
+        return
+
+    key = get_key(table_name, id_field, id_value)
+    identity_map.pop(key, None)
+    process_cache = get_process_cache()
+    if process_cache is not None:
+        process_cache.invalidate(key)
+
+
+def init_app(app):
+    """Create the process cache when it is enabled by the MODEL_CACHE_SIZE config."""
+    size = app.config.get('MODEL_CACHE_SIZE')
+    app.extensions['model_cache'] = LRUCache(size) if size else None
@@ -0,0 +1,142 @@
+"""Compression of the api responses negotiated by the Accept-Encoding header.
+
+The json of the bills is very repetitive (the same numbers, ids and date prefixes on every call), so the
+responses bigger than COMPRESS_MIN_SIZE are compressed with the best encoding accepted by the client, among
+the COMPRESS_ENCODINGS available: gzip is always available, br and zstd when the brotli and the zstandard
+packages are installed. The streamed responses are compressed chunk by chunk, without reading the whole body,
+and the compressed bodies are kept on a cache by the digest of the body, so the same bill is not compressed
+again on every request.
+"""
+import hashlib
+import zlib
+
+from flask import current_app, request
+
+from api.cache import MISSING, LRUCache
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+class BrotliCompressor:
+    """Compressor of brotli with the same methods of the compressors of zlib."""
+
+    def __init__(self, level):
+        """Constructor used to create the compressor with the quality level."""
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        """Return the compressed bytes of the data that are already available."""
+        return self.compressor.process(data)
+
+    def flush(self):
+        """Return the remaining compressed bytes, finishing the stream."""
+        return self.compressor.finish()
+
+
+# functions that return a compressor of the encoding with the level
+COMPRESSORS = {
+    'gzip': lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+}
+if brotli is not None:  # pragma: no cover
+    COMPRESSORS['br'] = BrotliCompressor
+if zstandard is not None:  # pragma: no cover
+    COMPRESSORS['zstd'] = lambda level: zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def get_encoding():
+    """Return the encoding accepted by the client to compress the response, or None to send it as it is."""
+    encodings = [encoding for encoding in current_app.config['COMPRESS_ENCODINGS'] if encoding in COMPRESSORS]
+    return request.accept_encodings.best_match(encodings)
+
+
+def get_compressor(encoding):
+    """Return a new compressor of the encoding with the level of the COMPRESS_LEVELS config."""
+    return COMPRESSORS[encoding](current_app.config['COMPRESS_LEVELS'][encoding])
+
+
+def compress_body(encoding, data):
+    """
+    Return the compressed body, from the cache when the same body was already compressed.
+
+    Args:
+        encoding (str): Name of the encoding.
+        data (bytes): Body of the response.
+
+    Returns:
+        (bytes): Compressed body.
+    """
+    compression_cache = current_app.extensions.get('compression_cache')
+    if compression_cache is None:
+        compressor = get_compressor(encoding)
+        return compressor.compress(data) + compressor.flush()
+
+    # the digest is much faster than the compression, and identifies the body without keeping it on the cache
+    key = (encoding, hashlib.sha1(data).digest())
+    compressed = compression_cache.get(key)
+    if compressed is MISSING:
+        compressor = get_compressor(encoding)
+        compressed = compressor.compress(data) + compressor.flush()
+        compression_cache.put(key, compressed)
+
+    return compressed
+
+
+def compress_stream(compressor, iterable):
+    """Compress the chunks of the iterable as they are produced, closing it at the end."""
+    try:
+        for chunk in iterable:
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+def compress_response(response):
+    """
+    Compress the response with the encoding negotiated with the client, when it is worth it.
+
+    Args:
+        response (Response): Response of the view.
+
+    Returns:
+        (Response): The same response, compressed or not.
+    """
+    if (not current_app.config['COMPRESS_ENCODINGS'] or response.direct_passthrough or
+            response.status_code < 200 or response.status_code in (204, 304) or
+            'Content-Encoding' in response.headers):
+        return response
+
+    if not response.is_streamed and len(response.get_data()) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    # the body depends on the Accept-Encoding header even when it is not compressed for this client
+    response.vary.add('Accept-Encoding')
+    encoding = get_encoding()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(get_compressor(encoding), response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress_body(encoding, response.get_data()))
+    response.headers['Content-Encoding'] = encoding
+
+    return response
+
+
+def init_app(app):
+    """Create the cache of the compressed bodies when it is enabled by the COMPRESS_CACHE_SIZE config."""
+    size = app.config.get('COMPRESS_CACHE_SIZE')
+    app.extensions['compression_cache'] = LRUCache(size) if size else None
@@ -16,6 +16,14 @@ MESSAGE_INVALID_PERIOD = 'The field period must be a closed period.'
 
 MESSAGE_INVALID_DATA_REQUEST = 'Invalid data request.'
 MESSAGE_ERROR_SAVE = 'An error occurred. Please, try again or contact the support team.'
+MESSAGE_BATCH_NOT_FOUND = 'The batch {} was not found.'
+MESSAGE_TOO_MANY_RECORDS = 'The request has more than {} records.'
+MESSAGE_PAYLOAD_TOO_LARGE = 'The request has more than {} bytes.'
+MESSAGE_TOO_MANY_REQUESTS = 'Too many requests. Please, try again later.'
+MESSAGE_METRICS_DISABLED = 'The metrics are disabled.'
+MESSAGE_TRACING_DISABLED = 'The tracing is disabled.'
+
+TRACES_LIMIT = 1000
 
 STANDARD_INITIAL_TIME = '06:00'
 STANDARD_FINAL_TIME = '21:59'
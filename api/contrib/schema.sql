@@ -1,5 +1,9 @@
 DROP TABLE IF EXISTS phone_call;
 DROP TABLE IF EXISTS phone_bill;
+DROP TABLE IF EXISTS phone_bill_call;
+DROP TABLE IF EXISTS ingest_batch;
+DROP TABLE IF EXISTS pending_pair;
+DROP TABLE IF EXISTS call_pair;
 
 CREATE TABLE phone_call (
   record_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -7,15 +11,23 @@ CREATE TABLE phone_call (
   record_timestamp TIMESTAMP,
   call_identifier INTEGER,
   origin_number TEXT,
-  destination_number TEXT
+  destination_number TEXT,
+  origin_key INTEGER,
+  destination_key INTEGER
 );
 
+CREATE INDEX phone_call_origin_key_idx ON phone_call (origin_key, call_identifier);
+CREATE INDEX phone_call_call_identifier_idx ON phone_call (call_identifier, record_type);
+
 CREATE TABLE phone_bill (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   phone_number TEXT,
-  period TEXT
+  period TEXT,
+  phone_key INTEGER
 );
 
+CREATE INDEX phone_bill_phone_key_idx ON phone_bill (phone_key, period);
+
 CREATE TABLE phone_bill_call (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   bill_id INTEGER,
@@ -26,3 +38,29 @@ CREATE TABLE phone_bill_call (
   duration INTEGER,
   price REAL
 );
+
+CREATE INDEX phone_bill_call_call_identifier_idx ON phone_bill_call (call_identifier);
+
+CREATE TABLE ingest_batch (
+  token TEXT PRIMARY KEY,
+  records INTEGER,
+  committed_at TIMESTAMP
+);
+
+CREATE TABLE pending_pair (
+  call_identifier INTEGER,
+  record_type TEXT,
+  record_timestamp TIMESTAMP,
+  PRIMARY KEY (call_identifier, record_type)
+);
+
+CREATE INDEX pending_pair_record_timestamp_idx ON pending_pair (record_timestamp);
+
+CREATE TABLE call_pair (
+  call_identifier INTEGER PRIMARY KEY,
+  origin_key INTEGER,
+  start_month INTEGER,
+  end_month INTEGER
+);
+
+CREATE INDEX call_pair_origin_key_idx ON call_pair (origin_key, end_month, start_month);
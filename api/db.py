@@ -1,39 +1,462 @@
 """DB functions for the api."""
+import os
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
 
 import click
-from flask import current_app, g
+from flask import current_app, g, has_app_context
 from flask.cli import with_appcontext
 
+from api import metrics, pairs, partitions
+from api.utils import normalize_phone_number
 
-def get_db():
-    """Return the db instance."""
-    if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
+
+FETCH_SIZE = 1000
+
+SHARD_NAME = 'shard{}'
+
+# key columns added to the tables after their first version, with the number column of each key
+KEY_COLUMNS = (
+    ('phone_call', 'origin_key', 'origin_number'),
+    ('phone_call', 'destination_key', 'destination_number'),
+    ('phone_bill', 'phone_key', 'phone_number'),
+)
+CREATE_STATEMENT = re.compile(r'^CREATE (TABLE|INDEX) ', re.MULTILINE)
+
+PRAGMAS_CONFIG = (
+    ('journal_mode', 'DATABASE_JOURNAL_MODE'),
+    ('synchronous', 'DATABASE_SYNCHRONOUS'),
+    ('cache_size', 'DATABASE_CACHE_SIZE'),
+    ('mmap_size', 'DATABASE_MMAP_SIZE'),
+    ('temp_store', 'DATABASE_TEMP_STORE'),
+    ('busy_timeout', 'DATABASE_BUSY_TIMEOUT'),
+)
+
+
+def statement_operation(sql):
+    """Return the first word of the statement (e.g. SELECT), used to label its metrics."""
+    words = sql[:64].split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records the latency of the statements on the histogram of its connection."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.record(sql, time.perf_counter() - start)
+
+    def record(self, sql, duration):
+        """Record the execution of the statement."""
+        histogram = self.connection.query_histogram
+        if histogram is not None:
+            histogram.observe(duration, (statement_operation(sql),))
+
+
+class LoggedCursor(InstrumentedCursor):
+    """Cursor that also records the statements and the rows read or written on the query log of the request."""
+
+    entry = None
+
+    def record(self, sql, duration):
+        """Record the execution of the statement, with the rows written by it."""
+        super().record(sql, duration)
+        query_log = self.connection.query_log
+        if query_log is not None:
+            self.query_log = query_log
+            self.entry = query_log.record(sql, duration, max(self.rowcount, 0))
+
+    def count_rows(self, rows):
+        """Add the rows read to the entry of the last statement."""
+        if self.entry is not None and rows:
+            self.query_log.add_rows(self.entry, rows)
+
+    def fetchone(self):
+        row = super().fetchone()
+        self.count_rows(row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self.count_rows(len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        self.count_rows(1)
+        return row
+
+
+class Connection(sqlite3.Connection):
+    """
+    Connection of the api, that keeps the partitions of the database cached (see partitions.get_partitions), and
+    the data_version seen by the process cache of the rows (see cache.check_process_cache).
+    """
+
+    partition_state = None
+    cache_data_version = None
+
+
+class InstrumentedConnection(Connection):
+    """
+    Connection whose cursors are instrumented, including the cursors of the execute shortcuts.
+
+    The statements are recorded on the query_histogram of the metrics, and on the query_log of the request
+    that is using the connection, when they are set.
+    """
+
+    query_histogram = None
+    query_log = None
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or (InstrumentedCursor if self.query_log is None else LoggedCursor))
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionManager:
+    """
+    Manager of the connections of the app with the database.
+
+    When the DATABASE_PERSISTENT config is enabled, each thread keeps one long lived connection for each
+    database file, so the requests do not pay for opening the connection and warming the page cache.
+    The connections are always opened inside the process that uses them: when the process id changes
+    (e.g. after gunicorn forks the workers) the connections inherited from the parent are discarded, and
+    the connections of the threads that finished are closed when a new one is opened. A reused connection is
+    checked only after a request failed with a database error on it, or once by DATABASE_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self, app):
+        """Constructor used to create the manager of the app."""
+        self.app = app
+        self.opened = 0
+        self.closed = 0
+        self.failed_checks = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """Discard the connections of the manager, used when the process was forked."""
+        self._pid = os.getpid()
+        self._connections = {}
+        self._suspects = set()
+
+    def connect(self, database, readonly=False):
+        """
+        Open a new connection with the database, applying the PRAGMAs of the config.
+
+        Args:
+            database (str): Path of the database file.
+            readonly (bool): Open the file with mode=ro, the connection will never take write locks.
+
+        Returns:
+            (sqlite3.Connection): The connection opened.
+        """
+        config = self.app.config
+        # the statements are timed only when the metrics, the query log or the slow request log are enabled, the
+        # plain connection has no overhead
+        registry = self.app.extensions.get('metrics')
+        instrumented = registry is not None or config['DATABASE_QUERY_LOG'] or config['SLOW_REQUEST_THRESHOLD']
+        db = sqlite3.connect(
+            'file:{}?mode=ro'.format(quote(database)) if readonly else database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=config['DATABASE_CACHED_STATEMENTS'],
+            check_same_thread=False,
+            uri=readonly,
+            factory=InstrumentedConnection if instrumented else Connection,
         )
-        g.db.row_factory = sqlite3.Row
+        db.row_factory = sqlite3.Row
+        if registry is not None:
+            db.query_histogram = registry.metrics[metrics.QUERY_SECONDS]
+
+        for pragma, config_name in PRAGMAS_CONFIG:
+            value = config.get(config_name)
+            # the journal mode is a property of the database file, only the writers can change it
+            if value is not None and not (readonly and pragma == 'journal_mode'):
+                db.execute('PRAGMA {} = {}'.format(pragma, value))
+
+        with self._lock:
+            self.opened += 1
+
+        return db
+
+    def close(self, db):
+        """Close the connection."""
+        try:
+            db.close()
+        finally:
+            with self._lock:
+                self.closed += 1
+
+    def get(self, database, readonly=False):
+        """
+        Return the connection of the current thread with the database, opening it if needed.
+
+        Args:
+            database (str): Path of the database file.
+            readonly (bool): Return a read only connection.
+
+        Returns:
+            (sqlite3.Connection): Connection ready to be used by the request.
+        """
+        if not self.app.config['DATABASE_PERSISTENT']:
+            return self.connect(database, readonly)
+
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
 
-    return g.db
+        thread = threading.current_thread()
+        key = (thread.ident, database, readonly)
+        entry = self._connections.get(key)
+        if entry is not None:
+            owner, db, checked = entry
+            if owner is thread:
+                now = time.monotonic()
+                if db not in self._suspects and now - checked < self.app.config['DATABASE_CHECK_INTERVAL']:
+                    return db
+                if self.check(db):
+                    self._suspects.discard(db)
+                    self._connections[key] = (thread, db, now)
+                    return db
+            self._discard(key)
+
+        db = self.connect(database, readonly)
+        with self._lock:
+            self._connections[key] = (thread, db, time.monotonic())
+        self._close_dead_threads()
+
+        return db
+
+    def release(self, db, error=None):
+        """
+        Give back the connection used by a request, closing it if the connections are not persistent.
+
+        Args:
+            db (sqlite3.Connection): Connection used by the request.
+            error (Exception): Error that finished the request, if any.
+        """
+        if not self.app.config['DATABASE_PERSISTENT']:
+            self.close(db)
+            return
+
+        # never let a failed request keep a transaction (and its locks) open on a persistent connection, the
+        # connections that failed are checked by the next get, and replaced when they are not usable anymore
+        failed = isinstance(error, sqlite3.Error)
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            failed = True
+        if failed:
+            partitions.invalidate(db)
+            with self._lock:
+                self._suspects.add(db)
+
+    def check(self, db):
+        """Check if the connection is usable, counting the failed checks."""
+        try:
+            db.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            with self._lock:
+                self.failed_checks += 1
+            return False
+
+    def _discard(self, key):
+        """Remove the persistent connection of the key and close it."""
+        with self._lock:
+            entry = self._connections.pop(key, None)
+            if entry is not None:
+                self._suspects.discard(entry[1])
+        if entry is not None:
+            try:
+                self.close(entry[1])
+            except sqlite3.Error:
+                pass
+
+    def _close_dead_threads(self):
+        """Close the persistent connections of the threads that already finished."""
+        for key, (owner, db, checked) in list(self._connections.items()):
+            if not owner.is_alive():
+                self._discard(key)
+
+    def close_all(self):
+        """Close all the persistent connections opened by the current process."""
+        if self._pid != os.getpid():
+            return
+
+        # the read only connections are closed first, so the last writer can checkpoint and remove the WAL
+        for key in sorted(self._connections, key=lambda key: not key[2]):
+            self._discard(key)
+
+    def stats(self):
+        """Return the counters of the manager and the number of persistent connections open."""
+        return {
+            'persistent': len(self._connections),
+            'opened': self.opened,
+            'closed': self.closed,
+            'failed_checks': self.failed_checks,
+        }
+
+
+def shard_names(count):
+    """Return the names of the shards for the number of shards."""
+    return [SHARD_NAME.format(index) for index in range(count or 0)]
+
+
+def shard_path(app, name):
+    """Return the path of the database file of the shard, next to the DATABASE file."""
+    root, extension = os.path.splitext(app.config['DATABASE'])
+    return '{}.{}{}'.format(root, name, extension or '.sqlite')
+
+
+@contextmanager
+def use_shard(name):
+    """Select the shard whose connection is returned by get_db inside the block. Nothing changes when name is None."""
+    if name is None or not has_app_context():
+        yield
+        return
+
+    previous = g.get('shard_database')
+    g.shard_database = shard_path(current_app, name)
+    try:
+        yield
+    finally:
+        g.shard_database = previous
+
+
+def get_db(readonly=False):
+    """
+    Return the db instance.
+
+    The connection is of the shard selected by use_shard, or of the DATABASE file when no shard is selected.
+
+    Args:
+        readonly (bool): Return the read only connection of the request, used by the queries that never
+            write so they do not share the transactions of the writers. The same connection of the
+            writers is returned when the DATABASE_READONLY config is disabled.
+    """
+    database = g.get('shard_database') or current_app.config['DATABASE']
+    readonly = readonly and current_app.config['DATABASE_READONLY']
+    if 'databases' not in g:
+        g.databases = {}
+
+    key = (database, readonly)
+    if key not in g.databases:
+        db = g.databases[key] = current_app.extensions['db'].get(database, readonly=readonly)
+        if isinstance(db, InstrumentedConnection):
+            db.query_log = g.get('query_log')
+
+    return g.databases[key]
 
 
 def close_db(e=None):
-    """Close the db instance, if exists."""
-    db = g.pop('db', None)
+    """Release the db instances, if exist."""
+    for db in g.pop('databases', {}).values():
+        if isinstance(db, InstrumentedConnection):
+            db.query_log = None
+        current_app.extensions['db'].release(db, e)
+
+
+def fetch_chunks(cursor, size=FETCH_SIZE):
+    """
+    Generate the rows of the executed cursor in chunks.
 
-    if db is not None:
-        db.close()
+    Args:
+        cursor (sqlite3.Cursor): Cursor with a query executed.
+        size (int): Maximum number of rows of each chunk.
+
+    Yields:
+        (list): List with the rows of the chunk.
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield rows
 
 
 def init_db():
-    """Initialize the database creating the schema."""
-    db = get_db()
+    """Initialize the database, and its shards when the sharding is enabled, creating the schema."""
+    for name in [None] + shard_names(current_app.config['DATABASE_SHARDS']):
+        with use_shard(name):
+            db = get_db()
+            partitions.drop_partitions(db)
+            create_schema(db)
+
 
+def create_schema(db):
+    """Create the tables of schema.sql on the database, dropping the existent ones."""
     with current_app.open_resource('contrib/schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
 
 
+def migrate_db():
+    """Migrate the database, and its shards when the sharding is enabled, to the schema of schema.sql."""
+    for name in [None] + shard_names(current_app.config['DATABASE_SHARDS']):
+        with use_shard(name):
+            db = get_db()
+            migrate_schema(db)
+            db.commit()
+
+
+def migrate_schema(db):
+    """
+    Migrate a database created by an older schema.sql, keeping its data, without committing.
+
+    The missing key columns are added and the keys of all the rows are calculated again, so the keys of the
+    databases created before a change of normalize_phone_number are also updated. The missing tables and
+    indexes are created, and the index of the pairs is rebuilt from the records with their new keys.
+    """
+    partitioned = partitions.is_partitioned(db)
+    record_tables = partitions.record_tables(db)
+    db.create_function('normalize_phone_number', 1, normalize_phone_number)
+    for table, column, number_column in KEY_COLUMNS:
+        for name in record_tables if table == partitions.CALLS_TABLE else [table]:
+            columns = [row[1] for row in db.execute('PRAGMA table_info({})'.format(name))]
+            if column not in columns:
+                db.execute('ALTER TABLE {} ADD COLUMN {} INTEGER'.format(name, column))
+            db.execute('UPDATE {} SET {} = normalize_phone_number({})'.format(name, column, number_column))
+
+    with current_app.open_resource('contrib/schema.sql') as f:
+        script = f.read().decode('utf8')
+    for statement in script.split(';'):
+        statement = statement.strip()
+        if not statement.startswith('CREATE'):
+            continue
+        # the partitions are created with their own indexes
+        if partitioned and ' {} ('.format(partitions.CALLS_TABLE) in statement:
+            continue
+        db.execute(CREATE_STATEMENT.sub(r'CREATE \1 IF NOT EXISTS ', statement))
+
+    pairs.rebuild_pairs(db)
+
+
 @click.command('init-db')
 @with_appcontext
 def init_db_command():
@@ -42,6 +465,44 @@ def init_db_command():
     click.echo('Initialized the database.')
 
 
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """Migrate the existing tables to the current schema, keeping their data."""
+    migrate_db()
+    click.echo('Migrated the database.')
+
+
+@click.command('db-status')
+@with_appcontext
+def db_status_command():
+    """Show the health of the database connection and the counters of the connections."""
+    manager = current_app.extensions['db']
+    healthy = manager.check(get_db())
+    click.echo('Connection: {}'.format('ok' if healthy else 'failed'))
+    for name, value in sorted(manager.stats().items()):
+        click.echo('{}: {}'.format(name, value))
+
+
+@click.command('partition-calls')
+@with_appcontext
+def partition_calls_command():
+    """Move the call records to monthly partitions, on each shard when the sharding is enabled."""
+    for shard in shard_names(current_app.config['DATABASE_SHARDS']) or [None]:
+        with use_shard(shard):
+            db = get_db()
+            partitions.partition_calls(db)
+            db.commit()
+
+            for name in partitions.list_partitions(db):
+                count = db.execute('SELECT COUNT(*) FROM {}'.format(name)).fetchone()[0]
+                click.echo('{}{}: {} records'.format('{}/'.format(shard) if shard else '', name, count))
+
+
 def init_app(app):
+    app.extensions['db'] = ConnectionManager(app)
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(db_status_command)
+    app.cli.add_command(partition_calls_command)
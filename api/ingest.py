@@ -0,0 +1,330 @@
+"""Group commit of the call records received by the api."""
+import atexit
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+from api import cache, constants, queries, shards
+from api.db import get_db, use_shard
+from api.writer import WriteError, run_with_retry, run_write
+
+
+BATCH_STATUS_PENDING = 'pending'
+BATCH_STATUS_COMMITTED = 'committed'
+BATCH_STATUS_FAILED = 'failed'
+# the batches queued by other worker, that only knows them until they are committed, or tokens never accepted
+BATCH_STATUS_UNKNOWN = 'unknown'
+
+
+class DuplicatedRecordError(ValueError):
+    """Raised when a record has the call id and the type of a record already queued."""
+
+    def __init__(self, record):
+        """Constructor used to keep the duplicated record."""
+        super().__init__(constants.MESSAGE_DUPLICATED_CALL_ID.format(record.call_identifier, record.record_type))
+        self.record = record
+
+
+def record_key(record):
+    """Return the call id and the type of the record, that are unique on the database."""
+    return record.call_identifier, record.record_type
+
+
+class IngestQueue:
+    """
+    Queue of the validated call records waiting to be committed.
+
+    The requests append their records and receive a batch token without waiting for the database. A
+    background committer writes all the pending batches in one transaction when INGEST_FLUSH_RECORDS
+    records are pending, or INGEST_FLUSH_INTERVAL milliseconds after the oldest pending batch. The
+    committed tokens are stored on the ingest_batch table in the same transaction, so the status of a
+    batch can be checked by any worker.
+
+    The records with the call id and the type of a record queued by the process are refused by append, and
+    the committer checks them again on the transaction, skipping the ones already saved by other processes.
+    The batches are pending until their transaction is committed or fails, including while they are written.
+    The pending batches are committed when the process exits.
+    """
+
+    def __init__(self, app):
+        """Constructor used to create the queue of the app, the committer is started on the first batch."""
+        self.app = app
+        self.flushes = 0
+        self.duplicates = 0
+        self._condition = threading.Condition()
+        self._pid = None
+        self._thread = None
+        self._stopped = False
+        self._pending = []
+        self._pending_records = 0
+        self._oldest = None
+        self._queued_keys = set()
+        self._flushing = set()
+        self._failed = OrderedDict()
+
+    def _start(self):
+        """Start the committer thread of the current process, discarding the batches inherited from the parent."""
+        self._pid = os.getpid()
+        self._stopped = False
+        self._pending = []
+        self._pending_records = 0
+        self._oldest = None
+        self._queued_keys = set()
+        self._flushing = set()
+        self._thread = threading.Thread(target=self._worker, name='ingest-committer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop, self.app.config['WRITE_TIMEOUT'])
+
+    def append(self, records, token=None):
+        """
+        Append the records on the queue as a new batch.
+
+        Args:
+            records (list): CallRecord objects already validated.
+            token (str): Token of the batch, e.g. the one of the batch on the journal. A new one if not given.
+
+        Returns:
+            (str): Token of the batch, used to check its status.
+
+        Raises:
+            WriteError: The queue was stopped.
+            DuplicatedRecordError: A record has the call id and the type of a record queued before.
+        """
+        token = token or uuid.uuid4().hex
+        keys = [record_key(record) for record in records]
+        with self._condition:
+            if self._pid != os.getpid():
+                self._start()
+            elif self._stopped:
+                raise WriteError('The ingest queue is stopped.')
+
+            for record, key in zip(records, keys):
+                if key in self._queued_keys:
+                    raise DuplicatedRecordError(record)
+            self._queued_keys.update(keys)
+            self._pending.append((token, records))
+            self._pending_records += len(records)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._condition.notify()
+
+        return token
+
+    def status(self, token):
+        """
+        Return the status of the batch.
+
+        Args:
+            token (str): Token returned when the batch was appended.
+
+        Returns:
+            (str/None): Status of the batch or None when the token is unknown.
+        """
+        with self._condition:
+            if token in self._flushing or any(pending_token == token for pending_token, _ in self._pending):
+                return BATCH_STATUS_PENDING
+            if token in self._failed:
+                return BATCH_STATUS_FAILED
+
+        return None
+
+    def stop(self, timeout=None):
+        """Commit the pending batches and stop the committer of the current process."""
+        with self._condition:
+            if self._pid != os.getpid() or self._stopped:
+                return
+            self._stopped = True
+            thread = self._thread
+            self._condition.notify()
+
+        thread.join(timeout)
+
+    def _wait_batches(self):
+        """Wait until the pending batches should be flushed, and take them from the queue."""
+        config = self.app.config
+        interval = config['INGEST_FLUSH_INTERVAL'] / 1000
+        with self._condition:
+            while not self._stopped:
+                if self._pending_records >= config['INGEST_FLUSH_RECORDS']:
+                    break
+                if self._oldest is not None:
+                    remaining = self._oldest + interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+
+            batches = self._pending
+            self._flushing.update(token for token, _ in batches)
+            self._pending = []
+            self._pending_records = 0
+            self._oldest = None
+            return batches, self._stopped
+
+    def _worker(self):
+        """Commit the pending batches until the queue is stopped."""
+        db = self.app.extensions['db'].connect(self.app.config['DATABASE'])
+        try:
+            while True:
+                batches, stopped = self._wait_batches()
+                if batches:
+                    self._flush(db, batches)
+                if stopped:
+                    return
+        finally:
+            self.app.extensions['db'].close(db)
+
+    def _flush(self, db, batches):
+        """
+        Write the batches in one transaction, using the write coordinator when it is enabled.
+
+        The records already saved (by other processes, or by a batch before on the same transaction) are
+        skipped, and the batches store only the number of records written. When the sharding is enabled the
+        records are saved on their shards, in one transaction by shard, before the transaction of the batches,
+        that only stores the tokens on the DATABASE file.
+        """
+        sharded = self.app.extensions.get('shard_ring') is not None
+        written = {token: 0 for token, _ in batches}
+        # the positions of the records of each batch already committed, the others are aborted on the journal
+        done = {token: set() for token, _ in batches}
+
+        def job(connection):
+            committed_at = datetime.utcnow()
+            for token, records in batches:
+                if not sharded:
+                    written[token] = 0
+                    for record in records:
+                        if not record.exists_call_id(connection):
+                            record.write(connection)
+                            written[token] += 1
+                connection.execute(
+                    queries.insert('ingest_batch', ('token', 'records', 'committed_at')),
+                    [token, written[token], committed_at]
+                )
+
+        config = self.app.config
+        coordinator = self.app.extensions.get('write_coordinator')
+        try:
+            if sharded:
+                with self.app.app_context():
+                    self._save_sharded(batches, written, done)
+            if coordinator is not None:
+                coordinator.run(job)
+            else:
+                run_with_retry(job, db, config['WRITE_RETRIES'], config['WRITE_BACKOFF'])
+        except Exception as error:
+            self.app.logger.exception('Error committing the ingest batches.')
+            with self._condition:
+                for token, _ in batches:
+                    self._failed[token] = str(error)
+                while len(self._failed) > config['INGEST_STATUS_SIZE']:
+                    self._failed.popitem(last=False)
+            self._abort_journal(batches, done)
+            return
+        finally:
+            with self._condition:
+                for token, records in batches:
+                    self._queued_keys.difference_update(record_key(record) for record in records)
+                    self._flushing.discard(token)
+
+        duplicates = sum(len(records) - written[token] for token, records in batches)
+        if duplicates:
+            self.app.logger.warning('Skipped %s duplicated records of the ingest batches.', duplicates)
+        self.flushes += 1
+        self.duplicates += duplicates
+        with self.app.app_context():
+            for _, records in batches:
+                for record in records:
+                    cache.invalidate(record.TABLE_NAME, 'record_id', record.record_id)
+
+    def _save_sharded(self, batches, written, done):
+        """
+        Save the records of the batches on their shards, in one transaction by shard.
+
+        The end records received before their start record are moved to the shard of the start after the
+        transactions, as by CallRecord.save.
+
+        Args:
+            batches (list): Tokens and records of the batches.
+            written (dict): Number of records written of each token, updated after each transaction.
+            done (dict): Positions of the records of each token committed or skipped, updated after each transaction.
+        """
+        by_shard = OrderedDict()
+        for token, records in batches:
+            for index, record in enumerate(records):
+                by_shard.setdefault(record.route(), []).append((token, index, record))
+
+        for shard, entries in by_shard.items():
+            saved = []
+
+            def job(connection):
+                # the job is executed again when the database is locked, after the rollback
+                del saved[:]
+                for token, index, record in entries:
+                    if not record.exists_call_id(connection):
+                        record.write(connection)
+                        saved.append((token, record))
+
+            with use_shard(shard):
+                run_write(job, get_db)
+            for token, index, _ in entries:
+                done[token].add(index)
+
+            for token, record in saved:
+                written[token] += 1
+                if record.record_type == constants.RECORD_TYPE_START:
+                    shards.claim_pending_end(record.call_identifier, shard)
+                elif record.record_type == constants.RECORD_TYPE_END:
+                    record.shard = shards.settle_pending_end(record.call_identifier, shard)
+
+    def _abort_journal(self, batches, done=None):
+        """Mark the records of the failed batches that were not committed as not saved on the journal, when enabled."""
+        journal = self.app.extensions.get('journal')
+        if journal is None:
+            return
+
+        for token, records in batches:
+            committed = done.get(token) if done else None
+            if committed and len(committed) == len(records):
+                continue
+
+            indexes = [index for index in range(len(records)) if index not in committed] if committed else None
+            try:
+                journal.abort(token, indexes)
+            except WriteError:
+                self.app.logger.exception('Error aborting the batch %s on the journal.', token)
+
+
+def get_batch_status(ingest_queue, db, token):
+    """
+    Return the status of the batch, checking the pending ones and the committed ones on the database.
+
+    Args:
+        ingest_queue (IngestQueue): Queue of the current process.
+        db (sqlite3.Connection): Connection used to check the committed batches.
+        token (str): Token of the batch.
+
+    Returns:
+        (dict/None): Status and number of records of the batch, or None when the async ingestion is disabled and
+            the token is not committed.
+    """
+    # the queue is checked first: a batch committed after it was checked is already on the database
+    status = ingest_queue.status(token) if ingest_queue else None
+    if status:
+        return {'status': status}
+
+    row = db.execute(queries.SELECT_INGEST_BATCH, [token]).fetchone()
+    if row:
+        return {'status': BATCH_STATUS_COMMITTED, 'records': row['records']}
+
+    # the batches queued by the other workers are only known by them until they are committed
+    return {'status': BATCH_STATUS_UNKNOWN} if ingest_queue else None
+
+
+def init_app(app):
+    """Create the ingest queue when it is enabled by the INGEST_ASYNC config."""
+    app.extensions['ingest_queue'] = IngestQueue(app) if app.config['INGEST_ASYNC'] else None
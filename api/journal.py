@@ -0,0 +1,372 @@
+"""Append-only journal of the call records accepted by the api."""
+import fcntl
+import json
+import os
+import re
+import struct
+import threading
+import uuid
+import zlib
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from api import cache, constants, pairs, partitions, queries, shards
+from api.db import get_db, use_shard
+from api.models import CallRecord
+from api.utils import get_int_or_none, normalize_phone_number
+from api.writer import WriteError, run_with_retry
+
+
+JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024
+REPLAY_BATCH_SIZE = 1000
+
+REPLAY_FIELDS = (
+    'record_type', 'record_timestamp', 'call_identifier', 'origin_number', 'destination_number', 'origin_key',
+    'destination_key', 'record_id',
+)
+
+SEGMENT_PATTERN = re.compile(r'^(\d{8})\.journal$')
+SEGMENT_NAME = '{:08d}.journal'
+LOCK_NAME = 'journal.lock'
+
+# each entry is the size and the crc32 of the payload, followed by the payload encoded as json
+ENTRY_HEADER = struct.Struct('>II')
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def encode_record(record):
+    """Return the fields of the call record as a dict that can be encoded as json."""
+    return {
+        'record_id': record.record_id,
+        'record_type': record.record_type,
+        'record_timestamp': record.record_timestamp.strftime(TIMESTAMP_FORMAT) if record.record_timestamp else None,
+        'call_identifier': record.call_identifier,
+        'origin_number': record.origin_number,
+        'destination_number': record.destination_number,
+    }
+
+
+class Journal:
+    """
+    Journal stored on numbered segment files, where each accepted batch of records is appended as one entry.
+
+    The appends of all the workers are serialized by a lock file, and a new segment is started when the
+    current one reaches the segment size, so the old segments can be moved or removed without stopping
+    the api. Each batch has a token, and the records of a batch that could not be saved after they were
+    journaled are marked by an abort entry with the token, so they are not replayed.
+    """
+
+    def __init__(self, directory, segment_size=JOURNAL_SEGMENT_SIZE, fsync=True):
+        """Constructor used to create the journal on the directory, that is created if needed."""
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self):
+        """Return the paths of the segment files, in order."""
+        names = sorted(name for name in os.listdir(self.directory) if SEGMENT_PATTERN.match(name))
+        return [os.path.join(self.directory, name) for name in names]
+
+    def _segment_for(self, size):
+        """Return the path of the segment where an entry of the size should be appended."""
+        segments = self.segments()
+        if not segments:
+            return os.path.join(self.directory, SEGMENT_NAME.format(1))
+
+        last = segments[-1]
+        current_size = os.path.getsize(last)
+        if current_size == 0 or current_size + size <= self.segment_size:
+            return last
+
+        number = int(SEGMENT_PATTERN.match(os.path.basename(last)).group(1))
+        return os.path.join(self.directory, SEGMENT_NAME.format(number + 1))
+
+    def append(self, records):
+        """
+        Append the batch of records as a new entry, synced to the disk when the fsync option is enabled.
+
+        Args:
+            records (list): CallRecord objects already validated.
+
+        Returns:
+            (str): Token of the batch, used to abort its records.
+
+        Raises:
+            WriteError: The entry could not be written.
+        """
+        token = uuid.uuid4().hex
+        self._write({'batch': token, 'records': [encode_record(record) for record in records]})
+        return token
+
+    def abort(self, token, indexes=None):
+        """
+        Append the entry that marks records of a batch as not saved, so they are not replayed.
+
+        Args:
+            token (str): Token of the batch.
+            indexes (list): Positions of the records not saved on the batch, all of them when not given.
+
+        Raises:
+            WriteError: The entry could not be written.
+        """
+        self._write({'abort': token, 'records': None if indexes is None else list(indexes)})
+
+    def _write(self, value):
+        """Append the value as a new entry, encoded as json."""
+        payload = json.dumps(value, separators=(',', ':')).encode('utf8')
+        entry = ENTRY_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        try:
+            with self._lock, open(os.path.join(self.directory, LOCK_NAME), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                fd = os.open(self._segment_for(len(entry)), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+                try:
+                    written = 0
+                    while written < len(entry):
+                        written += os.write(fd, entry[written:])
+                    if self.fsync:
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+        except OSError as error:
+            raise WriteError('The journal could not be written: {}'.format(error)) from error
+
+    def read(self, on_corrupted=None):
+        """
+        Generate the batches of records of the journal, in the order they were appended, without the aborted ones.
+
+        The journal is read twice, the first time to find the aborted records.
+
+        Args:
+            on_corrupted (callable): Function called with the path and the offset of each corrupted entry.
+
+        Yields:
+            (list): List with the dicts of the records of the batch.
+        """
+        aborted = {}
+        for entry in self.read_entries():
+            if isinstance(entry, dict) and 'abort' in entry:
+                indexes = entry['records']
+                aborted.setdefault(entry['abort'], set()).update([None] if indexes is None else indexes)
+
+        for entry in self.read_entries(on_corrupted):
+            # the entries written before the batch tokens are only the list of records
+            if isinstance(entry, list):
+                yield entry
+            elif 'batch' in entry:
+                skipped = aborted.get(entry['batch'], ())
+                if None not in skipped:
+                    yield [item for index, item in enumerate(entry['records']) if index not in skipped]
+
+    def read_entries(self, on_corrupted=None):
+        """
+        Generate the entries of the journal, in the order they were appended.
+
+        An entry with an invalid checksum or truncated (e.g. by a crash during the write) ends the reading
+        of its segment, because the position of the next entry can not be trusted.
+
+        Args:
+            on_corrupted (callable): Function called with the path and the offset of each corrupted entry.
+
+        Yields:
+            (dict/list): The batches and the abort entries, decoded.
+        """
+        for path in self.segments():
+            with open(path, 'rb') as segment:
+                offset = 0
+                while True:
+                    header = segment.read(ENTRY_HEADER.size)
+                    if not header:
+                        break
+
+                    payload = b''
+                    if len(header) == ENTRY_HEADER.size:
+                        size, checksum = ENTRY_HEADER.unpack(header)
+                        payload = segment.read(size)
+
+                    if len(header) < ENTRY_HEADER.size or len(payload) < size or zlib.crc32(payload) != checksum:
+                        if on_corrupted:
+                            on_corrupted(path, offset)
+                        break
+
+                    offset += ENTRY_HEADER.size + size
+                    yield json.loads(payload.decode('utf8'))
+
+
+def call_key(record):
+    """Return the call id and the type of the record, the call id as stored on the INTEGER column of the tables."""
+    return get_int_or_none(record.call_identifier) or record.call_identifier, record.record_type
+
+
+def replay_records(db, records):
+    """
+    Write the records that are not on the database yet with the connection, without committing.
+
+    The call ids already saved are selected with one query by type and IN list, and the new records are
+    inserted with one executemany by table (the partition of their month on a partitioned database).
+
+    Args:
+        db (sqlite3.Connection): Connection with the database, or with the shard of the records.
+        records (list): Call records, in the order of the journal.
+
+    Returns:
+        (int): Number of records written.
+    """
+    saved = set()
+    for record_type in constants.RECORD_TYPE_OPTIONS:
+        call_ids = {call_key(record)[0] for record in records if record.record_type == record_type}
+        for chunk in queries.in_list_chunks(call_ids):
+            rows = db.execute(queries.select_call_ids(len(chunk)), [record_type] + chunk)
+            saved.update((row[0], record_type) for row in rows)
+
+    tables = {}
+    for record in records:
+        key = call_key(record)
+        if key in saved:
+            continue
+        saved.add(key)
+
+        table_name = partitions.write_table(db, record.record_timestamp)
+        if not record.record_id and table_name != CallRecord.TABLE_NAME:
+            record.record_id = partitions.next_record_id(db)
+
+        start = record.record_type == constants.RECORD_TYPE_START
+        tables.setdefault(table_name, []).append([
+            record.record_type,
+            record.record_timestamp,
+            record.call_identifier,
+            record.origin_number if start else None,
+            record.destination_number if start else None,
+            normalize_phone_number(record.origin_number) if start else None,
+            normalize_phone_number(record.destination_number) if start else None,
+            record.record_id,
+        ])
+
+    for table_name, values in tables.items():
+        db.executemany(queries.insert(table_name, REPLAY_FIELDS), values)
+
+    return sum(len(values) for values in tables.values())
+
+
+def replay_batch(db, records, sharded):
+    """Write the records of a batch of entries with the connection, or on their shards, without committing."""
+    if not sharded:
+        return replay_records(db, records)
+
+    # the start records are written first, so the end records of the batch find their starts on the routing
+    written = 0
+    for record_type in (constants.RECORD_TYPE_START, constants.RECORD_TYPE_END):
+        by_shard = {}
+        for record in records:
+            if record.record_type == record_type:
+                by_shard.setdefault(record.route(), []).append(record)
+
+        for name, shard_records in by_shard.items():
+            with use_shard(name):
+                written += replay_records(get_db(), shard_records)
+
+    return written
+
+
+def replay(journal, db, batch_size=REPLAY_BATCH_SIZE, on_corrupted=None):
+    """
+    Rebuild the phone_call table from scratch with the records of the journal.
+
+    When the sharding is enabled the tables of all the shards are cleared, and each record is written on
+    its shard as it was received by the api. The replay is idempotent: a record with the call id and the
+    type of a record already replayed (e.g. journaled twice by the retries of a client) is skipped, as the
+    api refuses it. The records are written by batch of entries, one transaction by batch (and by shard),
+    with a bulk check of the call ids and one executemany by table. The pairs are rebuilt once at the end,
+    and the end records written before their starts on other shards are moved to the shards of the starts.
+
+    Args:
+        journal (Journal): Journal with the records.
+        db (sqlite3.Connection): Connection with the database.
+        batch_size (int): Number of entries written by transaction.
+        on_corrupted (callable): Function called with the path and the offset of each corrupted entry.
+
+    Returns:
+        (tuple): Number of entries and number of records replayed.
+    """
+    def clear(connection):
+        partitions.clear_calls(connection)
+        pairs.clear_pairs(connection)
+
+    def finish(connection):
+        pairs.rebuild_pairs(connection)
+        connection.commit()
+
+    def commit():
+        if sharded:
+            shards.scatter(lambda connection: connection.commit())
+        else:
+            db.commit()
+
+    ring = shards.get_ring()
+    sharded = ring is not None
+    if sharded:
+        shards.scatter(lambda connection: run_with_retry(clear, connection))
+    else:
+        clear(db)
+
+    # the ids of the cached rows are given again to other records
+    process_cache = cache.get_process_cache()
+    if process_cache is not None:
+        process_cache.discard()
+    identity_map = cache.get_identity_map()
+    if identity_map is not None:
+        identity_map.clear()
+
+    entries = records = 0
+    batch = []
+    for items in journal.read(on_corrupted):
+        batch.extend(CallRecord.from_row(item) for item in items)
+        entries += 1
+        if entries % batch_size == 0:
+            records += replay_batch(db, batch, sharded)
+            commit()
+            batch = []
+
+    records += replay_batch(db, batch, sharded)
+    commit()
+
+    if sharded:
+        shards.scatter(finish)
+        for name in ring.names:
+            shards.rebalance_pending(name, ring)
+    else:
+        finish(db)
+
+    return entries, records
+
+
+def get_journal(app):
+    """Return a journal with the directory and the options of the app config."""
+    config = app.config
+    return Journal(
+        config['JOURNAL_DIRECTORY'] or os.path.join(app.instance_path, 'journal'),
+        config['JOURNAL_SEGMENT_SIZE'],
+        config['JOURNAL_FSYNC'],
+    )
+
+
+@click.command('replay-journal')
+@with_appcontext
+def replay_journal_command():
+    """Rebuild the phone_call table from the journal."""
+    def on_corrupted(path, offset):
+        click.echo('Corrupted entry on {} at offset {}, skipping the rest of the segment.'.format(path, offset))
+
+    entries, records = replay(get_journal(current_app), get_db(), on_corrupted=on_corrupted)
+    click.echo('Replayed {} records from {} entries.'.format(records, entries))
+
+
+def init_app(app):
+    """Create the journal when it is enabled by the JOURNAL config, and add the replay command."""
+    app.extensions['journal'] = get_journal(app) if app.config['JOURNAL'] else None
+    app.cli.add_command(replay_journal_command)
@@ -0,0 +1,432 @@
+"""Metrics of the api, exposed on the text format of Prometheus by the /metrics endpoint.
+
+The metrics are recorded on a registry of the process, with a lock by metric, so recording a value costs a few
+microseconds. When METRICS_DIRECTORY is set, each process (e.g. each gunicorn worker) writes a snapshot of
+its registry on that directory every METRICS_FLUSH_INTERVAL seconds, and the /metrics endpoint adds the
+snapshots of all the processes, so any worker returns the metrics of all of them. The metrics are disabled by
+default: when enabled each database statement is timed, and the /metrics endpoint has no authentication, so it
+should only be reachable by the scraper.
+"""
+import atexit
+import bisect
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, g, has_app_context, request
+
+from api import constants
+
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+REQUESTS = 'phone_bills_http_requests_total'
+REQUEST_SECONDS = 'phone_bills_http_request_duration_seconds'
+RECORDS_INGESTED = 'phone_bills_records_ingested_total'
+RECORDS_REJECTED = 'phone_bills_records_rejected_total'
+BILL_CALLS = 'phone_bills_bill_calls'
+RATING_SECONDS = 'phone_bills_rating_duration_seconds'
+QUERY_SECONDS = 'phone_bills_db_query_duration_seconds'
+SLOW_REQUESTS = 'phone_bills_slow_requests_total'
+CACHE_HITS = 'phone_bills_cache_hits_total'
+CACHE_MISSES = 'phone_bills_cache_misses_total'
+CACHE_HIT_RATIO = 'phone_bills_cache_hit_ratio'
+
+# types of the validation errors of the records, with the pattern of their messages and the field of the error
+# (None when the field is the first value of the message)
+VALIDATION_ERRORS = (
+    ('mandatory_field', constants.MESSAGE_MANDATORY_FIELD, None),
+    ('invalid_field', constants.MESSAGE_INVALID_FIELD, None),
+    ('duplicated_call_id', constants.MESSAGE_DUPLICATED_CALL_ID, 'call_identifier'),
+)
+VALIDATION_PATTERNS = [
+    (error, re.compile('^{}$'.format(re.escape(message).replace(re.escape('{}'), '(.*?)'))), field)
+    for error, message, field in VALIDATION_ERRORS
+]
+
+# process caches whose counters are exposed, by the name of the extension
+CACHES = (
+    ('model', 'model_cache'),
+    ('compression', 'compression_cache'),
+)
+
+
+class Counter:
+    """Counter with a value by each combination of the values of the labels."""
+
+    type = COUNTER
+
+    def __init__(self, name, documentation, labels=()):
+        """Constructor used to create the counter without values."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        """Increment the value of the labels."""
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        """Return the values of the labels, as lists that can be saved as json."""
+        with self._lock:
+            return [[list(labels), value] for labels, value in self.values.items()]
+
+
+class Histogram:
+    """Histogram with the counts by bucket, the sum and the count of the observed values of each labels."""
+
+    type = HISTOGRAM
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        """Constructor used to create the histogram without values."""
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        """Add the value to the bucket of the smallest bound bigger or equal to it."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # the counts of the buckets, with the +Inf one, followed by the sum
+                entry = self.values[labels] = [0] * (len(self.buckets) + 1) + [0]
+            entry[index] += 1
+            entry[-1] += value
+
+    def samples(self):
+        """Return the counts and the sum of the labels, as lists that can be saved as json."""
+        with self._lock:
+            return [[list(labels), list(entry)] for labels, entry in self.values.items()]
+
+
+class Registry:
+    """Metrics of the process, with the functions that collect the values kept by other objects."""
+
+    def __init__(self, directory=None, flush_interval=5):
+        """Constructor used to create the registry, writing the snapshots on the directory when it is given."""
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = OrderedDict()
+        self.collectors = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labels=()):
+        """Create the counter on the registry."""
+        self.metrics[name] = Counter(name, documentation, labels)
+        return self.metrics[name]
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        """Create the histogram on the registry."""
+        self.metrics[name] = Histogram(name, documentation, labels, buckets)
+        return self.metrics[name]
+
+    def snapshot(self):
+        """
+        Return the values of the metrics of the process, with the values of the collectors.
+
+        Returns:
+            (dict): Definition and samples of each metric by name, that can be saved as json.
+        """
+        snapshot = OrderedDict()
+        for metric in self.metrics.values():
+            snapshot[metric.name] = {
+                'type': metric.type,
+                'help': metric.documentation,
+                'labels': list(metric.labels),
+                'buckets': list(getattr(metric, 'buckets', [])),
+                'samples': metric.samples(),
+            }
+
+        for collector in self.collectors:
+            for name, definition in collector().items():
+                snapshot[name] = definition
+
+        return snapshot
+
+    def path(self, pid=None):
+        """Return the path of the snapshot file of the process."""
+        return os.path.join(self.directory, '{}.json'.format(pid or os.getpid()))
+
+    def write(self):
+        """Write the snapshot of the process on its file, replacing the previous one atomically."""
+        path = self.path()
+        temporary = '{}.tmp'.format(path)
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, path)
+
+    def start(self):
+        """Start the thread that writes the snapshots of the current process, once by process."""
+        if self.directory is None or self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            os.makedirs(self.directory, exist_ok=True)
+            thread = threading.Thread(target=self._writer, name='metrics-writer', daemon=True)
+            thread.start()
+            atexit.register(self.write)
+
+    def _writer(self):
+        """Write the snapshot of the process on each interval."""
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def collect(self):
+        """
+        Return the values of the metrics of all the processes.
+
+        The snapshot of the current process is written before the files of the directory are read, so its values
+        are always the current ones.
+
+        Returns:
+            (dict): Definition and samples of each metric by name, added by labels.
+        """
+        if self.directory is None:
+            return self.snapshot()
+
+        self.start()
+        self.write()
+        snapshots = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # a file being replaced or truncated, its values are read on the next collect
+                continue
+
+        return merge_snapshots(snapshots)
+
+
+def merge_snapshots(snapshots):
+    """Add the samples with the same labels of the snapshots of the processes."""
+    merged = OrderedDict()
+    for snapshot in snapshots:
+        for name, definition in snapshot.items():
+            if name not in merged:
+                merged[name] = dict(definition, samples=OrderedDict())
+            samples = merged[name]['samples']
+            for labels, value in definition['samples']:
+                key = tuple(labels)
+                if key not in samples:
+                    samples[key] = value
+                elif isinstance(value, list):
+                    samples[key] = [current + other for current, other in zip(samples[key], value)]
+                else:
+                    samples[key] += value
+
+    for definition in merged.values():
+        definition['samples'] = [[list(labels), value] for labels, value in definition['samples'].items()]
+
+    return merged
+
+
+def add_hit_ratios(snapshot):
+    """Add the hit ratio of the caches, computed from the hits and the misses of all the processes."""
+    hits = {tuple(labels): value for labels, value in snapshot.get(CACHE_HITS, {}).get('samples', [])}
+    misses = {tuple(labels): value for labels, value in snapshot.get(CACHE_MISSES, {}).get('samples', [])}
+    snapshot[CACHE_HIT_RATIO] = {
+        'type': GAUGE,
+        'help': 'Ratio of the lookups of the process caches found on the cache.',
+        'labels': ['cache'],
+        'buckets': [],
+        'samples': [
+            [list(labels), value / (value + misses.get(labels, 0)) if value + misses.get(labels, 0) else 0]
+            for labels, value in hits.items()
+        ],
+    }
+
+    return snapshot
+
+
+def escape_label(value):
+    """Escape the value of a label of the text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    """Return the labels of a sample on the text format."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(name, escape_label(value)) for name, value in pairs) + '}'
+
+
+def format_value(value):
+    """Return the number on the text format."""
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+
+    return repr(value)
+
+
+def expose(snapshot):
+    """
+    Return the metrics on the text format of Prometheus.
+
+    Args:
+        snapshot (dict): Definition and samples of each metric by name.
+
+    Returns:
+        (str): Metrics on the text format.
+    """
+    lines = []
+    for name, definition in snapshot.items():
+        lines.append('# HELP {} {}'.format(name, definition['help']))
+        lines.append('# TYPE {} {}'.format(name, definition['type']))
+        names = definition['labels']
+        for labels, value in sorted(definition['samples']):
+            if definition['type'] != HISTOGRAM:
+                lines.append('{}{} {}'.format(name, format_labels(names, labels), format_value(value)))
+                continue
+
+            cumulative = 0
+            bounds = [format_value(bound) for bound in definition['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, value):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(name, format_labels(names, labels, [('le', bound)]), cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(names, labels), format_value(value[-1])))
+            lines.append('{}_count{} {}'.format(name, format_labels(names, labels), cumulative))
+
+    return '\n'.join(lines) + '\n'
+
+
+def get_registry():
+    """Return the registry of the app, or None when the metrics are disabled or there is no app context."""
+    if not has_app_context():
+        return None
+
+    return current_app.extensions.get('metrics')
+
+
+def inc(name, amount=1, labels=()):
+    """Increment the counter of the app, if the metrics are enabled."""
+    registry = get_registry()
+    if registry is not None:
+        registry.metrics[name].inc(amount, labels)
+
+
+def observe(name, value, labels=()):
+    """Observe the value on the histogram of the app, if the metrics are enabled."""
+    registry = get_registry()
+    if registry is not None:
+        registry.metrics[name].observe(value, labels)
+
+
+def error_labels(message):
+    """Return the type and the field of the validation error message."""
+    for error, pattern, field in VALIDATION_PATTERNS:
+        match = pattern.match(message)
+        if match:
+            return error, field or match.group(1)
+
+    return 'other', ''
+
+
+def count_rejected(errors):
+    """Count the validation errors of a refused record, by their type."""
+    registry = get_registry()
+    if registry is not None:
+        for message in errors:
+            registry.metrics[RECORDS_REJECTED].inc(1, error_labels(message))
+
+
+def start_request():
+    """Save the start time of the request, used by its latency."""
+    g.metrics_start = time.perf_counter()
+
+
+def save_status(response):
+    """Save the status of the response, that is not known by the teardown of the request."""
+    g.metrics_status = response.status_code
+    return response
+
+
+def finish_request(exception=None):
+    """Record the latency and the status of the request, by its route. The failed requests are 500."""
+    registry = get_registry()
+    if registry is None or 'metrics_start' not in g:
+        return
+
+    route = request.url_rule.rule if request.url_rule is not None else ''
+    status = g.get('metrics_status', 500)
+    registry.metrics[REQUEST_SECONDS].observe(time.perf_counter() - g.pop('metrics_start'), (route, request.method))
+    registry.metrics[REQUESTS].inc(1, (route, request.method, str(status)))
+    registry.start()
+
+
+def cache_collector(app):
+    """Return the collector of the hits and the misses of the process caches of the app."""
+    def collect():
+        hits = []
+        misses = []
+        for name, extension in CACHES:
+            process_cache = app.extensions.get(extension)
+            if process_cache is not None:
+                stats = process_cache.stats()
+                hits.append([[name], stats['hits']])
+                misses.append([[name], stats['misses']])
+
+        return OrderedDict((
+            (CACHE_HITS, {
+                'type': COUNTER, 'help': 'Lookups found on the process caches.',
+                'labels': ['cache'], 'buckets': [], 'samples': hits,
+            }),
+            (CACHE_MISSES, {
+                'type': COUNTER, 'help': 'Lookups not found on the process caches.',
+                'labels': ['cache'], 'buckets': [], 'samples': misses,
+            }),
+        ))
+
+    return collect
+
+
+def create_registry(app):
+    """Create the registry with the metrics of the api."""
+    directory = app.config.get('METRICS_DIRECTORY')
+    registry = Registry(directory, app.config['METRICS_FLUSH_INTERVAL'])
+    registry.counter(REQUESTS, 'Requests answered, by route, method and status.', ('route', 'method', 'status'))
+    registry.histogram(REQUEST_SECONDS, 'Latency of the requests, by route and method.', ('route', 'method'))
+    registry.counter(RECORDS_INGESTED, 'Call records accepted by the phone_call endpoint.')
+    registry.counter(RECORDS_REJECTED, 'Call records refused, by the type of each error.', ('error', 'field'))
+    registry.histogram(BILL_CALLS, 'Calls rated by each phone bill.', buckets=SIZE_BUCKETS)
+    registry.histogram(RATING_SECONDS, 'Time to calculate each phone bill.')
+    registry.counter(SLOW_REQUESTS, 'Requests over the SLOW_REQUEST_THRESHOLD, by route and method.',
+                     ('route', 'method'))
+    registry.histogram(QUERY_SECONDS, 'Latency of the database statements, by operation.', ('operation',),
+                       buckets=QUERY_BUCKETS)
+    registry.collectors.append(cache_collector(app))
+
+    return registry
+
+
+def init_app(app):
+    """Create the registry of the app when it is enabled by the METRICS config."""
+    app.extensions['metrics'] = create_registry(app) if app.config.get('METRICS') else None
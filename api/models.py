@@ -1,14 +1,28 @@
 """Models of data used in the api."""
+import itertools
+import time
 from datetime import datetime, timedelta
 
-from api import constants
-from api.db import get_db
-from api.utils import get_date_or_none, get_int_or_none, is_valid_phone_number
+from api import archive, cache, constants, metrics, pairs, partitions, queries, shards, slowlog, tracing
+from api.db import FETCH_SIZE, fetch_chunks, get_db, use_shard
+from api.records import CallBatch
+from api.writer import run_write
+from api.utils import get_date_or_none, get_int_or_none, is_valid_phone_number, normalize_phone_number
+
+
+STANDARD_INITIAL_TIME = tuple(int(value) for value in constants.STANDARD_INITIAL_TIME.split(':'))
+STANDARD_FINAL_TIME = tuple(int(value) for value in constants.STANDARD_FINAL_TIME.split(':'))
+REDUCED_FINAL_TIME = tuple(int(value) for value in constants.REDUCED_FINAL_TIME.split(':'))
 
 
 class CallRecord:
     """Model to store phone call records."""
 
+    __slots__ = (
+        'record_id', 'record_type', 'record_timestamp', 'call_identifier', 'origin_number', 'destination_number',
+        'shard',
+    )
+
     TABLE_NAME = 'phone_call'
 
     def __init__(
@@ -16,12 +30,13 @@ class CallRecord:
     ):
         """Constructor used to populate the data of the object."""
         if record_id:
-            existent = get_by_id(
-                self.TABLE_NAME,
-                'record_id',
-                record_id,
-                ['record_type', 'record_timestamp', 'call_identifier', 'origin_number', 'destination_number']
-            )
+            with use_shard(shards.record_shard(record_type, call_identifier, origin_number)):
+                existent = get_by_id(
+                    self.TABLE_NAME,
+                    'record_id',
+                    record_id,
+                    ['record_type', 'record_timestamp', 'call_identifier', 'origin_number', 'destination_number']
+                )
             if existent:
                 self.record_id = record_id
                 self.record_type = existent.get('record_type')
@@ -38,6 +53,27 @@ class CallRecord:
         self.origin_number = origin_number
         self.destination_number = destination_number
 
+    @classmethod
+    def from_row(cls, row):
+        """
+        Create the object with the values of a row, without querying the database.
+
+        Args:
+            row (dict/sqlite3.Row): Row with the fields of the phone_call table.
+
+        Returns:
+            (CallRecord): Object populated with the values of the row.
+        """
+        obj = cls.__new__(cls)
+        obj.record_id = row['record_id']
+        obj.record_type = row['record_type']
+        obj.record_timestamp = get_date_or_none(row['record_timestamp'])
+        obj.call_identifier = row['call_identifier']
+        obj.origin_number = row['origin_number']
+        obj.destination_number = row['destination_number']
+
+        return obj
+
     def validate(self):
         """
         Validate if the mandatory fields are present and are valid.
@@ -74,57 +110,102 @@ class CallRecord:
 
         return error_messages
 
-    def exists_call_id(self):
-        """Check if already exists a record with the call_id and record_type."""
+    def exists_call_id(self, db=None):
+        """
+        Check if already exists a record with the call_id and record_type.
+
+        Args:
+            db (sqlite3.Connection): Connection used to check, e.g. the one writing the records not committed yet.
+                The connection of the shard of the record when not given.
+        """
         if not self.call_identifier or not self.record_type:
             return False
 
-        sql_command = 'SELECT 1 FROM {} WHERE call_identifier = {} AND record_type = ?'.format(
-            self.TABLE_NAME, self.call_identifier
-        )
-        if self.record_id:
-            sql_command += ' AND record_id <> {}'.format(self.record_id)
-        cursor = get_db().cursor()
-        result = cursor.execute(sql_command, [self.record_type])
+        if db is None:
+            with use_shard(self.route()):
+                return self.exists_call_id(get_db())
 
+        cursor = db.cursor()
+        result = cursor.execute(queries.EXISTS_CALL_ID, [self.call_identifier, self.record_type, self.record_id])
         return result.fetchone() is not None
 
+    def route(self):
+        """
+        Return the shard of the record, or None when the sharding is disabled.
+
+        The shard is resolved once by record, because the shard of an end record is found by looking for its
+        start record on all the shards. An end record routed to its pending shard is moved by save when its
+        start record is found after it was saved.
+        """
+        shard = getattr(self, 'shard', cache.MISSING)
+        if shard is cache.MISSING:
+            shard = self.shard = shards.record_shard(self.record_type, self.call_identifier, self.origin_number)
+
+        return shard
+
     def save(self):
-        """Save the Call Record data on the database."""
-        db = get_db()
+        """
+        Save the Call Record data on the database.
+
+        When the sharding is enabled the record is saved on its shard, and the end record received before
+        a start record is moved to the shard of the start. Both look for the other record after committing,
+        so an end record saved on its pending shard while its start record was being saved is still moved.
+        """
+        shard = self.route()
+        with use_shard(shard):
+            result = run_write(self.write, get_db)
+            cache.invalidate(self.TABLE_NAME, 'record_id', self.record_id)
+
+        if shard and self.record_type == constants.RECORD_TYPE_START:
+            shards.claim_pending_end(self.call_identifier, shard)
+        elif shard and self.record_type == constants.RECORD_TYPE_END:
+            self.shard = shards.settle_pending_end(self.call_identifier, shard)
+
+        return result
+
+    def write(self, db):
+        """
+        Write the Call Record data with the connection, without committing.
+
+        On a partitioned database the record is written on the partition of its month, and the new
+        records receive their ids from the sequence shared by the partitions. An updated record whose month
+        changed is moved to the partition of its new month. The pending pairs are updated in the same
+        transaction.
+        """
         cursor = db.cursor()
+        table_name = partitions.write_table(db, self.record_timestamp)
 
         exists_id = check_exists_id(cursor, self.TABLE_NAME, 'record_id', self.record_id)
+        if exists_id and table_name != self.TABLE_NAME:
+            current_table = partitions.record_table(db, self.record_id)
+            if current_table != table_name:
+                cursor.execute(queries.delete_by_id(current_table, 'record_id'), [self.record_id])
+                exists_id = False
+        if not exists_id and not self.record_id and table_name != self.TABLE_NAME:
+            self.record_id = partitions.next_record_id(db)
+
+        fields = ('record_type', 'record_timestamp', 'call_identifier')
+        if self.record_type == constants.RECORD_TYPE_START:
+            fields += ('origin_number', 'destination_number', 'origin_key', 'destination_key')
 
         if exists_id:
-            update = 'record_type = ?, record_timestamp = ?, call_identifier = ?'
-            if self.record_type == constants.RECORD_TYPE_START:
-                update += ', origin_number = ?, destination_number = ?'
-
-            sql_command = 'UPDATE {} SET {} WHERE record_id = ?'.format(self.TABLE_NAME, update)
+            sql_command = queries.update(table_name, fields, 'record_id')
+        elif self.record_id:
+            sql_command = queries.insert(table_name, fields + ('record_id',))
         else:
-            fields = ['record_type', 'record_timestamp', 'call_identifier']
-            if self.record_type == constants.RECORD_TYPE_START:
-                fields.append('origin_number')
-                fields.append('destination_number')
-            if self.record_id:
-                fields.append('record_id')
-
-            sql_command = 'INSERT INTO {} ({}) VALUES ({})'.format(
-                self.TABLE_NAME,
-                ', '.join(fields),
-                ', '.join(['?'] * len(fields))
-            )
+            sql_command = queries.insert(table_name, fields)
 
         values = [self.record_type, self.record_timestamp, self.call_identifier]
         if self.record_type == constants.RECORD_TYPE_START:
             values.append(self.origin_number)
             values.append(self.destination_number)
+            values.append(normalize_phone_number(self.origin_number))
+            values.append(normalize_phone_number(self.destination_number))
         if self.record_id:
             values.append(self.record_id)
 
         res = cursor.execute(sql_command, values)
-        db.commit()
+        pairs.track_record(db, self.call_identifier, self.record_type, self.record_timestamp)
 
         return res.rowcount > 0
 
@@ -148,6 +229,13 @@ class PhoneBill:
 
         self.total = 0
         self.id = bill_id
+        self.archived = False
+        self._boundary_start_records = None
+
+    @property
+    def phone_key(self):
+        """Return the normalized key of the phone number used on the database lookups."""
+        return normalize_phone_number(self.phone_number)
 
     def to_dict(self):
         """Format the object in a json document."""
@@ -169,6 +257,7 @@ class PhoneBill:
 
         return '{:02}/{:0004}'.format(first_day.month, first_day.year)
 
+    @tracing.traced('bill.validate')
     def validate(self):
         """
         Validate if the mandatory fields are present and are valid.
@@ -213,6 +302,11 @@ class PhoneBill:
 
         return True
 
+    def period_month_year(self):
+        """Return the month and the year of the period as integers."""
+        splitted = self.period.split('/')
+        return get_int_or_none(splitted[0]), get_int_or_none(splitted[1])
+
     def is_closed_period(self, value, base_date):
         """Check if the period is a closed month lower than today."""
         if not self.is_valid_period(value):
@@ -229,185 +323,378 @@ class PhoneBill:
 
     def exists_period(self):
         """Check if already exists a record with the period."""
-        if not self.period or not self.phone_number:
+        if not self.period or not self.phone_key:
             return False
 
-        sql_command = 'SELECT id FROM {} WHERE period = ? AND phone_number = ?'.format(self.TABLE_NAME)
-        cursor = get_db().cursor()
-        result = cursor.execute(sql_command, [self.period, self.phone_number]).fetchone()
+        cursor = get_db(readonly=True).cursor()
+        result = cursor.execute(queries.SELECT_PERIOD_BILL, [self.period, self.phone_key]).fetchone()
 
         return result['id'] if result else None
 
     def get_phone_end_records(self):
-        """Return the existent list of record calls. If it is empty, will calculate."""
-        splitted = self.period.split('/')
-        month = '{:02}'.format(get_int_or_none(splitted[0]))
-        year = '{:0004}'.format(get_int_or_none(splitted[1]))
-
-        sql_command = (
-            'SELECT'
-            ' record_id, record_type, record_timestamp, call_identifier, origin_number, destination_number'
-            ' FROM {} WHERE'
-            ' record_type = ? AND'
-            ' strftime(?, record_timestamp) = ? AND'
-            ' strftime(?, record_timestamp) = ?'
-        ).format(CallRecord.TABLE_NAME)
-
-        cursor = get_db().cursor()
-        result = cursor.execute(sql_command, ['end', '%m', month, '%Y', year])
-
-        end_record_calls = []
-        for record in result.fetchall():
-            end_record_calls.append(CallRecord(
-                record[0],
-                record[1],
-                record[2],
-                record[3],
-                record[4],
-                record[5]
-            ))
+        """
+        Retrieve from the database the end records of the period.
+
+        Yields:
+            (CallBatch): Chunk of end records read from the database.
+        """
+        month, year = self.period_month_year()
+
+        db = get_db(readonly=True)
+        for table_name in partitions.end_tables(db, year, month):
+            result = db.cursor().execute(
+                queries.select_end_records(table_name), ['end', '%m', '{:02}'.format(month), '%Y', '{:04}'.format(year)]
+            )
 
-        return end_record_calls
+            for rows in fetch_chunks(result):
+                yield CallBatch.from_rows(constants.RECORD_TYPE_END, rows)
 
     def get_phone_start_records(self, calls_ids):
-        """Retrieve from the database the start records of the calls_ids."""
+        """
+        Retrieve from the database the start records of the calls_ids as a CallBatch.
+
+        Small lists of ids are bound on IN lists, the big ones are inserted on a temporary table of the
+        connection that is joined with the phone_call table. On a partitioned database only the partition
+        of the period is searched, and the calls started on the month before are read by the index of the
+        call pairs.
+        """
+        start_records = CallBatch(constants.RECORD_TYPE_START)
         if not calls_ids:
-            return []
-
-        sql_command = (
-            'SELECT record_id, record_type, record_timestamp, call_identifier, origin_number, destination_number '
-            'FROM {} WHERE'
-            ' record_type = ? AND'
-            ' call_identifier IN ({})'
-        ).format(CallRecord.TABLE_NAME, ', '.join([str(item) for item in calls_ids]))
-
-        cursor = get_db().cursor()
-        result = cursor.execute(sql_command, ['start'])
-
-        start_records = []
-        for record in result.fetchall():
-            start_records.append(CallRecord(
-                record[0],
-                record[1],
-                record[2],
-                record[3],
-                record[4],
-                record[5]
-            ))
+            return start_records
+
+        month, year = self.period_month_year()
+        db = get_db(readonly=True)
+        # without partitions the only table has the start records of all the months
+        table_names = partitions.end_tables(db, year, month)
+        if partitions.is_partitioned(db):
+            start_records.extend(self.get_boundary_start_records(db, calls_ids))
+
+        cursor = db.cursor()
+        if len(calls_ids) > queries.TEMP_TABLE_THRESHOLD:
+            cursor.execute(queries.CREATE_TEMP_CALL_IDS)
+            try:
+                cursor.executemany(queries.INSERT_TEMP_CALL_IDS, ((call_id,) for call_id in calls_ids))
+                for table_name in table_names:
+                    result = cursor.execute(
+                        queries.select_start_records_temp_table(table_name), ['start', self.phone_key]
+                    )
+                    start_records.append_rows(result.fetchall())
+            finally:
+                # the connection is reused by the next requests of the thread, that must find the table empty
+                cursor.execute(queries.CLEAR_TEMP_CALL_IDS)
+            return start_records
+
+        for table_name in table_names:
+            for chunk in queries.in_list_chunks(calls_ids):
+                result = cursor.execute(
+                    queries.select_start_records(len(chunk), table_name), ['start', self.phone_key] + chunk
+                )
+                start_records.append_rows(result)
 
         return start_records
 
+    def get_boundary_start_records(self, db, calls_ids):
+        """
+        Retrieve the start records of the calls_ids started on the month before the period, as a CallBatch.
+
+        The calls of the subscriber that crossed the start of the period are read once by the index of the
+        call_pair table, joined only with the partition of the previous month, and kept for the next chunks.
+        """
+        if self._boundary_start_records is None:
+            month, year = self.period_month_year()
+            previous_year, previous_month = partitions.previous_month(year, month)
+            self._boundary_start_records = CallBatch(constants.RECORD_TYPE_START)
+            table_name = partitions.previous_table(db, year, month)
+            if table_name:
+                result = db.execute(
+                    queries.select_boundary_start_records(table_name),
+                    [self.phone_key, year * 100 + month, previous_year * 100 + previous_month, 'start']
+                )
+                self._boundary_start_records.append_rows(result.fetchall())
+
+        start_records = CallBatch(constants.RECORD_TYPE_START)
+        calls_ids = set(calls_ids)
+        for record in self._boundary_start_records:
+            if record.call_identifier in calls_ids:
+                start_records.append(
+                    record.record_id, record.record_timestamp, record.call_identifier,
+                    record.origin_number, record.destination_number
+                )
+
+        return start_records
+
+    def get_rated_calls(self, calls_ids):
+        """
+        Retrieve from the database the calls of the calls_ids already rated by a bill, in one query by IN list.
+
+        Returns:
+            (dict): PhoneBillCall objects by their call_identifier.
+        """
+        rated_calls = {}
+        cursor = get_db(readonly=True).cursor()
+        for chunk in queries.in_list_chunks(calls_ids):
+            for row in cursor.execute(queries.select_bill_calls(len(chunk)), chunk):
+                rated_calls[row['call_identifier']] = PhoneBillCall.from_row(row)
+
+        return rated_calls
+
     def calculate_phone_bill(self):
-        """Calculate the price of the phone bill."""
+        """Calculate the price of the phone bill, keeping all its calls on record_calls."""
+        with tracing.span('bill.calculate'):
+            for phone_bill_calls in self.iter_rated_chunks():
+                self.record_calls.extend(phone_bill_calls)
+
+    def iter_rated_chunks(self):
+        """
+        Calculate the price of the phone bill chunk by chunk, with the records of the shard of the subscriber.
+
+        The calls are not kept on record_calls, so the caller that saves and encodes each chunk before the next
+        one keeps only one chunk of calls in memory. The total is complete after the last chunk. At least one
+        chunk is generated, empty for the bills without calls, so those bills are also saved.
+
+        Yields:
+            (list): The PhoneBillCall objects of the chunk, with the price calculated.
+        """
+        duration = 0
+        calls = 0
         self.total = 0
-        phone_end_records = self.get_phone_end_records()
-        calls_ids = [c.call_identifier for c in phone_end_records]
-        dict_start_records = {
-            call.call_identifier: call for call in self.get_phone_start_records(calls_ids)
-        }
+        with use_shard(shards.subscriber_shard(self.phone_key)):
+            chunks = self.iter_phone_bill_chunks()
+            while True:
+                # only the rating is timed, not the work done by the caller with each chunk
+                start = time.perf_counter()
+                phone_bill_calls = next(chunks, None)
+                duration += time.perf_counter() - start
+                if phone_bill_calls is None:
+                    break
+                # the end records of the period are of all the subscribers, most chunks may have no call of the bill
+                if not phone_bill_calls:
+                    continue
+
+                calls += len(phone_bill_calls)
+                for phone_bill_call in phone_bill_calls:
+                    self.total += phone_bill_call.price
+                yield phone_bill_calls
+
+            self.total = round(self.total, 2)
+            if not calls:
+                yield []
+
+        metrics.observe(metrics.RATING_SECONDS, duration)
+        metrics.observe(metrics.BILL_CALLS, calls)
+        slowlog.note(calls=calls)
+
+    def iter_phone_bill_chunks(self):
+        """
+        Generate the priced calls of the phone bill, by chunk.
+
+        The end records are read in chunks, and the start records of each chunk are retrieved and paired
+        before reading the next one, so only one chunk of records is kept in memory while pricing.
+
+        Yields:
+            (list): The PhoneBillCall objects of the chunk, with the price calculated.
+        """
+        period_archive = archive.open_period(self.period)
+        if period_archive is not None:
+            self.archived = True
+            archived_calls = self.iter_archived_calls(period_archive)
+            while True:
+                phone_bill_calls = list(itertools.islice(archived_calls, FETCH_SIZE))
+                if not phone_bill_calls:
+                    return
+                yield phone_bill_calls
+
+        # each stage of a chunk is finished before the calls are yielded, so each one is traced as a span
+        end_chunks = iter(self.get_phone_end_records())
+        while True:
+            with tracing.span('bill.end_records') as span:
+                phone_end_records = next(end_chunks, None)
+                if span is not None:
+                    span.attributes['records'] = len(phone_end_records) if phone_end_records else 0
+            if phone_end_records is None:
+                return
+
+            calls_ids = [c.call_identifier for c in phone_end_records]
+            with tracing.span('bill.start_records', calls=len(calls_ids)):
+                dict_start_records = {
+                    call.call_identifier: call for call in self.get_phone_start_records(calls_ids)
+                }
+            with tracing.span('bill.rated_calls', calls=len(dict_start_records)):
+                rated_calls = self.get_rated_calls(list(dict_start_records))
+
+            phone_bill_calls = []
+            with tracing.span('bill.pairing', records=len(phone_end_records)):
+                for end_record in phone_end_records:
+                    start_record = dict_start_records.get(end_record.call_identifier)
+                    if not start_record:
+                        continue
+
+                    rated_call = rated_calls.get(end_record.call_identifier)
+                    if rated_call is not None:
+                        phone_bill_calls.append(rated_call)
+                        continue
+
+                    phone_bill_calls.append(PhoneBillCall.from_values(
+                        start_record.destination_number,
+                        start_record.call_identifier,
+                        start_record.record_timestamp,
+                        end_record.record_timestamp
+                    ))
+
+            with tracing.span('bill.rating', calls=len(phone_bill_calls)):
+                phone_bill_calls = [self.price_call(phone_bill_call) for phone_bill_call in phone_bill_calls]
+
+            yield phone_bill_calls
+
+    def iter_archived_calls(self, period_archive):
+        """
+        Generate the calls of the phone bill of an archived period.
 
-        standard_initial_hours = int(constants.STANDARD_INITIAL_TIME.split(':')[0])
-        standard_initial_minutes = int(constants.STANDARD_INITIAL_TIME.split(':')[1])
-        standard_final_hours = int(constants.STANDARD_FINAL_TIME.split(':')[0])
-        standard_final_minutes = int(constants.STANDARD_FINAL_TIME.split(':')[1])
+        The rated calls archived with the bill are returned as they were saved, and the bills that were
+        not saved before the period was archived are rated with the archived records.
 
-        reduced_final_hours = int(constants.REDUCED_FINAL_TIME.split(':')[0])
-        reduced_final_minutes = int(constants.REDUCED_FINAL_TIME.split(':')[1])
+        Args:
+            period_archive (PeriodArchive): Archive of the period.
 
-        for end_record in phone_end_records:
+        Yields:
+            (PhoneBillCall): Call of the bill with the price calculated.
+        """
+        bill_id = self.exists_period()
+        rows = period_archive.bill_calls(bill_id, self.phone_key) if bill_id else []
+        if rows:
+            self.id = bill_id
+            for row in rows:
+                yield PhoneBillCall.from_row(row)
+            return
+
+        dict_start_records = period_archive.start_records(self.phone_key).by_call_identifier()
+        for end_record in period_archive.records(constants.RECORD_TYPE_END):
             start_record = dict_start_records.get(end_record.call_identifier)
             if not start_record:
                 continue
-            phone_bill_call = PhoneBillCall(
+
+            yield self.price_call(PhoneBillCall(
                 start_record.destination_number,
                 start_record.call_identifier,
                 start_record.record_timestamp,
                 end_record.record_timestamp
-            )
-            if phone_bill_call.id:
-                self.total += phone_bill_call.price
-                self.record_calls.append(phone_bill_call)
-                continue
+            ))
 
-            standard_initial_time = phone_bill_call.call_start.replace(
-                hour=standard_initial_hours, minute=standard_initial_minutes
-            )
-            standard_final_time = phone_bill_call.call_start.replace(
-                hour=standard_final_hours, minute=standard_final_minutes
-            )
-            reduced_final_time = phone_bill_call.call_start.replace(
-                hour=reduced_final_hours, minute=reduced_final_minutes
-            )
+    @staticmethod
+    def price_call(phone_bill_call):
+        """Calculate the price of the call, if it was not calculated before, and return it."""
+        if phone_bill_call.id:
+            return phone_bill_call
 
-            if standard_initial_time <= phone_bill_call.call_start <= standard_final_time:
-                phone_bill_call.price = constants.STANDARD_STANDING_CHARGE
-                standard_time = True
-            else:
-                phone_bill_call.price = constants.REDUCED_STANDING_CHARGE
-                standard_time = False
+        standard_initial_hours, standard_initial_minutes = STANDARD_INITIAL_TIME
+        standard_final_hours, standard_final_minutes = STANDARD_FINAL_TIME
+        reduced_final_hours, reduced_final_minutes = REDUCED_FINAL_TIME
 
-            if phone_bill_call.call_start > standard_initial_time:
-                reduced_final_time = reduced_final_time + timedelta(days=1)
+        standard_initial_time = phone_bill_call.call_start.replace(
+            hour=standard_initial_hours, minute=standard_initial_minutes
+        )
+        standard_final_time = phone_bill_call.call_start.replace(
+            hour=standard_final_hours, minute=standard_final_minutes
+        )
+        reduced_final_time = phone_bill_call.call_start.replace(
+            hour=reduced_final_hours, minute=reduced_final_minutes
+        )
+
+        if standard_initial_time <= phone_bill_call.call_start <= standard_final_time:
+            phone_bill_call.price = constants.STANDARD_STANDING_CHARGE
+            standard_time = True
+        else:
+            phone_bill_call.price = constants.REDUCED_STANDING_CHARGE
+            standard_time = False
+
+        if phone_bill_call.call_start > standard_initial_time:
+            reduced_final_time = reduced_final_time + timedelta(days=1)
 
-            aux_date = phone_bill_call.call_start
-            while aux_date < phone_bill_call.call_end:
-                if standard_time:
-                    if phone_bill_call.call_end > standard_final_time:
-                        comparsion_date = standard_final_time
-                    else:
-                        comparsion_date = phone_bill_call.call_end
+        aux_date = phone_bill_call.call_start
+        while aux_date < phone_bill_call.call_end:
+            if standard_time:
+                if phone_bill_call.call_end > standard_final_time:
+                    comparsion_date = standard_final_time
                 else:
-                    if phone_bill_call.call_end > reduced_final_time:
-                        comparsion_date = reduced_final_time
-                    else:
-                        comparsion_date = phone_bill_call.call_end
-                    reduced_final_time = reduced_final_time + timedelta(days=1)
-
-                minutes = (comparsion_date - aux_date).seconds // 60
-                if standard_time:
-                    phone_bill_call.price += minutes * constants.STANDARD_MINUTE_CHARGE
+                    comparsion_date = phone_bill_call.call_end
+            else:
+                if phone_bill_call.call_end > reduced_final_time:
+                    comparsion_date = reduced_final_time
                 else:
-                    phone_bill_call.price += minutes * constants.REDUCED_MINUTE_CHARGE
+                    comparsion_date = phone_bill_call.call_end
+                reduced_final_time = reduced_final_time + timedelta(days=1)
+
+            minutes = (comparsion_date - aux_date).seconds // 60
+            if standard_time:
+                phone_bill_call.price += minutes * constants.STANDARD_MINUTE_CHARGE
+            else:
+                phone_bill_call.price += minutes * constants.REDUCED_MINUTE_CHARGE
 
-                aux_date = comparsion_date
-                standard_time = not standard_time
+            aux_date = comparsion_date
+            standard_time = not standard_time
 
-            phone_bill_call.price = round(phone_bill_call.price, 2)
-            self.total += phone_bill_call.price
-            self.record_calls.append(phone_bill_call)
+        phone_bill_call.price = round(phone_bill_call.price, 2)
 
-        self.total = round(self.total, 2)
+        return phone_bill_call
 
     def save(self):
-        """Save the Phone Bill data on the database."""
-        db = get_db()
-        cursor = db.cursor()
+        """Save the Phone Bill data, and its calls, on the database."""
+        return self.save_calls(self.record_calls)
 
-        existent_period = self.exists_period()
-        result = None
-        if existent_period:
-            self.id = existent_period
-        else:
-            fields = ['phone_number', 'period']
+    @tracing.traced('bill.save')
+    def save_calls(self, record_calls):
+        """
+        Save the Phone Bill data, if it was not saved yet, and the calls on the database, on one transaction.
 
-            sql_command = 'INSERT INTO {} ({}) VALUES ({})'.format(
-                self.TABLE_NAME,
-                ', '.join(fields),
-                ', '.join(['?'] * len(fields))
-            )
-            values = [self.phone_number, self.period]
-            result = cursor.execute(sql_command, values)
+        Used to save the bill chunk by chunk: the first chunk saves the bill (or finds the bill already saved
+        for the period) and the next ones only their calls.
 
-        if result and result.rowcount <= 0:
-            return False
-        elif result:
-            self.id = result.lastrowid
+        Args:
+            record_calls (list): PhoneBillCall objects of the bill.
 
-        for call in self.record_calls:
-            call.bill_id = self.id
-            call.save()
+        Returns:
+            (bool): If the phone bill was written.
+        """
+        # the bills of the archived periods are read only, their calls are not written back on the database
+        if self.archived:
+            return True
+
+        with use_shard(shards.subscriber_shard(self.phone_key)):
+            existent_period = self.id or self.exists_period()
+
+            saved = run_write(lambda db: self.write(db, existent_period, record_calls), get_db)
+            for call in record_calls:
+                cache.invalidate(PhoneBillCall.TABLE_NAME, 'id', call.id)
+                cache.invalidate(PhoneBillCall.TABLE_NAME, 'call_identifier', call.call_identifier)
+
+        return saved
+
+    def write(self, db, bill_id=None, record_calls=None):
+        """
+        Write the Phone Bill data, and its calls, with the connection without committing.
+
+        Args:
+            db (sqlite3.Connection): Connection used to write.
+            bill_id (int): Id of the phone bill already saved for the period. A new one is inserted if not given.
+            record_calls (list): Calls written with the bill, all the record_calls when not given.
 
-        db.commit()
+        Returns:
+            (bool): If the phone bill was written.
+        """
+        cursor = db.cursor()
+
+        if not bill_id:
+            sql_command = queries.insert(self.TABLE_NAME, ('phone_number', 'period', 'phone_key'))
+            values = [self.phone_number, self.period, self.phone_key]
+            result = cursor.execute(sql_command, values)
+            if result.rowcount <= 0:
+                return False
+            bill_id = result.lastrowid
+
+        self.id = bill_id
+        for call in self.record_calls if record_calls is None else record_calls:
+            call.bill_id = self.id
+            call.write(db)
 
         return True
 
@@ -415,6 +702,10 @@ class PhoneBill:
 class PhoneBillCall:
     """Model to store phone bills calls."""
 
+    __slots__ = (
+        'id', 'destination_number', 'bill_id', 'call_identifier', 'call_start', 'call_end', 'duration', 'price'
+    )
+
     TABLE_NAME = 'phone_bill_call'
 
     def __init__(self, destination_number, call_identifier, call_start, call_end, bill_id=None, bill_call_id=None):
@@ -424,7 +715,8 @@ class PhoneBillCall:
                 self.TABLE_NAME,
                 'call_identifier',
                 call_identifier,
-                ['id', 'destination_number', 'call_start', 'call_end', 'duration', 'price']
+                ['id', 'destination_number', 'call_start', 'call_end', 'duration', 'price'],
+                readonly=True
             )
             if existent:
                 self.call_identifier = call_identifier
@@ -437,16 +729,54 @@ class PhoneBillCall:
                 self.price = existent.get('price')
                 return
 
+        self.set_values(destination_number, call_identifier, call_start, call_end, bill_id, bill_call_id)
+
+    @classmethod
+    def from_values(cls, destination_number, call_identifier, call_start, call_end):
+        """
+        Create a call not rated yet, without looking up the rated call of the call_identifier on the database.
+
+        Used by the bills, that read the rated calls of each chunk with one query.
+
+        Returns:
+            (PhoneBillCall): Object populated with the values.
+        """
+        obj = cls.__new__(cls)
+        obj.set_values(destination_number, call_identifier, call_start, call_end)
+
+        return obj
+
+    def set_values(self, destination_number, call_identifier, call_start, call_end, bill_id=None, bill_call_id=None):
+        """Populate the object with the values, calculating the duration of the call."""
         self.destination_number = destination_number
         self.call_identifier = call_identifier
         self.call_start = get_date_or_none(call_start)
         self.call_end = get_date_or_none(call_end)
         if self.call_start and self.call_end:
             self.duration = str(self.call_end - self.call_start)
+        else:
+            self.duration = None
         self.bill_id = bill_id
         self.price = None
         self.id = bill_call_id
 
+    @classmethod
+    def from_row(cls, row):
+        """
+        Create the object with the values of a row of the table, without querying the database.
+
+        Args:
+            row (dict/sqlite3.Row): Row of the phone_bill_call table.
+
+        Returns:
+            (PhoneBillCall): Object populated with the values of the row.
+        """
+        obj = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(obj, name, row[name])
+
+        return obj
+
     def to_dict(self):
         """Format the object in a json document."""
         return {
@@ -483,32 +813,27 @@ class PhoneBillCall:
         return error_messages
 
     def save(self):
-        """Save the Call Record data on the database."""
-        db = get_db()
+        """Save the Phone Bill Call data on the database."""
+        result = run_write(self.write, get_db)
+        cache.invalidate(self.TABLE_NAME, 'id', self.id)
+        cache.invalidate(self.TABLE_NAME, 'call_identifier', self.call_identifier)
+
+        return result
+
+    def write(self, db):
+        """Write the Phone Bill Call data with the connection, without committing."""
         cursor = db.cursor()
 
         exists_id = check_exists_id(cursor, self.TABLE_NAME, 'id', self.id)
 
-        if exists_id:
-            update = (
-                'destination_number = ?, call_start = ?, call_end = ?, duration = ?,'
-                ' price = ?, call_identifier = ?, bill_id = ?'
-            )
+        fields = ('destination_number', 'call_start', 'call_end', 'duration', 'price', 'call_identifier', 'bill_id')
 
-            sql_command = 'UPDATE {} SET {} WHERE id = ?'.format(self.TABLE_NAME, update)
+        if exists_id:
+            sql_command = queries.update(self.TABLE_NAME, fields, 'id')
+        elif self.id:
+            sql_command = queries.insert(self.TABLE_NAME, fields + ('id',))
         else:
-            fields = [
-                'destination_number', 'call_start', 'call_end', 'duration',
-                'price', 'call_identifier', 'bill_id'
-            ]
-            if self.id:
-                fields.append('id')
-
-            sql_command = 'INSERT INTO {} ({}) VALUES ({})'.format(
-                self.TABLE_NAME,
-                ', '.join(fields),
-                ', '.join(['?'] * len(fields))
-            )
+            sql_command = queries.insert(self.TABLE_NAME, fields)
 
         values = [
             self.destination_number, self.call_start, self.call_end, self.duration,
@@ -517,7 +842,6 @@ class PhoneBillCall:
             values.append(self.id)
 
         res = cursor.execute(sql_command, values)
-        db.commit()
 
         return res.rowcount > 0
 
@@ -539,39 +863,50 @@ def check_exists_id(cursor, table_name, id_field, id_value):
     if not id_value:
         return False
 
-    sql_command = 'SELECT 1 FROM {} WHERE {} = {}'.format(table_name, id_field, id_value)
-    result = cursor.execute(sql_command)
+    cached = cache.lookup(table_name, id_field, id_value)
+    if cached is not cache.MISSING:
+        return cached is not None
 
-    return result.fetchone() is not None
+    result = cursor.execute(queries.exists_id(table_name, id_field), [id_value])
 
+    exists = result.fetchone() is not None
+    cache.store(table_name, id_field, id_value, {} if exists else None)
 
-def get_by_id(table_name, id_field, id_value, fields=None):
+    return exists
+
+
+def get_by_id(table_name, id_field, id_value, fields=None, readonly=False):
     """
-    Check if there is some record on the table with the id.
+    Return the fields of the record on the table with the id.
+
+    The rows are cached by the id on the identity map of the request (and on the process cache when it
+    is enabled), so repeated lookups of the same id will not query the database again.
 
     Args:
         table_name (str): Name of the table that will be used in the verification.
         if_field (str): Name of the id field that will be used to check the value.
         id_value (int): Value of the id that will be searched on the id field of the table.
+        fields (list): Name of the fields that will be returned. All fields if not given.
+        readonly (bool): Use the read only connection.
 
     Returns:
-        True - id exists.
-        False - id not exists.
+        (dict/None): The fields of the record or None if the id does not exist.
     """
     if not id_value:
         return None
 
-    cursor = get_db().cursor()
+    cached = cache.lookup(table_name, id_field, id_value)
+    if cached is None:
+        return None
+    if cached is not cache.MISSING and fields and all(field in cached for field in fields):
+        return {field: cached[field] for field in fields}
+
+    cursor = get_db(readonly=readonly).cursor()
 
-    sql_command = 'SELECT {} FROM {} WHERE {} = {}'.format(
-        '*' if not fields else ', '.join(fields),
-        table_name,
-        id_field,
-        id_value
-    )
-    result = cursor.execute(sql_command).fetchone()
+    sql_command = queries.select_by_id(table_name, id_field, tuple(fields) if fields else None)
+    result = cursor.execute(sql_command, [id_value]).fetchone()
 
-    if result:
-        return dict(result)
+    row = dict(result) if result else None
+    cache.store(table_name, id_field, id_value, row)
 
-    return None
+    return row
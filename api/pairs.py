@@ -0,0 +1,100 @@
+"""Index of the call records waiting for the record of the other type of the call.
+
+Each record is added to the pending_pair table when it is written and its partner (the end record of a
+start record, or the start record of an end record) was not received yet, and the row of the partner is
+removed when it arrives. So the records that would be missing from the bills are read from the small
+pending_pair table by its timestamp index, instead of an anti-join over all the phone_call table.
+
+When the partner arrives the call is added to the call_pair table, with the subscriber and the months of its
+start and end records, so the bills find the few calls started on the month before the period by an index
+lookup instead of searching the start records of all the history.
+"""
+from datetime import datetime, timedelta
+
+from api import constants, queries
+
+
+# the records younger than this number of seconds are usually calls in progress, not orphans
+RECONCILE_MIN_AGE = 3600
+RECONCILE_LIMIT = 100
+
+
+def partner_type(record_type):
+    """Return the type of the other record of the call."""
+    if record_type == constants.RECORD_TYPE_START:
+        return constants.RECORD_TYPE_END
+
+    return constants.RECORD_TYPE_START
+
+
+def track_record(db, call_identifier, record_type, record_timestamp):
+    """
+    Update the pending pairs and the call pairs with a record just written, without committing.
+
+    Args:
+        db (sqlite3.Connection): Connection used to write the record.
+        call_identifier (int): Call id of the record.
+        record_type (str): Type of the record.
+        record_timestamp (datetime): Timestamp of the record.
+    """
+    other_type = partner_type(record_type)
+    if db.execute(queries.EXISTS_CALL_ID, [call_identifier, other_type, None]).fetchone():
+        db.execute(queries.DELETE_PENDING_PAIR, [call_identifier, other_type])
+        db.execute(
+            queries.INSERT_CALL_PAIR, [constants.RECORD_TYPE_START, constants.RECORD_TYPE_END, call_identifier]
+        )
+    else:
+        db.execute(queries.INSERT_PENDING_PAIR, [call_identifier, record_type, record_timestamp])
+
+
+def untrack_record(db, call_identifier, record_type):
+    """Update the pending pairs with a record just deleted, whose partner becomes pending again."""
+    db.execute(queries.DELETE_PENDING_PAIR, [call_identifier, record_type])
+    db.execute(queries.DELETE_CALL_PAIR, [call_identifier])
+
+    other_type = partner_type(record_type)
+    partner = db.execute(queries.SELECT_CALL_RECORD, [call_identifier, other_type]).fetchone()
+    if partner:
+        db.execute(queries.INSERT_PENDING_PAIR, [call_identifier, other_type, partner['record_timestamp']])
+
+
+def clear_pairs(db):
+    """Remove all the pending pairs and call pairs, without committing."""
+    db.execute('DELETE FROM pending_pair')
+    db.execute('DELETE FROM call_pair')
+
+
+def rebuild_pairs(db):
+    """Rebuild the pending pairs and the call pairs from the phone_call table, creating the tables if needed."""
+    for statement in queries.CREATE_PENDING_PAIR + queries.CREATE_CALL_PAIR:
+        db.execute(statement)
+    clear_pairs(db)
+    db.execute(queries.REBUILD_PENDING_PAIRS)
+    db.execute(queries.INSERT_CALL_PAIRS, [constants.RECORD_TYPE_START, constants.RECORD_TYPE_END])
+
+
+def list_orphans(db, min_age=RECONCILE_MIN_AGE, limit=RECONCILE_LIMIT, base_date=None):
+    """
+    Return the records without partner older than the minimum age, the oldest first.
+
+    Args:
+        db (sqlite3.Connection): Connection used to read the pending pairs.
+        min_age (int): Minimum age of the records, in seconds.
+        limit (int): Maximum number of records returned.
+        base_date (datetime): Date used to calculate the ages. Now if not given.
+
+    Returns:
+        (list): Dicts with the call id, the type, the timestamp and the age in seconds of the records.
+    """
+    base_date = base_date or datetime.today()
+    rows = db.execute(queries.SELECT_PENDING_PAIRS, [base_date - timedelta(seconds=min_age), limit])
+
+    return [
+        {
+            'call_identifier': row['call_identifier'],
+            'record_type': row['record_type'],
+            'record_timestamp': row['record_timestamp'],
+            'age': int((base_date - row['record_timestamp']).total_seconds()),
+        }
+        for row in rows
+    ]
@@ -0,0 +1,288 @@
+"""Monthly partitions of the call records.
+
+When the database is partitioned (by the partition-calls command) the records are stored on one table
+by month, named phone_call_YYYYMM, and phone_call becomes a view of all the partitions. The lookups by
+id keep using the view, while the writes and the queries of the bills are routed to the partitions of
+their months, so the old partitions are never touched by the live data.
+
+The partitions of a database are read once by connection and cached on it, so the writes and the bills do
+not query sqlite_master. The cache is discarded when the partitions are changed by the process, and when
+the connection fails (e.g. writing on the phone_call table after other process partitioned it). A partition
+that is not on the cache is looked up again before it is created or considered missing.
+"""
+import re
+import threading
+
+
+CALLS_TABLE = 'phone_call'
+DEFAULT_PARTITION = 'phone_call_default'
+SEQUENCE_TABLE = 'phone_call_sequence'
+
+PARTITION_NAME = 'phone_call_{:04d}{:02d}'
+PARTITION_PATTERN = re.compile(r'^phone_call_\d{6}$')
+
+# same columns of the phone_call table of schema.sql, the ids are allocated by the sequence table so they
+# are unique on all the partitions
+CREATE_PARTITION = (
+    'CREATE TABLE {0} ('
+    ' record_id INTEGER PRIMARY KEY,'
+    ' record_type INTEGER NOT NULL,'
+    ' record_timestamp TIMESTAMP,'
+    ' call_identifier INTEGER,'
+    ' origin_number TEXT,'
+    ' destination_number TEXT,'
+    ' origin_key INTEGER,'
+    ' destination_key INTEGER'
+    ')',
+    'CREATE INDEX {0}_origin_key_idx ON {0} (origin_key, call_identifier)',
+    'CREATE INDEX {0}_call_identifier_idx ON {0} (call_identifier, record_type)',
+)
+
+SELECT_OBJECT_TYPE = 'SELECT type FROM sqlite_master WHERE name = ?'
+
+SELECT_TABLES = "SELECT name FROM sqlite_master WHERE type = 'table'"
+
+SELECT_MONTHS = (
+    "SELECT DISTINCT strftime('%Y', record_timestamp), strftime('%m', record_timestamp) "
+    'FROM phone_call_default WHERE record_timestamp IS NOT NULL'
+)
+
+SELECT_RECORD_MONTH = "SELECT strftime('%Y%m', record_timestamp) FROM phone_call WHERE record_id = ?"
+
+# incremented each time the process changes the partitions, the states cached with an older one are read again
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def invalidate(db=None):
+    """
+    Discard the partitions cached on the connection, or on all the connections of the process when not given.
+
+    Args:
+        db (sqlite3.Connection): Connection whose cache is discarded, e.g. after it failed.
+    """
+    global _generation
+    if db is not None:
+        if getattr(db, 'partition_state', None) is not None:
+            db.partition_state = None
+        return
+
+    with _generation_lock:
+        _generation += 1
+
+
+def get_partitions(db, refresh=False):
+    """
+    Return the names of the monthly partitions of the database, cached on the connection.
+
+    Args:
+        db (sqlite3.Connection): Connection with the database. The state is cached only on the connections
+            opened by the api, that accept the partition_state attribute.
+        refresh (bool): Read the partitions from the database even when they are cached.
+
+    Returns:
+        (frozenset/None): The names of the partitions, or None when the database is not partitioned.
+    """
+    state = getattr(db, 'partition_state', None)
+    if not refresh and state is not None and state[0] == _generation:
+        return state[1]
+
+    generation = _generation
+    row = db.execute(SELECT_OBJECT_TYPE, [CALLS_TABLE]).fetchone()
+    names = frozenset(list_partitions(db)) if row is not None and row[0] == 'view' else None
+    try:
+        db.partition_state = (generation, names)
+    except AttributeError:
+        # a plain sqlite3 connection, not opened by the api, reads the partitions each time
+        pass
+
+    return names
+
+
+def is_partitioned(db, refresh=False):
+    """Check if the records of the database are stored on monthly partitions."""
+    return get_partitions(db, refresh) is not None
+
+
+def has_partition(db, name):
+    """Check if the partition exists, looking it up again when it is not on the cache of the connection."""
+    partitions = get_partitions(db)
+    if partitions is not None and name in partitions:
+        return True
+
+    partitions = get_partitions(db, refresh=True)
+    return partitions is not None and name in partitions
+
+
+def partition_name(year, month):
+    """Return the name of the partition of the month."""
+    return PARTITION_NAME.format(year, month)
+
+
+def previous_month(year, month):
+    """Return the year and the month before the given one."""
+    return (year - 1, 12) if month == 1 else (year, month - 1)
+
+
+def list_partitions(db):
+    """Return the names of the monthly partitions of the database, in order."""
+    return sorted(row[0] for row in db.execute(SELECT_TABLES) if PARTITION_PATTERN.match(row[0]))
+
+
+def record_tables(db):
+    """Return the tables that store the records, the phone_call table or all the partitions."""
+    partitions = get_partitions(db, refresh=True)
+    if partitions is None:
+        return [CALLS_TABLE]
+
+    return [DEFAULT_PARTITION] + sorted(partitions)
+
+
+def rebuild_view(db):
+    """Recreate the phone_call view with all the partitions."""
+    tables = [DEFAULT_PARTITION] + list_partitions(db)
+    db.execute('DROP VIEW IF EXISTS {}'.format(CALLS_TABLE))
+    db.execute('CREATE VIEW {} AS {}'.format(
+        CALLS_TABLE, ' UNION ALL '.join('SELECT * FROM {}'.format(table) for table in tables)
+    ))
+    invalidate()
+
+
+def ensure_partition(db, name):
+    """Create the partition and add it to the view, if it does not exist."""
+    if has_partition(db, name):
+        return
+
+    for statement in CREATE_PARTITION:
+        db.execute(statement.format(name))
+    rebuild_view(db)
+
+
+def table_for(db, timestamp):
+    """Return the table that stores the records of the timestamp, that may not exist yet."""
+    if not is_partitioned(db):
+        return CALLS_TABLE
+
+    if not timestamp:
+        return DEFAULT_PARTITION
+
+    return partition_name(timestamp.year, timestamp.month)
+
+
+def write_table(db, timestamp):
+    """
+    Return the table where the record of the timestamp should be written, creating its partition if needed.
+
+    Args:
+        db (sqlite3.Connection): Connection with the database, on the transaction of the write.
+        timestamp (datetime): Timestamp of the record.
+
+    Returns:
+        (str): Name of the table.
+    """
+    name = table_for(db, timestamp)
+    if name not in (CALLS_TABLE, DEFAULT_PARTITION):
+        ensure_partition(db, name)
+    return name
+
+
+def record_table(db, record_id):
+    """
+    Return the table that stores the record now, used to route the updates by the current row.
+
+    Returns:
+        (str/None): Name of the table, or None if there is no record with the id.
+    """
+    row = db.execute(SELECT_RECORD_MONTH, [record_id]).fetchone()
+    if row is None:
+        return None
+    if not is_partitioned(db):
+        return CALLS_TABLE
+
+    return partition_name(int(row[0][:4]), int(row[0][4:])) if row[0] else DEFAULT_PARTITION
+
+
+def next_record_id(db):
+    """Allocate a new record id on the sequence of the partitions."""
+    record_id = db.execute('INSERT INTO {} DEFAULT VALUES'.format(SEQUENCE_TABLE)).lastrowid
+    db.execute('DELETE FROM {}'.format(SEQUENCE_TABLE))
+    return record_id
+
+
+def end_tables(db, year, month):
+    """Return the tables with the end records of the month."""
+    if not is_partitioned(db):
+        return [CALLS_TABLE]
+
+    return [name for name in (partition_name(year, month),) if has_partition(db, name)]
+
+
+def previous_table(db, year, month):
+    """Return the partition of the month before the given one, or None if it does not exist or not partitioned."""
+    if not is_partitioned(db):
+        return None
+
+    name = partition_name(*previous_month(year, month))
+    return name if has_partition(db, name) else None
+
+
+def start_tables(db, year, month):
+    """Return the tables with the start records of the calls ended on the month, including the previous month."""
+    if not is_partitioned(db):
+        return [CALLS_TABLE]
+
+    months = (previous_month(year, month), (year, month))
+    return [name for name in (partition_name(*value) for value in months) if has_partition(db, name)]
+
+
+def partition_calls(db):
+    """
+    Move the records of the phone_call table to monthly partitions, without committing.
+
+    The table is renamed to phone_call_default, that keeps the records without timestamp, and the
+    sequence of the ids continues from the biggest id already used.
+    """
+    if is_partitioned(db, refresh=True):
+        return
+
+    db.execute('ALTER TABLE {} RENAME TO {}'.format(CALLS_TABLE, DEFAULT_PARTITION))
+    db.execute('CREATE TABLE {} (record_id INTEGER PRIMARY KEY AUTOINCREMENT)'.format(SEQUENCE_TABLE))
+    last_id = db.execute('SELECT max(record_id) FROM {}'.format(DEFAULT_PARTITION)).fetchone()[0]
+    if last_id:
+        db.execute('INSERT INTO {} (record_id) VALUES (?)'.format(SEQUENCE_TABLE), [last_id])
+        db.execute('DELETE FROM {}'.format(SEQUENCE_TABLE))
+
+    for year, month in db.execute(SELECT_MONTHS).fetchall():
+        name = partition_name(int(year), int(month))
+        for statement in CREATE_PARTITION:
+            db.execute(statement.format(name))
+        where = "WHERE strftime('%Y', record_timestamp) = ? AND strftime('%m', record_timestamp) = ?"
+        db.execute('INSERT INTO {} SELECT * FROM {} {}'.format(name, DEFAULT_PARTITION, where), [year, month])
+        db.execute('DELETE FROM {} {}'.format(DEFAULT_PARTITION, where), [year, month])
+
+    rebuild_view(db)
+
+
+def clear_calls(db):
+    """Remove all the records and restart the sequence of the ids, without committing."""
+    if not is_partitioned(db, refresh=True):
+        db.execute('DELETE FROM {}'.format(CALLS_TABLE))
+        db.execute('DELETE FROM sqlite_sequence WHERE name = ?', [CALLS_TABLE])
+        return
+
+    for name in list_partitions(db):
+        db.execute('DROP TABLE {}'.format(name))
+    db.execute('DELETE FROM {}'.format(DEFAULT_PARTITION))
+    db.execute('DELETE FROM sqlite_sequence WHERE name = ?', [SEQUENCE_TABLE])
+    rebuild_view(db)
+
+
+def drop_partitions(db):
+    """Drop the view, the partitions and the sequence of a partitioned database, so the schema can be recreated."""
+    if not is_partitioned(db, refresh=True):
+        return
+
+    db.execute('DROP VIEW {}'.format(CALLS_TABLE))
+    for name in list_partitions(db) + [DEFAULT_PARTITION, SEQUENCE_TABLE]:
+        db.execute('DROP TABLE {}'.format(name))
+    invalidate()
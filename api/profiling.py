@@ -0,0 +1,152 @@
+"""Profiling of single requests on demand, used to find why the bill of a subscriber is slow in production.
+
+When the PROFILE config is enabled, a request is profiled when it has a valid X-Profile-Token header (created
+by the `flask profile-token` command, signed with the SECRET_KEY), or when it is one in every PROFILE_SAMPLE
+requests of the process. The request is profiled by cProfile, saved as a .pstats file, and by a sampler of
+its stack every PROFILE_INTERVAL seconds, saved as collapsed stacks (.collapsed) that are read by the
+flamegraph tools. The files are written on PROFILE_DIRECTORY (default instance/profiles), tagged with the
+route, the subscriber and the period of the request.
+"""
+import cProfile
+import itertools
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+import click
+from flask import current_app, g, request
+from flask.cli import with_appcontext
+from itsdangerous import BadSignature, TimestampSigner
+
+
+PROFILE_HEADER = 'X-Profile-Token'
+PROFILE_SALT = 'profile'
+TAG_PATTERN = re.compile(r'[^A-Za-z0-9]+')
+
+_requests = itertools.count(1)
+
+
+class StackSampler(threading.Thread):
+    """Thread that samples the stack of other thread, counting the samples of each stack."""
+
+    def __init__(self, thread_id, interval):
+        """Constructor used to create the sampler of the thread."""
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        """Sample the stack on each interval until the sampler is stopped."""
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        """Count the current stack of the thread, from the outermost frame to the innermost one."""
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        if names:
+            self.stacks[';'.join(reversed(names))] += 1
+
+    def stop(self):
+        """Stop the sampler and wait for its last sample."""
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def collapsed(self):
+        """Return the samples on the collapsed stacks format, one stack and its count by line."""
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in sorted(self.stacks.items()))
+
+
+def get_signer(app):
+    """Return the signer of the profile tokens, with the SECRET_KEY of the app."""
+    return TimestampSigner(app.config['SECRET_KEY'], salt=PROFILE_SALT)
+
+
+def create_token(app):
+    """Return a new token that enables the profile of the requests that send it."""
+    return get_signer(app).sign(PROFILE_SALT).decode('ascii')
+
+
+def is_valid_token(app, token):
+    """Check if the token was signed by the app and is not older than the PROFILE_TOKEN_MAX_AGE config."""
+    try:
+        return get_signer(app).unsign(token, max_age=app.config['PROFILE_TOKEN_MAX_AGE']) == PROFILE_SALT.encode()
+    except BadSignature:
+        return False
+
+
+def should_profile():
+    """Check if the current request is profiled, by its token or by the sampling of the requests."""
+    token = request.headers.get(PROFILE_HEADER)
+    if token is not None and is_valid_token(current_app, token):
+        return True
+
+    sample = current_app.config['PROFILE_SAMPLE']
+    return bool(sample) and next(_requests) % sample == 0
+
+
+def get_profile_name():
+    """Return the name of the files of the profile, with the time, the route, the subscriber and the period."""
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    tags = [route, request.args.get('subscriber'), request.args.get('period')]
+    tags = [TAG_PATTERN.sub('-', tag).strip('-') for tag in tags if tag]
+
+    # the random part keeps apart the profiles of the same second
+    return '-'.join([time.strftime('%Y%m%dT%H%M%S'), uuid.uuid4().hex[:8]] + [tag for tag in tags if tag])
+
+
+def start_profile():
+    """Start the profile of the request when it is enabled and selected. The only cost when disabled is the flag."""
+    if not current_app.config['PROFILE'] or not should_profile():
+        return
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # other profiler is already running on the thread
+        return
+
+    sampler = StackSampler(threading.get_ident(), current_app.config['PROFILE_INTERVAL'])
+    sampler.start()
+    g.profile = (profile, sampler)
+
+
+def finish_profile(exception=None):
+    """Stop the profile of the request and write its files."""
+    if 'profile' not in g:
+        return
+
+    profile, sampler = g.pop('profile')
+    profile.disable()
+    sampler.stop()
+
+    directory = current_app.config['PROFILE_DIRECTORY'] or os.path.join(current_app.instance_path, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, get_profile_name())
+    profile.dump_stats(path + '.pstats')
+    with open(path + '.collapsed', 'w') as f:
+        f.write(sampler.collapsed())
+    current_app.logger.info('Profile of %s %s written on %s', request.method, request.full_path, path)
+
+
+@click.command('profile-token')
+@with_appcontext
+def profile_token_command():
+    """Create a token for the X-Profile-Token header, that enables the profile of the requests that send it."""
+    click.echo(create_token(current_app))
+
+
+def init_app(app):
+    app.cli.add_command(profile_token_command)
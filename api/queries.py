@@ -0,0 +1,241 @@
+"""SQL statements issued by the models of the api.
+
+All the values are bound as parameters, so each statement has a fixed text that is prepared once by
+sqlite3 and reused from its statement cache. The statements that depend on table or field names are
+built by functions memoized by those names, and the IN lists are split in chunks padded to a few
+fixed sizes.
+"""
+from functools import lru_cache
+
+
+IN_LIST_SIZES = (1, 8, 32, 128, 256)
+
+# lists of call ids bigger than this are joined against a temporary table instead of bound on IN lists,
+# the value is the crossover point measured by benchmarks/start_records_strategy.py
+TEMP_TABLE_THRESHOLD = 2048
+
+CALL_RECORD_FIELDS = 'record_id, record_type, record_timestamp, call_identifier, origin_number, destination_number'
+
+EXISTS_CALL_ID = (
+    'SELECT 1 FROM phone_call WHERE call_identifier = ? AND record_type = ? AND record_id IS NOT ?'
+)
+
+SELECT_PERIOD_BILL = 'SELECT id FROM phone_bill WHERE period = ? AND phone_key = ?'
+
+SELECT_PERIOD_BILL_CALLS = (
+    'SELECT phone_bill_call.*, phone_bill.phone_key FROM phone_bill_call '
+    'JOIN phone_bill ON phone_bill.id = phone_bill_call.bill_id '
+    'WHERE phone_bill.period = ?'
+)
+
+SELECT_CALL_RECORD = 'SELECT * FROM phone_call WHERE call_identifier = ? AND record_type = ?'
+
+SELECT_SUBSCRIBER_RECORDS = 'SELECT * FROM phone_call WHERE record_type = ? AND origin_key = ?'
+
+SELECT_SUBSCRIBER_BILLS = 'SELECT * FROM phone_bill WHERE phone_key = ?'
+
+SELECT_BILL_CALLS = 'SELECT * FROM phone_bill_call WHERE bill_id = ?'
+
+SELECT_SHARD_SUBSCRIBERS = (
+    'SELECT origin_key FROM phone_call WHERE record_type = ? UNION SELECT phone_key FROM phone_bill'
+)
+
+# records without the record of the other type of the call, read by the index of the pending_pair table
+SELECT_PENDING_RECORDS = (
+    'SELECT phone_call.* FROM pending_pair JOIN phone_call USING (call_identifier, record_type) '
+    'WHERE pending_pair.record_type = ?'
+)
+
+# same table of schema.sql, created on the databases initialized before it existed
+CREATE_PENDING_PAIR = (
+    'CREATE TABLE IF NOT EXISTS pending_pair ('
+    ' call_identifier INTEGER,'
+    ' record_type TEXT,'
+    ' record_timestamp TIMESTAMP,'
+    ' PRIMARY KEY (call_identifier, record_type)'
+    ')',
+    'CREATE INDEX IF NOT EXISTS pending_pair_record_timestamp_idx ON pending_pair (record_timestamp)',
+)
+
+INSERT_PENDING_PAIR = (
+    'INSERT OR REPLACE INTO pending_pair (call_identifier, record_type, record_timestamp) VALUES (?, ?, ?)'
+)
+
+DELETE_PENDING_PAIR = 'DELETE FROM pending_pair WHERE call_identifier = ? AND record_type = ?'
+
+SELECT_PENDING_PAIRS = (
+    'SELECT call_identifier, record_type, record_timestamp FROM pending_pair '
+    'WHERE record_timestamp <= ? ORDER BY record_timestamp LIMIT ?'
+)
+
+# full anti-join of the phone_call table, only used to build the pending_pair table of an existent database
+REBUILD_PENDING_PAIRS = (
+    'INSERT INTO pending_pair (call_identifier, record_type, record_timestamp) '
+    'SELECT call_identifier, record_type, record_timestamp FROM phone_call AS record WHERE NOT EXISTS ('
+    'SELECT 1 FROM phone_call AS partner WHERE'
+    ' partner.call_identifier = record.call_identifier AND'
+    ' partner.record_type != record.record_type)'
+)
+
+# same table of schema.sql, created on the databases initialized before it existed
+CREATE_CALL_PAIR = (
+    'CREATE TABLE IF NOT EXISTS call_pair ('
+    ' call_identifier INTEGER PRIMARY KEY,'
+    ' origin_key INTEGER,'
+    ' start_month INTEGER,'
+    ' end_month INTEGER'
+    ')',
+    'CREATE INDEX IF NOT EXISTS call_pair_origin_key_idx ON call_pair (origin_key, end_month, start_month)',
+)
+
+# the months are stored as YYYYMM integers
+INSERT_CALL_PAIRS = (
+    'INSERT OR REPLACE INTO call_pair (call_identifier, origin_key, start_month, end_month) '
+    "SELECT call_identifier, start_record.origin_key, CAST(strftime('%Y%m', start_record.record_timestamp) AS INTEGER),"
+    " CAST(strftime('%Y%m', end_record.record_timestamp) AS INTEGER) "
+    'FROM phone_call AS start_record JOIN phone_call AS end_record USING (call_identifier) WHERE'
+    ' start_record.record_type = ? AND'
+    ' end_record.record_type = ?'
+)
+
+INSERT_CALL_PAIR = INSERT_CALL_PAIRS + ' AND call_identifier = ?'
+
+DELETE_CALL_PAIR = 'DELETE FROM call_pair WHERE call_identifier = ?'
+
+SELECT_INGEST_BATCH = 'SELECT records, committed_at FROM ingest_batch WHERE token = ?'
+
+
+CREATE_TEMP_CALL_IDS = 'CREATE TEMP TABLE IF NOT EXISTS temp_call_ids (call_identifier INTEGER PRIMARY KEY)'
+
+INSERT_TEMP_CALL_IDS = 'INSERT OR IGNORE INTO temp_call_ids (call_identifier) VALUES (?)'
+
+CLEAR_TEMP_CALL_IDS = 'DELETE FROM temp_call_ids'
+
+
+@lru_cache(maxsize=None)
+def exists_id(table_name, id_field):
+    """Return the statement that checks if there is a record with the id."""
+    return 'SELECT 1 FROM {} WHERE {} = ?'.format(table_name, id_field)
+
+
+@lru_cache(maxsize=None)
+def select_by_id(table_name, id_field, fields=None):
+    """Return the statement that selects the fields (tuple or None for all) of the record with the id."""
+    return 'SELECT {} FROM {} WHERE {} = ?'.format('*' if not fields else ', '.join(fields), table_name, id_field)
+
+
+@lru_cache(maxsize=None)
+def insert(table_name, fields):
+    """Return the statement that inserts a record with the fields (tuple)."""
+    return 'INSERT INTO {} ({}) VALUES ({})'.format(table_name, ', '.join(fields), ', '.join(['?'] * len(fields)))
+
+
+@lru_cache(maxsize=None)
+def update(table_name, fields, id_field):
+    """Return the statement that updates the fields (tuple) of the record with the id."""
+    return 'UPDATE {} SET {} WHERE {} = ?'.format(table_name, ', '.join('{} = ?'.format(f) for f in fields), id_field)
+
+
+@lru_cache(maxsize=None)
+def delete_by_id(table_name, id_field):
+    """Return the statement that deletes the record with the id."""
+    return 'DELETE FROM {} WHERE {} = ?'.format(table_name, id_field)
+
+
+@lru_cache(maxsize=None)
+def select_end_records(table_name='phone_call'):
+    """Return the statement that selects the end records of a month and year from the table."""
+    return (
+        'SELECT'
+        ' {}'
+        ' FROM {} WHERE'
+        ' record_type = ? AND'
+        ' strftime(?, record_timestamp) = ? AND'
+        ' strftime(?, record_timestamp) = ?'
+    ).format(CALL_RECORD_FIELDS, table_name)
+
+
+@lru_cache(maxsize=None)
+def select_start_records(size, table_name='phone_call'):
+    """Return the statement that selects the start records of a subscriber with a list of call ids of the size."""
+    return (
+        'SELECT {} '
+        'FROM {} WHERE'
+        ' record_type = ? AND'
+        ' origin_key = ? AND'
+        ' call_identifier IN ({})'
+    ).format(CALL_RECORD_FIELDS, table_name, ', '.join(['?'] * size))
+
+
+@lru_cache(maxsize=None)
+def select_call_ids(size):
+    """Return the statement that selects the call ids of a type already saved, with a list of call ids of the size."""
+    return 'SELECT call_identifier FROM phone_call WHERE record_type = ? AND call_identifier IN ({})'.format(
+        ', '.join(['?'] * size)
+    )
+
+
+@lru_cache(maxsize=None)
+def select_bill_calls(size):
+    """Return the statement that selects the rated calls with a list of call ids of the size."""
+    return 'SELECT * FROM phone_bill_call WHERE call_identifier IN ({})'.format(', '.join(['?'] * size))
+
+
+@lru_cache(maxsize=None)
+def select_boundary_start_records(table_name='phone_call'):
+    """Return the statement that selects the start records of a subscriber of the calls ended on the next month."""
+    return (
+        'SELECT {} '
+        'FROM call_pair CROSS JOIN {} USING (call_identifier) WHERE'
+        ' call_pair.origin_key = ? AND'
+        ' call_pair.end_month = ? AND'
+        ' call_pair.start_month = ? AND'
+        ' record_type = ?'
+    ).format(CALL_RECORD_FIELDS, table_name)
+
+
+@lru_cache(maxsize=None)
+def select_start_records_temp_table(table_name='phone_call'):
+    """Return the statement that selects the start records of a subscriber with the call ids of the temporary table."""
+    return (
+        'SELECT {} '
+        'FROM temp_call_ids CROSS JOIN {} USING (call_identifier) WHERE'
+        ' record_type = ? AND'
+        ' origin_key = ?'
+    ).format(CALL_RECORD_FIELDS, table_name)
+
+
+@lru_cache(maxsize=None)
+def select_records_temp_table(table_name='phone_call'):
+    """Return the statement that selects the records of any subscriber with the call ids of the temporary table."""
+    return (
+        'SELECT {} '
+        'FROM temp_call_ids CROSS JOIN {} USING (call_identifier) WHERE'
+        ' record_type = ?'
+    ).format(CALL_RECORD_FIELDS, table_name)
+
+
+def in_list_chunks(values):
+    """
+    Split the values in chunks with the sizes allowed on the IN lists.
+
+    Each chunk is padded repeating its last value until the next allowed size, what does not change
+    the result of the IN condition but keeps the number of distinct statements small.
+
+    Args:
+        values (iterable): Values that will be bound on the IN lists.
+
+    Returns:
+        (list): List of chunks, each one a list of values.
+    """
+    values = list(values)
+    max_size = IN_LIST_SIZES[-1]
+
+    chunks = []
+    for start in range(0, len(values), max_size):
+        chunk = values[start:start + max_size]
+        size = next(size for size in IN_LIST_SIZES if size >= len(chunk))
+        chunk.extend([chunk[-1]] * (size - len(chunk)))
+        chunks.append(chunk)
+
+    return chunks
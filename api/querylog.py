@@ -0,0 +1,165 @@
+"""Log of the database statements executed by each request.
+
+When the DATABASE_QUERY_LOG config is enabled, the connections of the requests record each statement by its
+shape (the statement with the values and the lists of parameters collapsed), with the number of executions,
+the time and the rows read or written. At the end of the request the summary is logged and returned on the
+X-DB-Queries header, and the shapes executed more than DATABASE_REPEATED_STATEMENTS times are logged as
+repeated, which is usually a query by id inside a loop (N+1).
+
+The DATABASE_QUERY_BUDGETS config sets the maximum number of statements of the endpoints. The requests over
+their budget are logged, and fail with QueryBudgetExceeded when testing, so the tests assert the budgets.
+"""
+import re
+from contextlib import contextmanager
+
+from flask import current_app, g, request
+
+
+NORMALIZE_PATTERNS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?, ...)'),
+    (re.compile(r'\s+'), ' '),
+)
+NORMALIZED_CACHE_SIZE = 2048
+
+_normalized = {}
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when testing, when a request executes more statements than the budget of its endpoint."""
+
+
+def normalize_statement(sql):
+    """Return the shape of the statement, the same for the statements that only differ by their values."""
+    shape = _normalized.get(sql)
+    if shape is None:
+        shape = sql
+        for pattern, replacement in NORMALIZE_PATTERNS:
+            shape = pattern.sub(replacement, shape)
+        shape = shape.strip()
+        if len(_normalized) >= NORMALIZED_CACHE_SIZE:
+            _normalized.clear()
+        _normalized[sql] = shape
+
+    return shape
+
+
+class QueryLog:
+    """Statements executed by a request, by shape."""
+
+    def __init__(self):
+        """Constructor used to create an empty log."""
+        self.count = 0
+        self.duration = 0
+        self.rows = 0
+        self.rows_read = 0
+        self.rows_written = 0
+        self.shapes = {}
+
+    def record(self, sql, duration, rows=0):
+        """
+        Record the execution of the statement.
+
+        Args:
+            sql (str): Statement executed.
+            duration (float): Time of the execution, in seconds.
+            rows (int): Rows written by the statement.
+
+        Returns:
+            (list): Entry of the shape, with the executions, the time and the rows.
+        """
+        shape = normalize_statement(sql)
+        entry = self.shapes.get(shape)
+        if entry is None:
+            entry = self.shapes[shape] = [0, 0, 0]
+        entry[0] += 1
+        entry[1] += duration
+        self.count += 1
+        self.duration += duration
+        entry[2] += rows
+        self.rows += rows
+        self.rows_written += rows
+
+        return entry
+
+    def add_rows(self, entry, rows):
+        """Add the rows read by a statement of the shape of the entry."""
+        entry[2] += rows
+        self.rows += rows
+        self.rows_read += rows
+
+    def repeated(self, threshold):
+        """Return the shapes executed more than the threshold times, with their number of executions."""
+        return sorted(
+            ((shape, entry[0]) for shape, entry in self.shapes.items() if entry[0] > threshold),
+            key=lambda item: -item[1]
+        )
+
+    def summary(self):
+        """Return the number of statements and their time, e.g. 4123 / 870ms."""
+        return '{} / {:.0f}ms'.format(self.count, self.duration * 1000)
+
+
+def attach(query_log):
+    """Make the connections already opened by the request record on the log."""
+    for db in g.get('databases', {}).values():
+        if hasattr(db, 'query_log'):
+            db.query_log = query_log
+
+
+@contextmanager
+def track_queries():
+    """
+    Record the statements executed inside the block, out of a request (e.g. on the tests of the models).
+
+    Yields:
+        (QueryLog): Log of the statements of the block.
+    """
+    previous = g.get('query_log')
+    g.query_log = QueryLog()
+    attach(g.query_log)
+    try:
+        yield g.query_log
+    finally:
+        g.query_log = previous
+        attach(previous)
+
+
+def start_request():
+    """Create the log of the request, when it is enabled by the DATABASE_QUERY_LOG config or used by the slow log."""
+    if current_app.config['DATABASE_QUERY_LOG'] or current_app.config['SLOW_REQUEST_THRESHOLD']:
+        g.query_log = QueryLog()
+        attach(g.query_log)
+
+
+def finish_request(response):
+    """
+    Report the statements of the request: the summary, the repeated shapes and the budget of the endpoint.
+
+    Raises:
+        QueryBudgetExceeded: The request executed more statements than its budget, when testing.
+    """
+    query_log = g.get('query_log')
+    # the log is also kept for the slow request log, that reports it only when the request is slow
+    if query_log is None or not current_app.config['DATABASE_QUERY_LOG']:
+        return response
+
+    config = current_app.config
+    logger = current_app.logger
+    response.headers['X-DB-Queries'] = query_log.summary()
+    logger.info('%s %s: %s, %d rows', request.method, request.path, query_log.summary(), query_log.rows)
+
+    for shape, count in query_log.repeated(config['DATABASE_REPEATED_STATEMENTS']):
+        logger.warning('Statement repeated %d times by %s %s: %s', count, request.method, request.path, shape)
+
+    budget = config['DATABASE_QUERY_BUDGETS'].get(request.endpoint)
+    if budget is not None and query_log.count > budget:
+        message = 'The endpoint {} executed {} statements, over its budget of {}.'.format(
+            request.endpoint, query_log.count, budget
+        )
+        if current_app.testing:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+    return response
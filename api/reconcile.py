@@ -0,0 +1,47 @@
+"""Reconciliation of the call records whose start or end record was not received."""
+import click
+from flask.cli import with_appcontext
+
+from api import pairs, shards
+from api.db import get_db, use_shard
+from api.writer import run_write
+
+
+def find_orphans(min_age=pairs.RECONCILE_MIN_AGE, limit=pairs.RECONCILE_LIMIT):
+    """Return the records without partner of all the shards, the oldest first."""
+    orphans = [
+        orphan
+        for shard_orphans in shards.scatter(lambda db: pairs.list_orphans(db, min_age, limit), readonly=True)
+        for orphan in shard_orphans
+    ]
+
+    return sorted(orphans, key=lambda orphan: orphan['age'], reverse=True)[:limit]
+
+
+@click.command('reconcile')
+@click.option('--min-age', type=int, default=pairs.RECONCILE_MIN_AGE, help='Minimum age of the records, in seconds.')
+@click.option('--limit', type=int, default=pairs.RECONCILE_LIMIT, help='Maximum number of records listed.')
+@click.option('--rebuild', is_flag=True, help='Rebuild the index from the phone_call table before listing.')
+@click.option('--pending', is_flag=True,
+              help='Move the end records left on their pending shards to the shards of their start records.')
+@with_appcontext
+def reconcile_command(min_age, limit, rebuild, pending):
+    """List the call records whose start or end record was not received, the oldest first."""
+    if rebuild:
+        for name in shards.get_shard_names():
+            with use_shard(name):
+                run_write(pairs.rebuild_pairs, get_db)
+
+    ring = shards.get_ring()
+    if pending and ring is not None:
+        moved = sum(shards.rebalance_pending(name, ring) for name in ring.names)
+        click.echo('{} pending end records moved.'.format(moved))
+
+    orphans = find_orphans(min_age, limit)
+    for orphan in orphans:
+        click.echo('{call_identifier} {record_type} {record_timestamp} ({age} seconds)'.format(**orphan))
+    click.echo('{} records without the start or the end record.'.format(len(orphans)))
+
+
+def init_app(app):
+    app.cli.add_command(reconcile_command)
@@ -0,0 +1,137 @@
+"""Lightweight value types used to hold the call records read by the billing queries."""
+import sys
+from array import array
+from datetime import datetime, timedelta
+
+from api.utils import get_date_or_none
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch_seconds(value):
+    """Return the number of seconds between the epoch and the datetime given."""
+    delta = value - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def from_epoch_seconds(value):
+    """Return the datetime of the number of seconds since the epoch."""
+    return EPOCH + timedelta(seconds=value)
+
+
+class CallRecordData:
+    """Call record read from the database, without any database access of its own."""
+
+    __slots__ = (
+        'record_id', 'record_type', 'record_timestamp', 'call_identifier', 'origin_number', 'destination_number'
+    )
+
+    def __init__(
+        self, record_id, record_type, record_timestamp, call_identifier, origin_number=None, destination_number=None
+    ):
+        """Constructor used to populate the data of the object."""
+        self.record_id = record_id
+        self.record_type = record_type
+        self.record_timestamp = record_timestamp
+        self.call_identifier = call_identifier
+        self.origin_number = origin_number
+        self.destination_number = destination_number
+
+    def __eq__(self, other):
+        """Compare the values of two records."""
+        if not isinstance(other, CallRecordData):
+            return NotImplemented
+
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        """Return the representation of the record with its identifiers."""
+        return 'CallRecordData({!r}, {!r}, {!r})'.format(self.record_id, self.record_type, self.call_identifier)
+
+
+class CallBatch:
+    """
+    Columnar container of call records of the same record type.
+
+    The integer values (ids and timestamps as seconds since the epoch) are kept in typed arrays and the
+    phone numbers in lists of interned strings, so a big month is held without one object per record.
+    Iterating the batch yields a CallRecordData for each record.
+    """
+
+    __slots__ = ('record_type', 'record_ids', 'call_identifiers', 'timestamps', 'origin_numbers', 'destination_numbers')
+
+    def __init__(self, record_type):
+        """Constructor used to create an empty batch of the record type."""
+        self.record_type = record_type
+        self.record_ids = array('q')
+        self.call_identifiers = array('q')
+        self.timestamps = array('q')
+        self.origin_numbers = []
+        self.destination_numbers = []
+
+    @classmethod
+    def from_rows(cls, record_type, rows):
+        """
+        Create a batch with the rows returned by a query.
+
+        Args:
+            record_type (str): Type of the records of the batch.
+            rows (iterable): Rows in the order record_id, record_type, record_timestamp, call_identifier,
+                origin_number, destination_number.
+
+        Returns:
+            (CallBatch): Batch with the values of the rows.
+        """
+        batch = cls(record_type)
+        batch.append_rows(rows)
+
+        return batch
+
+    def append_rows(self, rows):
+        """Add the rows returned by a query, in the same order of from_rows, on the batch."""
+        for row in rows:
+            self.append(row[0], row[2], row[3], row[4], row[5])
+
+    def append(self, record_id, record_timestamp, call_identifier, origin_number=None, destination_number=None):
+        """Add a record on the batch."""
+        if not isinstance(record_timestamp, datetime):
+            record_timestamp = get_date_or_none(record_timestamp)
+
+        self.record_ids.append(record_id or 0)
+        self.timestamps.append(to_epoch_seconds(record_timestamp))
+        self.call_identifiers.append(call_identifier)
+        self.origin_numbers.append(sys.intern(origin_number) if origin_number else None)
+        self.destination_numbers.append(sys.intern(destination_number) if destination_number else None)
+
+    def extend(self, other):
+        """Add all the records of other batch on this one."""
+        self.record_ids.extend(other.record_ids)
+        self.timestamps.extend(other.timestamps)
+        self.call_identifiers.extend(other.call_identifiers)
+        self.origin_numbers.extend(other.origin_numbers)
+        self.destination_numbers.extend(other.destination_numbers)
+
+    def __len__(self):
+        """Return the number of records on the batch."""
+        return len(self.record_ids)
+
+    def __getitem__(self, index):
+        """Return the record of the position as a CallRecordData."""
+        return CallRecordData(
+            self.record_ids[index] or None,
+            self.record_type,
+            from_epoch_seconds(self.timestamps[index]),
+            self.call_identifiers[index],
+            self.origin_numbers[index],
+            self.destination_numbers[index],
+        )
+
+    def __iter__(self):
+        """Iterate over the records of the batch."""
+        for index in range(len(self.record_ids)):
+            yield self[index]
+
+    def by_call_identifier(self):
+        """Return a dict with the call identifiers as keys and the records as values."""
+        return {record.call_identifier: record for record in self}
@@ -0,0 +1,271 @@
+"""Fast JSON serialization of the api responses.
+
+The responses have the same bytes of jsonify (compact separators, sorted keys, ascii strings and the dates
+formatted as http dates), but each type has its own encoder, chosen by the exact type of the value, and
+the models are encoded from their attributes with a template compiled for the class, without building the
+dicts of to_dict. orjson is used when it is installed.
+
+The bills are written chunk by chunk of their calls by BillWriter, so the calls of a bill are not all kept in
+memory to be encoded.
+"""
+import json
+from datetime import date, datetime
+from operator import attrgetter
+
+from flask import current_app, jsonify
+from werkzeug.http import http_date
+from werkzeug.wsgi import FileWrapper
+
+from api.models import PhoneBill, PhoneBillCall
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = (None, 'Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+HTTP_DATE_FORMAT = '%s, %02d %s %04d %02d:%02d:%02d GMT'
+HTTP_DATE_JSON_FORMAT = '"' + HTTP_DATE_FORMAT + '"'
+# size of the blocks read from the spooled bodies streamed to the client
+STREAM_BLOCK_SIZE = 64 * 1024
+
+# json keys of the models and the attributes where their values are read
+PHONE_BILL_FIELDS = {
+    'subscriber': 'phone_number',
+    'period': 'period',
+    'total': 'total',
+    'calls': 'record_calls',
+}
+PHONE_BILL_CALL_FIELDS = {name: name for name in PhoneBillCall.__slots__}
+
+encode_string = json.encoder.encode_basestring_ascii
+
+
+def format_http_date(value):
+    """Return the date formatted as an http date, the same of werkzeug http_date for the naive dates."""
+    if not isinstance(value, datetime):
+        return HTTP_DATE_FORMAT % (WEEKDAYS[value.weekday()], value.day, MONTHS[value.month], value.year, 0, 0, 0)
+    if value.tzinfo is not None:
+        return http_date(value)
+
+    return HTTP_DATE_FORMAT % (
+        WEEKDAYS[value.weekday()], value.day, MONTHS[value.month], value.year, value.hour, value.minute, value.second
+    )
+
+
+def encode_datetime(value):
+    """Encode the datetime as a json string with the http date."""
+    if value.tzinfo is not None:
+        return encode_string(http_date(value))
+
+    return HTTP_DATE_JSON_FORMAT % (
+        WEEKDAYS[value.weekday()], value.day, MONTHS[value.month], value.year, value.hour, value.minute, value.second
+    )
+
+
+def encode_date(value):
+    """Encode the date as a json string with the http date."""
+    return encode_string(format_http_date(value))
+
+
+def encode_dict(value):
+    """Encode the dict with the keys sorted."""
+    items = [(key, value[key]) for key in sorted(value)]
+    return '{' + ','.join([encode_string(key) + ':' + ENCODERS[type(item)](item) for key, item in items]) + '}'
+
+
+def encode_list(value):
+    """Encode the list or the tuple."""
+    return '[' + ','.join([ENCODERS[type(item)](item) for item in value]) + ']'
+
+
+class EncoderMap(dict):
+    """Encoders by exact type, that returns the generic encode function for the other types."""
+
+    def __missing__(self, value_type):
+        return encode
+
+
+ENCODERS = EncoderMap({
+    str: encode_string,
+    int: int.__repr__,
+    float: float.__repr__,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+    datetime: encode_datetime,
+    date: encode_date,
+    dict: encode_dict,
+    list: encode_list,
+    tuple: encode_list,
+})
+
+
+def encode(value):
+    """
+    Encode the value as json, with the encoder of its type.
+
+    The objects without a compiled encoder are encoded with the dict of their to_dict method.
+
+    Raises:
+        TypeError: The type of the value can not be encoded.
+    """
+    encoder = ENCODERS.get(type(value))
+    if encoder is not None:
+        return encoder(value)
+
+    for value_type, encoder in list(ENCODERS.items()):
+        if isinstance(value, value_type):
+            return encoder(value)
+
+    if hasattr(value, 'to_dict'):
+        return encode_dict(value.to_dict())
+
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def compile_object_encoder(fields):
+    """
+    Return the encoder of the objects of a class, with the keys sorted as the encoded dicts.
+
+    Args:
+        fields (dict): Json keys and the names of the attributes with their values.
+
+    Returns:
+        (callable): Function that encodes an object.
+    """
+    keys = sorted(fields)
+    template = '{' + ','.join(encode_string(key).replace('%', '%%') + ':%s' for key in keys) + '}'
+    getter = attrgetter(*(fields[key] for key in keys))
+
+    def encode_object(value):
+        return template % tuple([ENCODERS[type(item)](item) for item in getter(value)])
+
+    return encode_object
+
+
+def object_to_dict(fields):
+    """Return the function that reads the attributes of an object as a dict, used by orjson."""
+    keys = list(fields)
+    getter = attrgetter(*(fields[key] for key in keys))
+    return lambda value: dict(zip(keys, getter(value)))
+
+
+ENCODERS[PhoneBill] = compile_object_encoder(PHONE_BILL_FIELDS)
+ENCODERS[PhoneBillCall] = compile_object_encoder(PHONE_BILL_CALL_FIELDS)
+
+ORJSON_DEFAULTS = {
+    PhoneBill: object_to_dict(PHONE_BILL_FIELDS),
+    PhoneBillCall: object_to_dict(PHONE_BILL_CALL_FIELDS),
+    datetime: format_http_date,
+    date: format_http_date,
+}
+
+
+def orjson_default(value):
+    """Convert the values that orjson does not encode as jsonify."""
+    converter = ORJSON_DEFAULTS.get(type(value))
+    if converter is not None:
+        return converter(value)
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def dumps(value):
+    """
+    Encode the value as json, with the same bytes of jsonify out of the debug mode.
+
+    Args:
+        value (any): Value with dicts, lists, the json types, dates and models.
+
+    Returns:
+        (bytes): Json document encoded as ascii.
+    """
+    if orjson is not None:
+        options = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        result = orjson.dumps(value, default=orjson_default, option=options)
+        try:
+            # orjson does not escape the non ascii characters, these documents are encoded by the python encoders
+            result.decode('ascii')
+            return result
+        except UnicodeDecodeError:
+            pass
+
+    return encode(value).encode('ascii')
+
+
+def json_response(value):
+    """
+    Return a json response of the value, the same of jsonify.
+
+    The debug mode keeps jsonify, that indents the documents.
+    """
+    if current_app.debug:
+        return jsonify(json.loads(dumps(value).decode('ascii')))
+
+    return current_app.response_class(dumps(value) + b'\n', mimetype='application/json')
+
+
+class BillWriter:
+    """
+    Writer of the successful response of a phone bill to a file, chunk by chunk of its calls.
+
+    The bytes are the same of json_response with the bill: the calls are the first of the sorted keys, so they
+    are written as they are rated, and the total, known only after the last chunk, is written by finish.
+    """
+
+    def __init__(self, fileobj, phone_bill):
+        """
+        Start the response on the file.
+
+        Args:
+            fileobj (file): Binary file where the response is written.
+            phone_bill (PhoneBill): Bill of the response, read by finish.
+        """
+        self.fileobj = fileobj
+        self.phone_bill = phone_bill
+        self.separator = ''
+        self.encode_call = ENCODERS[PhoneBillCall]
+        fileobj.write(b'{"data":{"calls":[')
+
+    def write_calls(self, phone_bill_calls):
+        """Write the calls of a chunk of the bill."""
+        if phone_bill_calls:
+            encoded = ','.join([self.encode_call(phone_bill_call) for phone_bill_call in phone_bill_calls])
+            self.fileobj.write((self.separator + encoded).encode('ascii'))
+            self.separator = ','
+
+    def finish(self):
+        """Write the rest of the bill, after all its calls."""
+        self.fileobj.write(('],"period":%s,"subscriber":%s,"total":%s},"success":true}\n' % (
+            encode(self.phone_bill.period), encode(self.phone_bill.phone_number), encode(self.phone_bill.total)
+        )).encode('ascii'))
+
+
+def file_response(fileobj, memory_size):
+    """
+    Return the json response with the body written on the file, that is closed with the response.
+
+    Args:
+        fileobj (file): Binary file with the body, positioned at its end.
+        memory_size (int): Bodies up to this size are read into the response (indented on the debug mode), the
+            bigger ones are streamed from the file.
+
+    Returns:
+        (flask.Response): The json response.
+    """
+    size = fileobj.tell()
+    fileobj.seek(0)
+    if size <= memory_size:
+        with fileobj:
+            body = fileobj.read()
+        if current_app.debug:
+            return jsonify(json.loads(body.decode('ascii')))
+        return current_app.response_class(body, mimetype='application/json')
+
+    response = current_app.response_class(FileWrapper(fileobj, STREAM_BLOCK_SIZE), mimetype='application/json')
+    response.content_length = size
+    return response
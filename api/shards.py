@@ -0,0 +1,359 @@
+"""Sharding of the subscribers data across many database files.
+
+When the DATABASE_SHARDS config is set, the call records and the bills of each subscriber are stored on
+one shard file, chosen by a consistent hash of the normalized phone number, so the requests of different
+subscribers use different files and write locks. The end records do not have the subscriber: they are
+stored on the shard of their start record or, while the start was not received, on a pending shard chosen
+by the hash of the call id, and are moved to the shard of the subscriber when the start arrives.
+
+The shard used by the models is selected with db.use_shard, and get_db returns the connection of the
+selected shard, or of the DATABASE file when no shard is selected.
+"""
+import bisect
+import hashlib
+import os
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+
+from api import constants, pairs, partitions, queries
+from api.cache import LRUCache
+from api.db import create_schema, get_db, shard_names, shard_path, use_shard
+from api.utils import normalize_phone_number
+from api.writer import run_write
+
+
+SHARD_REPLICAS = 64
+
+CALL_FIELDS = (
+    'record_id', 'record_type', 'record_timestamp', 'call_identifier', 'origin_number', 'destination_number',
+    'origin_key', 'destination_key',
+)
+
+
+def hash_key(value):
+    """Return the position of the value on the ring, a 64 bits integer."""
+    return int.from_bytes(hashlib.md5(str(value).encode('utf8')).digest()[:8], 'big')
+
+
+class ShardRing:
+    """
+    Consistent hash ring of the shards.
+
+    Each shard has many points on the ring, and a key belongs to the shard of the first point after its
+    hash, so adding or removing a shard only moves the keys of the points next to it.
+    """
+
+    def __init__(self, names, replicas=SHARD_REPLICAS):
+        """Constructor used to create the ring with the names of the shards."""
+        self.names = list(names)
+        points = sorted(
+            (hash_key('{}#{}'.format(name, replica)), name) for name in self.names for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def get(self, key):
+        """Return the name of the shard of the key."""
+        index = bisect.bisect(self._hashes, hash_key(key)) % len(self._hashes)
+        return self._names[index]
+
+
+def get_ring():
+    """Return the ring of the shards of the app, or None when the sharding is disabled."""
+    if not has_app_context():
+        return None
+
+    return current_app.extensions.get('shard_ring')
+
+
+def subscriber_shard(phone_key):
+    """Return the shard of the subscriber, or None when the sharding is disabled."""
+    ring = get_ring()
+    return ring.get('subscriber:{}'.format(phone_key)) if ring else None
+
+
+def pending_shard(call_identifier):
+    """Return the shard of the end records of the call while its start record was not received."""
+    ring = get_ring()
+    return ring.get('call:{}'.format(call_identifier)) if ring else None
+
+
+def get_start_shards():
+    """Return the cache of the shards of the start records seen by the process, or None when it is disabled."""
+    if not has_app_context():
+        return None
+
+    return current_app.extensions.get('start_shards')
+
+
+def find_start_shard(call_identifier):
+    """
+    Return the shard that has the start record of the call, or None if it was not received yet.
+
+    The shard of the start records routed or found by the process is cached, so it is queried first, and the
+    other shards are only queried when it is not cached (e.g. the start was received by other worker) or when
+    the start is not there anymore (e.g. moved by a rebalance).
+    """
+    ring = get_ring()
+    start_shards = get_start_shards()
+    cached = start_shards.get(call_identifier, None) if start_shards is not None else None
+    names = ring.names if cached not in ring.names else [cached] + [name for name in ring.names if name != cached]
+
+    for name in names:
+        with use_shard(name):
+            # the write connection is used, so the records written and not committed yet are found
+            result = get_db().execute(queries.EXISTS_CALL_ID, [call_identifier, constants.RECORD_TYPE_START, None])
+            if result.fetchone():
+                if start_shards is not None and name != cached:
+                    start_shards.put(call_identifier, name)
+                return name
+
+    return None
+
+
+def record_shard(record_type, call_identifier, origin_number):
+    """
+    Return the shard where the call record should be stored.
+
+    Args:
+        record_type (str): Type of the record.
+        call_identifier (int): Call id of the record.
+        origin_number (str): Phone number of the subscriber, only given on the start records.
+
+    Returns:
+        (str/None): Name of the shard, or None when the sharding is disabled.
+    """
+    if get_ring() is None:
+        return None
+
+    if record_type == constants.RECORD_TYPE_START:
+        shard = subscriber_shard(normalize_phone_number(origin_number))
+        start_shards = get_start_shards()
+        if start_shards is not None:
+            start_shards.put(call_identifier, shard)
+        return shard
+
+    return find_start_shard(call_identifier) or pending_shard(call_identifier)
+
+
+def get_shard_names():
+    """Return the names of the shards, or a list with None (the DATABASE file) when the sharding is disabled."""
+    ring = get_ring()
+    return ring.names if ring else [None]
+
+
+def scatter(job, readonly=False):
+    """
+    Execute the job with the connection of each shard, used by the jobs that read or write all the subscribers.
+
+    Args:
+        job (callable): Function that receives the connection.
+        readonly (bool): Use the read only connections.
+
+    Returns:
+        (list): Values returned by the job on each shard, or a list with the value returned on the DATABASE file
+            when the sharding is disabled.
+    """
+    results = []
+    for name in get_shard_names():
+        with use_shard(name):
+            results.append(job(get_db(readonly=readonly)))
+
+    return results
+
+
+def copy_call_rows(db, rows):
+    """
+    Insert the rows of the phone_call table read from other shard, without committing.
+
+    The rows whose call id and record type are already on this shard are skipped, so a copy interrupted
+    before the rows were deleted from the other shard can be repeated.
+    """
+    for row in rows:
+        values = dict(row)
+        if db.execute(queries.EXISTS_CALL_ID, [values['call_identifier'], values['record_type'], None]).fetchone():
+            continue
+
+        table_name = partitions.write_table(db, values['record_timestamp'])
+        # the ids are kept when they are not used on this shard, the others receive new ids
+        exists_id = queries.exists_id(partitions.CALLS_TABLE, 'record_id')
+        if values['record_id'] and db.execute(exists_id, [values['record_id']]).fetchone():
+            values['record_id'] = None
+        if not values['record_id'] and table_name != partitions.CALLS_TABLE:
+            values['record_id'] = partitions.next_record_id(db)
+
+        fields = tuple(field for field in CALL_FIELDS if field != 'record_id' or values[field])
+        db.execute(queries.insert(table_name, fields), [values[field] for field in fields])
+        pairs.track_record(db, values['call_identifier'], values['record_type'], values['record_timestamp'])
+
+
+def delete_call_rows(db, rows):
+    """Delete the rows of the phone_call table, without committing."""
+    for row in rows:
+        table_name = partitions.table_for(db, row['record_timestamp'])
+        db.execute(queries.delete_by_id(table_name, 'record_id'), [row['record_id']])
+        pairs.untrack_record(db, row['call_identifier'], row['record_type'])
+
+
+def move_call_rows(rows, source, target):
+    """Move the rows of the phone_call table between the shards, committing first on the target shard."""
+    with use_shard(target):
+        run_write(lambda db: copy_call_rows(db, rows), get_db)
+    with use_shard(source):
+        run_write(lambda db: delete_call_rows(db, rows), get_db)
+
+
+def claim_pending_end(call_identifier, shard):
+    """Move the end record of the call from its pending shard to the shard of its start record."""
+    pending = pending_shard(call_identifier)
+    if pending is None or pending == shard:
+        return
+
+    with use_shard(pending):
+        rows = get_db().execute(queries.SELECT_CALL_RECORD, [call_identifier, constants.RECORD_TYPE_END]).fetchall()
+    if rows:
+        move_call_rows(rows, pending, shard)
+
+
+def settle_pending_end(call_identifier, shard):
+    """
+    Move the end record of the call saved on its pending shard to the shard of its start record, if it was found.
+
+    The start record may be committed after the end record was routed, e.g. by a concurrent request or by a
+    record before it on the same batch, when its claim did not find the end record yet.
+
+    Returns:
+        (str): Shard where the end record is stored.
+    """
+    if shard != pending_shard(call_identifier):
+        return shard
+
+    start_shard = find_start_shard(call_identifier)
+    if start_shard is None or start_shard == shard:
+        return shard
+
+    claim_pending_end(call_identifier, start_shard)
+    return start_shard
+
+
+def move_bills(rows, source, target):
+    """Move the bills, and their calls, between the shards, committing first on the target shard."""
+    def copy(db):
+        for row in rows:
+            bill = dict(row)
+            if db.execute(queries.SELECT_PERIOD_BILL, [bill['period'], bill['phone_key']]).fetchone():
+                continue
+
+            calls = bill.pop('calls')
+            bill_id = db.execute(
+                queries.insert('phone_bill', ('phone_number', 'period', 'phone_key')),
+                [bill['phone_number'], bill['period'], bill['phone_key']]
+            ).lastrowid
+            for call in calls:
+                call = dict(call, bill_id=bill_id)
+                fields = tuple(field for field in call if field != 'id')
+                db.execute(queries.insert('phone_bill_call', fields), [call[field] for field in fields])
+
+    def delete(db):
+        for row in rows:
+            db.execute(queries.delete_by_id('phone_bill_call', 'bill_id'), [row['id']])
+            db.execute(queries.delete_by_id('phone_bill', 'id'), [row['id']])
+
+    with use_shard(target):
+        run_write(copy, get_db)
+    with use_shard(source):
+        run_write(delete, get_db)
+
+
+def rebalance_shard(source, ring):
+    """
+    Move the subscribers of the shard that belong to other shards on the ring.
+
+    Returns:
+        (tuple): Number of subscribers and number of end records without start record moved.
+    """
+    with use_shard(source):
+        db = get_db()
+        keys = [row[0] for row in db.execute(queries.SELECT_SHARD_SUBSCRIBERS, [constants.RECORD_TYPE_START])]
+
+    subscribers = 0
+    for key in keys:
+        target = ring.get('subscriber:{}'.format(key))
+        if target == source:
+            continue
+
+        with use_shard(source):
+            db = get_db()
+            starts = db.execute(queries.SELECT_SUBSCRIBER_RECORDS, [constants.RECORD_TYPE_START, key]).fetchall()
+            ends = [
+                row for start in starts
+                for row in db.execute(queries.SELECT_CALL_RECORD, [start['call_identifier'], constants.RECORD_TYPE_END])
+            ]
+            bills = [
+                dict(bill, calls=[dict(call) for call in db.execute(queries.SELECT_BILL_CALLS, [bill['id']])])
+                for bill in db.execute(queries.SELECT_SUBSCRIBER_BILLS, [key])
+            ]
+
+        move_call_rows(starts + ends, source, target)
+        move_bills(bills, source, target)
+        subscribers += 1
+
+    return subscribers
+
+
+def rebalance_pending(source, ring):
+    """Move the end records of the shard whose start records are on other shards."""
+    with use_shard(source):
+        rows = get_db().execute(queries.SELECT_PENDING_RECORDS, [constants.RECORD_TYPE_END]).fetchall()
+
+    moved = 0
+    for row in rows:
+        target = find_start_shard(row['call_identifier']) or ring.get('call:{}'.format(row['call_identifier']))
+        if target != source:
+            move_call_rows([row], source, target)
+            moved += 1
+
+    return moved
+
+
+@click.command('rebalance-shards')
+@click.option('--previous', type=int, required=True, help='Number of shards before the change of DATABASE_SHARDS.')
+@with_appcontext
+def rebalance_shards_command(previous):
+    """Move the subscribers to their shards after a change of the DATABASE_SHARDS config."""
+    ring = get_ring()
+    if ring is None:
+        raise click.ClickException('The sharding is disabled, set the DATABASE_SHARDS config.')
+
+    for name in ring.names:
+        if not os.path.exists(shard_path(current_app, name)):
+            with use_shard(name):
+                create_schema(get_db())
+            click.echo('{}: created.'.format(name))
+
+    names = [
+        name for name in shard_names(max(previous, len(ring.names)))
+        if os.path.exists(shard_path(current_app, name))
+    ]
+    for name in names:
+        click.echo('{}: {} subscribers moved.'.format(name, rebalance_shard(name, ring)))
+    for name in names:
+        click.echo('{}: {} pending end records moved.'.format(name, rebalance_pending(name, ring)))
+
+    for name in names:
+        if name not in ring.names:
+            click.echo('{} is not used anymore and can be removed: {}'.format(name, shard_path(current_app, name)))
+
+
+def init_app(app):
+    """
+    Create the ring of the shards when the sharding is enabled by the DATABASE_SHARDS config, and the cache of
+    the shards of the start records with the size of the DATABASE_SHARD_CACHE_SIZE config.
+    """
+    count = app.config['DATABASE_SHARDS']
+    size = app.config['DATABASE_SHARD_CACHE_SIZE']
+    app.extensions['shard_ring'] = ShardRing(shard_names(count)) if count else None
+    app.extensions['start_shards'] = LRUCache(size) if count and size else None
+    app.cli.add_command(rebalance_shards_command)
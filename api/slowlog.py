@@ -0,0 +1,245 @@
+"""Log of the slow requests, with what they read and the memory they used.
+
+When the SLOW_REQUEST_THRESHOLD config is set, the requests that take longer than that number of seconds are
+logged and appended as json lines to SLOW_REQUEST_FILE (default instance/slow_requests.jsonl), with their
+route, the subscriber and the period of the bill, the size of the payload, the statements executed and the rows
+read and written (from the query log of the request), the calls rated and the memory used by the request. The
+memory is the peak of the memory allocated while the request ran, traced by tracemalloc when
+SLOW_REQUEST_TRACEMALLOC is enabled, otherwise how much the request raised the peak RSS of the process, that is
+zero unless the request needed more memory than any request before it. Both are of the whole process, so the
+memory is only measured for the requests that ran alone on the process: it is None for the requests that
+overlapped others, whose allocations could not be told apart.
+
+The `flask slow-requests` command aggregates the log into the top offenders, by route, subscriber or period.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import click
+from flask import current_app, g, has_app_context, request
+from flask.cli import with_appcontext
+
+from api import metrics
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # not available on windows, the memory is only traced by tracemalloc there
+    resource = None
+
+
+AGGREGATE_KEYS = ('route', 'subscriber', 'period')
+SORT_FIELDS = ('duration', 'memory', 'calls', 'queries', 'rows_read', 'rows_written')
+# the ru_maxrss is in kilobytes on linux and in bytes on macos
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+_lock = threading.Lock()
+# the requests in progress and the requests started on the process, to know which ones ran alone
+_memory_lock = threading.Lock()
+_active = 0
+_started = 0
+
+
+def get_path(app):
+    """Return the path of the slow request log of the app."""
+    return app.config['SLOW_REQUEST_FILE'] or os.path.join(app.instance_path, 'slow_requests.jsonl')
+
+
+def get_peak_rss():
+    """Return the peak RSS of the process in bytes, or None when it is not available."""
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+def start_memory():
+    """
+    Start the measure of the memory of the request.
+
+    The peak of tracemalloc is of the whole process, so it is only reset when no other request is in progress,
+    otherwise the request would erase the peak of the others.
+
+    Returns:
+        (tuple): Source of the measure (tracemalloc or rss), the memory at the start, in bytes, and the number of
+            the request on the process, or None when other request is in progress.
+    """
+    global _active, _started
+    with _memory_lock:
+        _active += 1
+        _started += 1
+        sequence = _started if _active == 1 else None
+        if tracemalloc.is_tracing():
+            # without reset_peak (before python 3.9) the peak is the one since the tracing started
+            if sequence is not None and hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            return 'tracemalloc', tracemalloc.get_traced_memory()[0], sequence
+
+    return 'rss', get_peak_rss(), sequence
+
+
+def finish_memory(source, start, sequence):
+    """
+    Finish the measure of the memory of the request.
+
+    Returns:
+        (int/None): The memory used since the start of the measure, in bytes, or None when it is not available
+            or when other request ran at the same time.
+    """
+    global _active
+    with _memory_lock:
+        _active -= 1
+        alone = sequence is not None and sequence == _started
+    if start is None or not alone:
+        return None
+    if source == 'tracemalloc':
+        return max(tracemalloc.get_traced_memory()[1] - start, 0) if tracemalloc.is_tracing() else None
+
+    return get_peak_rss() - start
+
+
+def note(**values):
+    """Add the values (e.g. the calls rated) to the entry of the request, when the slow request log is enabled."""
+    entry = g.get('slow_request') if has_app_context() else None
+    if entry is not None:
+        entry.update(values)
+
+
+def start_request():
+    """Start the measure of the request, when the slow request log is enabled."""
+    if not current_app.config['SLOW_REQUEST_THRESHOLD']:
+        return
+
+    g.slow_request = {}
+    g.slow_request_memory = start_memory()
+    g.slow_request_start = time.perf_counter()
+
+
+def save_status(response):
+    """Save the status and the size of the response, that are not known by the teardown of the request."""
+    if 'slow_request' in g:
+        g.slow_request.update(status=response.status_code, response_size=response.content_length)
+
+    return response
+
+
+def finish_request(exception=None):
+    """Log the request when it took longer than the SLOW_REQUEST_THRESHOLD config."""
+    if 'slow_request_start' not in g:
+        return
+
+    duration = time.perf_counter() - g.pop('slow_request_start')
+    source, start, sequence = g.pop('slow_request_memory')
+    memory = finish_memory(source, start, sequence)
+    noted = g.pop('slow_request')
+    if duration < current_app.config['SLOW_REQUEST_THRESHOLD']:
+        return
+
+    route = request.url_rule.rule if request.url_rule is not None else request.path
+    query_log = g.get('query_log')
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'method': request.method,
+        'route': route,
+        'status': 500,
+        'duration': round(duration, 6),
+        'subscriber': request.args.get('subscriber'),
+        'period': request.args.get('period'),
+        'payload_size': request.content_length,
+        'queries': query_log.count if query_log is not None else None,
+        'rows_read': query_log.rows_read if query_log is not None else None,
+        'rows_written': query_log.rows_written if query_log is not None else None,
+        'calls': None,
+        'memory': memory,
+        'memory_source': source,
+        'trace_id': g.trace.trace_id if 'trace' in g else None,
+    }
+    entry.update(noted)
+    if exception is not None:
+        entry['error'] = repr(exception)
+
+    current_app.logger.warning(
+        'Slow request %s %s: %.3fs, %s statements, %s rows read, %s rows written, %s calls, %s bytes of memory',
+        request.method, request.full_path, duration, entry['queries'], entry['rows_read'], entry['rows_written'],
+        entry['calls'], memory
+    )
+    with _lock, open(get_path(current_app), 'a') as f:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+    metrics.inc(metrics.SLOW_REQUESTS, 1, (route, request.method))
+
+
+def read_log(path):
+    """Generate the entries of the slow request log, skipping the lines that are not valid (e.g. partial)."""
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def aggregate(entries, key, field, top):
+    """
+    Aggregate the slow requests into the top offenders.
+
+    Args:
+        entries (iterable): Entries of the slow request log.
+        key (str): Field that groups the requests, one of AGGREGATE_KEYS.
+        field (str): Field that orders the groups by its maximum, one of SORT_FIELDS.
+        top (int): Maximum number of groups returned.
+
+    Returns:
+        (list): Groups with the key, the number of requests, the total duration and the maximum of each field.
+    """
+    groups = OrderedDict()
+    for entry in entries:
+        name = entry.get(key) or '-'
+        group = groups.get(name)
+        if group is None:
+            group = groups[name] = dict({key: name, 'requests': 0, 'total_duration': 0}, **dict.fromkeys(SORT_FIELDS))
+        group['requests'] += 1
+        group['total_duration'] += entry.get('duration') or 0
+        for column in SORT_FIELDS:
+            value = entry.get(column)
+            if value is not None and (group[column] is None or value > group[column]):
+                group[column] = value
+
+    return sorted(groups.values(), key=lambda group: -(group[field] or 0))[:top]
+
+
+@click.command('slow-requests')
+@click.option('--by', 'key', type=click.Choice(AGGREGATE_KEYS), default='subscriber', show_default=True,
+              help='Field that groups the requests.')
+@click.option('--sort', 'field', type=click.Choice(SORT_FIELDS), default='memory', show_default=True,
+              help='Field whose maximum orders the groups.')
+@click.option('--top', default=10, show_default=True, help='Number of groups listed.')
+@click.option('--file', 'path', type=click.Path(), help='Slow request log, by default the one of the app.')
+@with_appcontext
+def slow_requests_command(key, field, top, path):
+    """List the top offenders of the slow request log."""
+    path = path or get_path(current_app)
+    if not os.path.exists(path):
+        raise click.ClickException('The slow request log {} does not exist.'.format(path))
+
+    click.echo('{:<24} {:>8} {:>10} {:>10} {:>10} {:>9} {:>8} {:>10} {:>10}'.format(
+        key, 'requests', 'total (s)', 'max (s)', 'memory MB', 'calls', 'queries', 'rows read', 'written'
+    ))
+    for group in aggregate(read_log(path), key, field, top):
+        click.echo('{:<24} {:>8} {:>10.3f} {:>10.3f} {:>10} {:>9} {:>8} {:>10} {:>10}'.format(
+            group[key], group['requests'], group['total_duration'], group['duration'] or 0,
+            '-' if group['memory'] is None else '{:.1f}'.format(group['memory'] / 1048576),
+            *('-' if group[name] is None else group[name] for name in ('calls', 'queries', 'rows_read', 'rows_written'))
+        ))
+
+
+def init_app(app):
+    """Start tracemalloc when the SLOW_REQUEST_TRACEMALLOC config is enabled, and add the slow-requests command."""
+    if app.config['SLOW_REQUEST_THRESHOLD'] and app.config['SLOW_REQUEST_TRACEMALLOC'] and \
+            not tracemalloc.is_tracing():
+        tracemalloc.start()
+    app.cli.add_command(slow_requests_command)
@@ -0,0 +1,217 @@
+"""Tracing of the stages of the requests, without an external collector.
+
+When the TRACING config is enabled, each traced request has a root span and the spans of its stages (e.g. the
+validation, the reads, the pairing, the rating and the persistence of a bill, or the validation and the
+persistence of the records of a request), with their duration and their parent. The trace id and the parent
+span are taken from the traceparent header (W3C Trace Context) when the request has it, so the spans join the
+trace of the caller, and the trace id is returned on the X-Trace-Id header. The spans are kept on a ring buffer
+of the last TRACING_BUFFER_SIZE spans of the process, listed by the traces endpoint, and appended as json lines
+to TRACING_FILE when it is set.
+
+The requests without the header are traced one in every TRACING_SAMPLE, the other ones follow the sampled
+flag of the header.
+"""
+import functools
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+
+
+TRACE_HEADER = 'traceparent'
+TRACE_ID_HEADER = 'X-Trace-Id'
+TRACEPARENT_PATTERN = re.compile(r'^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_requests = itertools.count()
+
+
+def new_id(bits):
+    """Return a random id with the number of bits, as hex."""
+    return '{:0{}x}'.format(random.getrandbits(bits), bits // 4)
+
+
+def parse_traceparent(value):
+    """
+    Parse the traceparent header.
+
+    Args:
+        value (str): Value of the header, e.g. 00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01.
+
+    Returns:
+        (tuple/None): Trace id, parent span id and sampled flag, or None when the value is invalid.
+    """
+    match = TRACEPARENT_PATTERN.match((value or '').strip().lower())
+    if match is None:
+        return None
+
+    trace_id, parent_id, flags = match.groups()
+    if trace_id == '0' * 32 or parent_id == '0' * 16:
+        return None
+
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+class Span:
+    """Stage of a request, with its duration and its parent span."""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'duration', 'attributes', '_started')
+
+    def __init__(self, trace_id, parent_id, name, attributes):
+        """Constructor used to start the span."""
+        self.trace_id = trace_id
+        self.span_id = new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.attributes = attributes
+        self._started = time.perf_counter()
+
+    def finish(self):
+        """Finish the span, saving its duration."""
+        self.duration = time.perf_counter() - self._started
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+        }
+
+
+class Trace:
+    """Spans of a request, with the stack of the spans in progress."""
+
+    def __init__(self, trace_id, parent_id=None):
+        """Constructor used to create the trace without spans."""
+        self.trace_id = trace_id
+        self.spans = []
+        self.stack = [parent_id]
+
+    def start(self, name, attributes):
+        """Start a span, child of the innermost span in progress."""
+        span = Span(self.trace_id, self.stack[-1], name, attributes)
+        self.stack.append(span.span_id)
+        return span
+
+    def finish(self, span):
+        """Finish the span, that is the innermost span in progress."""
+        span.finish()
+        self.stack.pop()
+        self.spans.append(span)
+
+
+class Tracer:
+    """Exporter of the spans of the process, to the ring buffer and to the json lines file."""
+
+    def __init__(self, buffer_size, path=None):
+        """Constructor used to create the exporter with an empty buffer."""
+        self.spans = deque(maxlen=buffer_size)
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        """Export the finished spans of a trace."""
+        spans = [span.to_dict() for span in spans]
+        self.spans.extend(spans)
+        if self.path:
+            lines = ''.join(json.dumps(span, sort_keys=True) + '\n' for span in spans)
+            with self._lock, open(self.path, 'a') as f:
+                f.write(lines)
+
+    def list_spans(self, trace_id=None, limit=None):
+        """Return the spans of the buffer, of the trace if it is given, the most recent last."""
+        spans = [span for span in list(self.spans) if trace_id is None or span['trace_id'] == trace_id]
+        return spans[-limit:] if limit else spans
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Record the block as a span of the trace of the request. Nothing is recorded when the request is not traced.
+
+    Yields:
+        (Span/None): The span in progress, whose attributes can be changed by the block.
+    """
+    trace = g.get('trace') if has_app_context() else None
+    if trace is None:
+        yield None
+        return
+
+    current = trace.start(name, attributes)
+    try:
+        yield current
+    finally:
+        trace.finish(current)
+
+
+def traced(name):
+    """Decorator that records each call of the function as a span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request():
+    """Start the trace of the request and its root span, when the request is traced."""
+    if current_app.extensions.get('tracer') is None:
+        return
+
+    parent = parse_traceparent(request.headers.get(TRACE_HEADER))
+    if parent is not None:
+        trace_id, parent_id, sampled = parent
+    else:
+        trace_id, parent_id = new_id(128), None
+        sample = current_app.config['TRACING_SAMPLE']
+        sampled = bool(sample) and next(_requests) % sample == 0
+    if not sampled:
+        return
+
+    g.trace = Trace(trace_id, parent_id)
+    g.trace_root = g.trace.start('{} {}'.format(request.method, request.path), {})
+
+
+def add_trace_header(response):
+    """Return the trace id of the request on the X-Trace-Id header."""
+    if 'trace' in g:
+        response.headers[TRACE_ID_HEADER] = g.trace.trace_id
+        g.trace_root.attributes['status'] = response.status_code
+
+    return response
+
+
+def finish_request(exception=None):
+    """Finish the root span of the request and export the spans of its trace."""
+    trace = g.pop('trace', None)
+    if trace is None:
+        return
+
+    root = g.pop('trace_root')
+    if request.url_rule is not None:
+        root.attributes['route'] = request.url_rule.rule
+    if exception is not None:
+        root.attributes['error'] = repr(exception)
+    # the spans of the stages are finished by their blocks even on failures, only the root is in progress
+    trace.finish(root)
+    current_app.extensions['tracer'].export(trace.spans)
+
+
+def init_app(app):
+    """Create the exporter of the spans when the tracing is enabled by the TRACING config."""
+    app.extensions['tracer'] = Tracer(
+        app.config['TRACING_BUFFER_SIZE'], app.config['TRACING_FILE']
+    ) if app.config.get('TRACING') else None
@@ -1,7 +1,13 @@
 """Utils functions used to help in common operations."""
+import re
 from datetime import datetime
 
 
+PHONE_NUMBER_FORMATTING = re.compile(r'[\s().+-]')
+# only the ascii digits, str.isdigit also accepts the other digits of unicode (e.g. superscripts)
+PHONE_NUMBER_DIGITS = re.compile(r'[0-9]{10,11}')
+
+
 def get_date_or_none(value):
     """
     Return the value converted as datetime type or None.
@@ -53,9 +59,36 @@ def get_int_or_none(value):
         return None
 
 
-def is_valid_phone_number(number):
-    """Check if the phone number is in the valid format."""
+def normalize_phone_number(number):
+    """
+    Return the canonical integer key of a phone number or None.
+
+    The formatting characters (spaces, dots, dashes, parenthesis and the plus sign) are
+    ignored, so the same number received in different formats is mapped to the same key.
+
+    Args:
+        number (str/int): Phone number to be normalized.
+
+    Returns:
+        (int/None): The digits of the number as an integer, that fits in a 64 bits column.
+            The numbers with leading zeros have a negative key with a 1 before the digits, so
+            they are not mapped to the key of the same digits with other number of zeros
+            (e.g. 0119999999 and 00119999999). If the number is not in the valid format will
+            return None.
+    """
     if not number:
-        return False
+        return None
+
+    digits = PHONE_NUMBER_FORMATTING.sub('', str(number))
+    if not PHONE_NUMBER_DIGITS.fullmatch(digits):
+        return None
+
+    if digits[0] == '0':
+        return -int('1' + digits)
 
-    return 10 <= len(str(number)) <= 11
+    return int(digits)
+
+
+def is_valid_phone_number(number):
+    """Check if the phone number is in the valid format."""
+    return normalize_phone_number(number) is not None
@@ -0,0 +1,242 @@
+"""Coordination of the writes on the database."""
+import atexit
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from flask import current_app, has_app_context
+
+
+WRITE_RETRIES = 5
+WRITE_BACKOFF = 0.05
+
+
+class WriteError(Exception):
+    """Raised when a write could not be done, because the database stayed locked or the writer is busy."""
+
+
+def is_locked_error(error):
+    """Check if the sqlite error was caused by other connection holding the lock of the database."""
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def run_with_retry(job, db, retries=WRITE_RETRIES, backoff=WRITE_BACKOFF, on_retry=None):
+    """
+    Run the write job with the connection and commit it, retrying while the database is locked.
+
+    Args:
+        job (callable): Function that receives the connection and executes the writes, without committing.
+        db (sqlite3.Connection): Connection used by the job.
+        retries (int): Maximum number of retries.
+        backoff (float): Base of the exponential wait between the retries, in seconds. The wait is jittered
+            so the workers that failed together do not retry together.
+        on_retry (callable): Function called before each retry.
+
+    Returns:
+        The value returned by the job.
+
+    Raises:
+        WriteError: The database was still locked after all the retries.
+    """
+    for attempt in range(retries + 1):
+        try:
+            result = job(db)
+            db.commit()
+            return result
+        except sqlite3.OperationalError as error:
+            db.rollback()
+            if not is_locked_error(error):
+                raise
+            if attempt == retries:
+                raise WriteError(str(error)) from error
+        except BaseException:
+            # the writes of a failed job are never left on the connection, to be committed by the next job
+            db.rollback()
+            raise
+
+        if on_retry:
+            on_retry()
+        time.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+
+class WriteCoordinator:
+    """
+    Writer thread that executes all the writes of the process with its own connection.
+
+    The requests put the write jobs on a bounded queue and wait for their results, so only one connection
+    by process competes for the write lock of the database, instead of one by request. The jobs already on
+    the queue are written before the process exits.
+    """
+
+    def __init__(self, app):
+        """Constructor used to create the coordinator of the app, the thread is started on the first write."""
+        self.app = app
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.max_queue_depth = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _start(self):
+        """Start the writer thread of the current process, stopped when the process exits."""
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.app.config['WRITE_QUEUE_SIZE'])
+        self._thread = threading.Thread(target=self._worker, args=(self._queue,), name='db-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, job):
+        """
+        Put the write job on the queue of the writer thread.
+
+        Args:
+            job (callable): Function that receives the connection and executes the writes, without committing.
+
+        Returns:
+            (Future): Future of the value returned by the job.
+
+        Raises:
+            WriteError: The queue stayed full for more than the WRITE_TIMEOUT config.
+        """
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._start()
+
+        future = Future()
+        try:
+            self._queue.put((job, future), timeout=self.app.config['WRITE_TIMEOUT'])
+        except queue.Full:
+            with self._lock:
+                self.timeouts += 1
+            raise WriteError('The write queue is full.')
+
+        with self._lock:
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+        return future
+
+    def run(self, job):
+        """
+        Execute the write job on the writer thread, waiting for its result.
+
+        A job that is not done in time raises WriteError, but is still executed by the writer thread.
+        """
+        future = self.submit(job)
+        try:
+            return future.result(timeout=self.app.config['WRITE_TIMEOUT'])
+        except FutureTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise WriteError('The write was not done in time.')
+
+    def _count_retry(self):
+        """Count a retry of a write."""
+        with self._lock:
+            self.retries += 1
+
+    def stop(self, timeout=None):
+        """
+        Stop the writer thread of the current process after the jobs already on the queue.
+
+        Args:
+            timeout (float): Maximum time waiting for the jobs to be written, the WRITE_TIMEOUT config if not given.
+        """
+        if self._pid != os.getpid():
+            return
+
+        timeout = self.app.config['WRITE_TIMEOUT'] if timeout is None else timeout
+        with self._lock:
+            self._pid = None
+            thread = self._thread
+        try:
+            self._queue.put((None, None), timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def _worker(self, jobs):
+        """Execute the jobs of the queue, one at a time."""
+        config = self.app.config
+        manager = self.app.extensions['db']
+        db = manager.connect(config['DATABASE'])
+        while True:
+            job, future = jobs.get()
+            if job is None:
+                manager.close(db)
+                return
+
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                result = run_with_retry(
+                    job, db, config['WRITE_RETRIES'], config['WRITE_BACKOFF'], on_retry=self._count_retry
+                )
+            except Exception as error:
+                with self._lock:
+                    self.failed += 1
+                future.set_exception(error)
+            else:
+                with self._lock:
+                    self.completed += 1
+                future.set_result(result)
+
+    def stats(self):
+        """Return the queue depth and the counters of the writes."""
+        return {
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+            'max_queue_depth': self.max_queue_depth,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retries': self.retries,
+            'timeouts': self.timeouts,
+        }
+
+
+def run_write(job, get_connection):
+    """
+    Execute the write job and commit it.
+
+    The job is executed on the writer thread when the WRITE_COORDINATOR config is enabled, or with the
+    connection of the request otherwise. In both cases the locked database errors are retried.
+
+    Args:
+        job (callable): Function that receives the connection and executes the writes, without committing.
+        get_connection (callable): Function that returns the connection of the request.
+
+    Returns:
+        The value returned by the job.
+    """
+    if not has_app_context():
+        return run_with_retry(job, get_connection())
+
+    coordinator = current_app.extensions.get('write_coordinator')
+    if coordinator is not None:
+        return coordinator.run(job)
+
+    config = current_app.config
+    return run_with_retry(job, get_connection(), config['WRITE_RETRIES'], config['WRITE_BACKOFF'])
+
+
+def init_app(app):
+    """
+    Create the write coordinator when it is enabled by the WRITE_COORDINATOR config.
+
+    The coordinator writes on the DATABASE file only, so it is not used when the sharding is enabled and
+    each shard serializes its own writers.
+    """
+    enabled = app.config['WRITE_COORDINATOR'] and not app.config['DATABASE_SHARDS']
+    app.extensions['write_coordinator'] = WriteCoordinator(app) if enabled else None
@@ -0,0 +1,5 @@
+"""Used to start the application with an ASGI server, e.g. uvicorn asgi:app."""
+from api import create_app
+from api.asgi import AsgiApp
+
+app = AsgiApp(create_app())
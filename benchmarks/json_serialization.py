@@ -0,0 +1,68 @@
+"""Benchmark of the serialization of the phone bill responses.
+
+Compares jsonify of the dicts of to_dict, the default encoder of Flask, with serializers.json_response,
+that encodes the models with the compiled encoders (and orjson when it is installed), on a bill with
+many calls. Both responses are checked to have the same bytes.
+
+Usage:
+    python benchmarks/json_serialization.py [number_of_calls]
+"""
+import os
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+from flask import jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from api import create_app, serializers  # noqa: E402
+from api.models import PhoneBill, PhoneBillCall  # noqa: E402
+
+
+def create_bill(number_of_calls):
+    """Return a calculated phone bill with the number of calls, without using the database."""
+    phone_bill = PhoneBill('14981227001', '10/2018')
+    base_date = datetime(2018, 10, 1)
+    for call_identifier in range(1, number_of_calls + 1):
+        call = PhoneBillCall.__new__(PhoneBillCall)
+        call.id = call_identifier
+        call.bill_id = 1
+        call.call_identifier = call_identifier
+        call.destination_number = '1434567890'
+        call.call_start = base_date + timedelta(seconds=call_identifier * 40)
+        call.call_end = call.call_start + timedelta(seconds=call_identifier % 3600)
+        call.duration = str(call.call_end - call.call_start)
+        call.price = round(0.36 + (call_identifier % 60) * 0.09, 2)
+        phone_bill.record_calls.append(call)
+        phone_bill.total += call.price
+    phone_bill.total = round(phone_bill.total, 2)
+
+    return phone_bill
+
+
+def main():
+    """Run the benchmark and print the time of each serialization."""
+    number_of_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    app = create_app({'TESTING': True, 'DATABASE': os.path.join(tempfile.gettempdir(), 'benchmark.sqlite')})
+    phone_bill = create_bill(number_of_calls)
+
+    def default_encoder():
+        return jsonify({'success': True, 'data': phone_bill.to_dict()}).get_data()
+
+    def fast_encoder():
+        return serializers.json_response({'success': True, 'data': phone_bill}).get_data()
+
+    with app.test_request_context():
+        assert default_encoder() == fast_encoder()
+
+        print('calls: {}, orjson: {}'.format(number_of_calls, 'yes' if serializers.orjson else 'no'))
+        print('{:>24} {:>10}'.format('serialization', 'time (ms)'))
+        for name, function in (('jsonify(to_dict)', default_encoder), ('serializers', fast_encoder)):
+            elapsed = min(timeit.repeat(function, number=1, repeat=5))
+            print('{:>24} {:>10.1f}'.format(name, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Benchmark of the strategies used to select the start records of a list of call ids.
+
+Compares the bound IN lists (split in chunks by queries.in_list_chunks) with the join against a
+temporary table, for lists of different sizes, to find the crossover point used as
+queries.TEMP_TABLE_THRESHOLD.
+
+Usage:
+    python benchmarks/start_records_strategy.py [number_of_records]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from api import queries  # noqa: E402
+
+
+SUBSCRIBER = 14981227001
+SIZES = (8, 32, 128, 256, 512, 1024, 4096, 16384, 65536)
+
+
+def create_database(path, number_of_records):
+    """Create the schema and the start records of the subscriber on the database."""
+    db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    with open(os.path.join(os.path.dirname(__file__), '..', 'api', 'contrib', 'schema.sql')) as f:
+        db.executescript(f.read())
+
+    base_date = datetime(2018, 10, 1)
+    db.executemany(
+        queries.insert('phone_call', (
+            'record_type', 'record_timestamp', 'call_identifier', 'origin_number', 'destination_number',
+            'origin_key', 'destination_key'
+        )),
+        (
+            ('start', base_date + timedelta(seconds=call_id), call_id, str(SUBSCRIBER), '1434567890', SUBSCRIBER,
+             1434567890)
+            for call_id in range(1, number_of_records + 1)
+        )
+    )
+    db.commit()
+
+    return db
+
+
+def select_in_list(db, calls_ids):
+    """Select the start records with bound IN lists."""
+    rows = []
+    for chunk in queries.in_list_chunks(calls_ids):
+        rows.extend(db.execute(queries.select_start_records(len(chunk)), ['start', SUBSCRIBER] + chunk))
+
+    return rows
+
+
+def select_temp_table(db, calls_ids):
+    """Select the start records with a join against a temporary table."""
+    db.execute(queries.CREATE_TEMP_CALL_IDS)
+    db.executemany(queries.INSERT_TEMP_CALL_IDS, ((call_id,) for call_id in calls_ids))
+    rows = db.execute(queries.select_start_records_temp_table(), ['start', SUBSCRIBER]).fetchall()
+    db.execute(queries.CLEAR_TEMP_CALL_IDS)
+
+    return rows
+
+
+def main():
+    """Run the benchmark and print the time of each strategy by size of the list."""
+    number_of_records = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    fd, path = tempfile.mkstemp()
+    try:
+        db = create_database(path, number_of_records)
+        print('{:>8} {:>14} {:>14}'.format('ids', 'in list (ms)', 'temp table (ms)'))
+        for size in SIZES:
+            calls_ids = random.sample(range(1, number_of_records + 1), min(size, number_of_records))
+            assert len(select_in_list(db, calls_ids)) == len(select_temp_table(db, calls_ids))
+
+            repeat = max(1, 20000 // size)
+            in_list = min(timeit.repeat(lambda: select_in_list(db, calls_ids), number=repeat, repeat=3))
+            temp_table = min(timeit.repeat(lambda: select_temp_table(db, calls_ids), number=repeat, repeat=3))
+            print('{:>8} {:>14.3f} {:>14.3f}'.format(size, in_list * 1000 / repeat, temp_table * 1000 / repeat))
+        db.close()
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -53,10 +53,20 @@ def app():
 
     yield app
 
+    app.extensions['db'].close_all()
     os.close(db_fd)
     os.unlink(db_path)
 
 
+@pytest.fixture
+def query_log_app(app):
+    """Fixture to return the app with the statements of the connections recorded by the query log."""
+    app.config['DATABASE_QUERY_LOG'] = True
+    # the connections already open do not record the statements
+    app.extensions['db'].close_all()
+    return app
+
+
 @pytest.fixture
 def client(app):
     """Fixture to be used on the tests of the endpoints."""
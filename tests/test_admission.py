@@ -0,0 +1,176 @@
+"""Tests for admission.py file."""
+import os
+import subprocess
+import sys
+
+import mock
+import pytest
+
+from api import admission, create_app
+from api.db import init_db
+
+
+PHONE_CALL_ENDPOINT = '/api/v1/phone_call'
+PHONE_BILL_ENDPOINT = '/api/v1/phone_bill?subscriber=14981227001&period=10/2018'
+RECORD = {
+    'type': 'start',
+    'timestamp': '2018-10-10T10:00:00',
+    'call_id': 1,
+    'source': '14981227001',
+    'destination': '1434567890',
+}
+
+
+def test_token_bucket():
+    """Test TokenBucket class taking the tokens and refilling them with the time."""
+    bucket = admission.TokenBucket(10, 20, 100.0)
+
+    assert bucket.take(15, 100.0) == 0
+    assert bucket.take(10, 100.0) == pytest.approx(0.5)
+    assert bucket.take(10, 100.5) == 0
+    # a big request is admitted with the full bucket, and all its cost is taken as debt
+    assert bucket.take(50, 102.5) == 0
+    assert bucket.tokens == -30
+    assert bucket.take(1, 102.5) == pytest.approx(3.1)
+    assert bucket.take(1, 105.7) == 0
+
+
+@mock.patch('api.admission.time.monotonic', return_value=10.0)
+def test_rate_limiter(monotonic):
+    """Test RateLimiter class keeping one bucket by client."""
+    limiter = admission.RateLimiter(1, 2, 10)
+
+    assert limiter.take('10.0.0.1', 2) == 0
+    assert limiter.take('10.0.0.1', 1) == 1
+    assert limiter.take('10.0.0.2', 1) == 0
+
+
+def test_concurrency_limiter(tmpdir):
+    """Test ConcurrencyLimiter class reserving the capacity out of the write budget to the reads."""
+    limiter = admission.ConcurrencyLimiter(str(tmpdir.join('admission.slots')), 3, 2)
+
+    slots = limiter.acquire(True)
+    assert slots
+    assert limiter.acquire(True)
+    assert limiter.acquire(True) is None
+    assert limiter.acquire(False)
+    assert limiter.acquire(False) is None
+
+    limiter.release(slots)
+    assert limiter.in_flight == 2
+    assert limiter.writes == 1
+    assert limiter.acquire(True)
+
+
+def test_concurrency_limiter_other_process(tmpdir):
+    """Test ConcurrencyLimiter class sharing the slots with the limiters of the other processes."""
+    path = str(tmpdir.join('admission.slots'))
+    limiter = admission.ConcurrencyLimiter(path, 3, 1)
+    # other worker holding the write slot and one slot of the capacity
+    worker = subprocess.Popen([
+        sys.executable, '-c',
+        'import fcntl, os, sys; fd = os.open(sys.argv[1], os.O_RDWR | os.O_CREAT); '
+        'fcntl.lockf(fd, fcntl.LOCK_EX, 2, 0); print("locked", flush=True); sys.stdin.read()',
+        path,
+    ], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        assert worker.stdout.readline() == b'locked\n'
+
+        assert limiter.acquire(True) is None
+        assert limiter.acquire(False) == (2,)
+        assert limiter.acquire(False) == (3,)
+        assert limiter.acquire(False) is None
+    finally:
+        worker.communicate(b'')
+
+    assert limiter.acquire(True) == (0, 1)
+
+
+def test_phone_call_too_many_records(app, client):
+    """Test the phone_call endpoint refusing the requests with more than ADMISSION_MAX_RECORDS records."""
+    app.config['ADMISSION_MAX_RECORDS'] = 2
+
+    result = client.post(PHONE_CALL_ENDPOINT, json=[RECORD] * 3)
+
+    assert result.status_code == 413
+    assert result.json.get('errors') == 'The request has more than 2 records.'
+
+
+def test_phone_call_rate_limit(app, client):
+    """Test the phone_call endpoint refusing the records over the rate of the client."""
+    app.extensions['admission_rate'] = admission.RateLimiter(0.5, 1, 10)
+
+    assert client.post(PHONE_CALL_ENDPOINT, json=[RECORD]).json.get('success')
+
+    result = client.post(PHONE_CALL_ENDPOINT, json=[dict(RECORD, call_id=2)])
+
+    assert result.status_code == 429
+    assert result.headers['Retry-After'] == '2'
+    assert result.json.get('errors') == 'Too many requests. Please, try again later.'
+
+
+def test_phone_call_rate_limit_proxy(tmpdir):
+    """Test the clients behind the PROXY_COUNT proxies having their own buckets."""
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmpdir.join('phone_bills.sqlite')),
+        'ADMISSION_RATE': 0.5,
+        'ADMISSION_BURST': 1,
+        'PROXY_COUNT': 1,
+    })
+    with app.app_context():
+        init_db()
+    client = app.test_client()
+
+    for call_id, address in enumerate(('10.0.0.1', '10.0.0.2'), 1):
+        result = client.post(PHONE_CALL_ENDPOINT, json=[dict(RECORD, call_id=call_id)],
+                             headers={'X-Forwarded-For': address})
+        assert result.json.get('success')
+
+    result = client.post(PHONE_CALL_ENDPOINT, json=[dict(RECORD, call_id=3)], headers={'X-Forwarded-For': '10.0.0.1'})
+    assert result.status_code == 429
+    app.extensions['db'].close_all()
+
+
+def test_phone_call_payload_too_large(app, client):
+    """Test the phone_call endpoint refusing the bodies bigger than MAX_CONTENT_LENGTH before parsing them."""
+    app.config['MAX_CONTENT_LENGTH'] = 100
+
+    with mock.patch('api.api.admit_records') as admit_records:
+        result = client.post(PHONE_CALL_ENDPOINT, json=[RECORD] * 2)
+
+    assert result.status_code == 413
+    assert result.json.get('errors') == 'The request has more than 100 bytes.'
+    admit_records.assert_not_called()
+
+
+def test_write_budget(app, client, tmpdir):
+    """Test the phone_call endpoint refused when the write budget is used, while the bills are still served."""
+    limiter = admission.ConcurrencyLimiter(str(tmpdir.join('admission.slots')), 3, 1)
+    app.extensions['admission_concurrency'] = limiter
+    slots = limiter.acquire(True)
+
+    result = client.post(PHONE_CALL_ENDPOINT, json=[RECORD])
+    assert result.status_code == 429
+    assert result.headers['Retry-After'] == '1'
+
+    assert client.get(PHONE_BILL_ENDPOINT).json.get('success')
+    assert limiter.in_flight == 1
+
+    limiter.release(slots)
+    assert client.post(PHONE_CALL_ENDPOINT, json=[RECORD]).json.get('success')
+    assert limiter.in_flight == 0
+    assert limiter.writes == 0
+
+
+def test_init_app(app):
+    """Test init_app function creating the limiters only when they are enabled."""
+    assert app.extensions['admission_rate'] is None
+    assert app.extensions['admission_concurrency'] is None
+
+    app.config.update(ADMISSION_RATE=5, ADMISSION_CAPACITY=4, ADMISSION_WRITE_BUDGET=10)
+    admission.init_app(app)
+
+    assert app.extensions['admission_rate'].burst == 5
+    assert app.extensions['admission_concurrency'].write_budget == 4
+    assert app.extensions['admission_concurrency'].path == os.path.join(app.instance_path, 'admission.slots')
@@ -1,11 +1,23 @@
 """Tests for api.py file."""
 import mock
 
-from api import api
+from api import api, ingest
+from api.db import get_db
+from api.writer import WriteError
 
 
 PHONE_CALL_ENDPOINT = '/api/v1/phone_call'
 PHONE_BILL_ENDPOINT = '/api/v1/phone_bill'
+RECONCILE_ENDPOINT = '/api/v1/reconcile'
+
+
+def set_record_keys(record_class):
+    """Set the call id and the type of the record mocked as the ones of each record of the request."""
+    def create(record_id, record_type, record_timestamp, call_identifier, *args):
+        record_class.return_value.configure_mock(call_identifier=call_identifier, record_type=record_type)
+        return mock.DEFAULT
+
+    record_class.side_effect = create
 
 
 @mock.patch('api.api.render_template')
@@ -50,6 +62,7 @@ def test_phone_call_not_saving(record_class, client):
         {'type': 'start', 'timestamp': '2018-11-10T12:22:14', 'call_id': 10, 'source': '321', 'destination': '123'},
         {'type': 'end', 'timestamp': '2018-11-10T12:25:32', 'call_id': 10},
     ]
+    set_record_keys(record_class)
     record_class.return_value.validate.return_value = []
     record_class.return_value.save.return_value = False
     result = client.post(PHONE_CALL_ENDPOINT, json=data)
@@ -70,7 +83,8 @@ def test_phone_call_not_saving(record_class, client):
             )
         )
         assert_calls.append(mock.call().validate())
-        assert_calls.append(mock.call().save())
+    # all the records are validated before they are saved
+    assert_calls.extend([mock.call().save()] * len(data))
     record_class.assert_has_calls(assert_calls)
 
 
@@ -81,6 +95,7 @@ def test_phone_call_saved(record_class, client):
         {'type': 'start', 'timestamp': '2018-11-10T12:22:14', 'call_id': 10, 'source': '321', 'destination': '123'},
         {'type': 'end', 'timestamp': '2018-11-10T12:25:32', 'call_id': 10},
     ]
+    set_record_keys(record_class)
     record_class.return_value.validate.return_value = []
     record_class.return_value.save.return_value = True
     result = client.post(PHONE_CALL_ENDPOINT, json=data)
@@ -101,7 +116,8 @@ def test_phone_call_saved(record_class, client):
             )
         )
         assert_calls.append(mock.call().validate())
-        assert_calls.append(mock.call().save())
+    # all the records are validated before they are saved
+    assert_calls.extend([mock.call().save()] * len(data))
     record_class.assert_has_calls(assert_calls)
 
 
@@ -128,16 +144,18 @@ def test_phone_bill_error_validate(record_class, client):
 
 @mock.patch('api.api.PhoneBill')
 def test_phone_bill_not_saving(record_class, client):
-    """Test phone_bill function when the save method returns False."""
+    """Test phone_bill function when the save_calls method returns False."""
     endpoint_args = 'subscriber=12345'
     record_class.return_value.validate.return_value = []
-    record_class.return_value.save.return_value = False
+    record_class.return_value.iter_rated_chunks.return_value = [[]]
+    record_class.return_value.save_calls.return_value = False
     result = client.get('{}?{}'.format(PHONE_BILL_ENDPOINT, endpoint_args))
 
     assert not result.json.get('success')
     assert result.json.get('errors') == 'Invalid data request.'
 
-    record_class.return_value.calculate_phone_bill.assert_called_once_with()
+    record_class.return_value.iter_rated_chunks.assert_called_once_with()
+    record_class.return_value.save_calls.assert_called_once_with([])
     record_class.assert_called_once_with('12345', None)
 
 
@@ -145,13 +163,182 @@ def test_phone_bill_not_saving(record_class, client):
 def test_phone_bill_saved(record_class, client):
     """Test phone_bill function when the records are save with success."""
     endpoint_args = 'subscriber=12345&period=11/2018'
-    record_class.return_value.validate.return_value = []
-    record_class.return_value.save.return_value = True
-    record_class.return_value.to_dict.return_value = {'dict': 'data'}
+    phone_bill = record_class.return_value
+    phone_bill.configure_mock(phone_number='12345', period='11/2018', total=0)
+    phone_bill.validate.return_value = []
+    phone_bill.iter_rated_chunks.return_value = [[]]
+    phone_bill.save_calls.return_value = True
     result = client.get('{}?{}'.format(PHONE_BILL_ENDPOINT, endpoint_args))
 
     assert result.json.get('success')
-    assert result.json.get('data') == {'dict': 'data'}
+    assert result.json.get('data') == {'calls': [], 'period': '11/2018', 'subscriber': '12345', 'total': 0}
 
-    record_class.return_value.calculate_phone_bill.assert_called_once_with()
+    phone_bill.save_calls.assert_called_once_with([])
     record_class.assert_called_once_with('12345', '11/2018')
+
+
+@mock.patch('api.api.PhoneBill')
+def test_phone_bill_query_only(record_class, app, client):
+    """Test phone_bill function when the persistence of the bills is disabled."""
+    app.config['PHONE_BILL_PERSIST'] = False
+    endpoint_args = 'subscriber=12345&period=11/2018'
+    phone_bill = record_class.return_value
+    phone_bill.configure_mock(phone_number='12345', period='11/2018', total=0)
+    phone_bill.validate.return_value = []
+    phone_bill.iter_rated_chunks.return_value = [[]]
+    result = client.get('{}?{}'.format(PHONE_BILL_ENDPOINT, endpoint_args))
+
+    assert result.json.get('success')
+    assert result.json.get('data')['subscriber'] == '12345'
+
+    phone_bill.iter_rated_chunks.assert_called_once_with()
+    phone_bill.save_calls.assert_not_called()
+
+
+@mock.patch('api.api.CallRecord')
+def test_phone_call_write_error(record_class, client):
+    """Test phone_call function when the database stays locked."""
+    data = [{'type': 'end', 'timestamp': '2018-11-10T12:25:32', 'call_id': 10}]
+    record_class.return_value.validate.return_value = []
+    record_class.return_value.save.side_effect = WriteError('database is locked')
+    result = client.post(PHONE_CALL_ENDPOINT, json=data)
+
+    assert result.status_code == 503
+    assert not result.json.get('success')
+    assert result.json.get('errors') == 'An error occurred. Please, try again or contact the support team.'
+
+
+@mock.patch('api.api.CallRecord')
+def test_phone_call_async(record_class, app, client):
+    """Test phone_call function appending the records on the ingest queue."""
+    ingest_queue = mock.Mock()
+    ingest_queue.append.return_value = 'token'
+    app.extensions['ingest_queue'] = ingest_queue
+    data = [
+        {'type': 'start', 'timestamp': '2018-11-10T12:22:14', 'call_id': 10, 'source': '321', 'destination': '123'},
+        {'type': 'end', 'timestamp': '2018-11-10T12:25:32', 'call_id': 10},
+    ]
+    records = [mock.Mock(call_identifier=10, record_type=item['type']) for item in data]
+    record_class.side_effect = records
+    for record in records:
+        record.validate.return_value = []
+    result = client.post(PHONE_CALL_ENDPOINT, json=data)
+
+    assert result.status_code == 202
+    assert result.json == {'success': True, 'accepted': 2, 'batch': 'token'}
+    ingest_queue.append.assert_called_once_with(records, None)
+    records[0].save.assert_not_called()
+
+
+def test_phone_call_async_duplicated(app, client):
+    """Test phone_call function refusing the duplicated records of the request and of the requests queued before."""
+    app.config['INGEST_ASYNC'] = True
+    app.config['INGEST_FLUSH_INTERVAL'] = 60000
+    ingest.init_app(app)
+    start = {'type': 'start', 'timestamp': '2018-11-10T12:22:14', 'call_id': 10,
+             'source': '14981227001', 'destination': '1434567890'}
+
+    try:
+        duplicated = client.post(PHONE_CALL_ENDPOINT, json=[start, start])
+        first = client.post(PHONE_CALL_ENDPOINT, json=[start])
+        second = client.post(PHONE_CALL_ENDPOINT, json=[start])
+    finally:
+        app.extensions['ingest_queue'].stop(timeout=5)
+
+    assert not duplicated.json['success']
+    assert first.status_code == 202
+    assert not second.json['success']
+    assert 'call id 10 record type start' in second.json['errors'][0]
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM phone_call').fetchone()[0] == 1
+
+
+@mock.patch('api.api.get_batch_status')
+def test_phone_call_batch(get_batch_status, client):
+    """Test phone_call_batch function returning the status of the batch."""
+    get_batch_status.return_value = {'status': 'committed', 'records': 2}
+    result = client.get(PHONE_CALL_ENDPOINT + '/batch/token')
+
+    assert result.json == {'success': True, 'batch': 'token', 'status': 'committed', 'records': 2}
+
+
+@mock.patch('api.api.get_batch_status')
+def test_phone_call_batch_not_found(get_batch_status, client):
+    """Test phone_call_batch function with an unknown batch."""
+    get_batch_status.return_value = None
+    result = client.get(PHONE_CALL_ENDPOINT + '/batch/token')
+
+    assert result.status_code == 404
+    assert result.json.get('errors') == 'The batch token was not found.'
+
+
+@mock.patch('api.api.CallRecord')
+def test_phone_call_journal(record_class, app, client):
+    """Test phone_call function appending the batch on the journal once, before saving its records."""
+    journal = mock.Mock()
+    app.extensions['journal'] = journal
+    data = [{'type': 'end', 'timestamp': '2018-11-10T12:25:32', 'call_id': call_id} for call_id in (10, 11)]
+    set_record_keys(record_class)
+    record_class.return_value.validate.return_value = []
+    record_class.return_value.save.return_value = True
+    client.post(PHONE_CALL_ENDPOINT, json=data)
+
+    journal.append.assert_called_once_with([record_class.return_value] * 2)
+    assert record_class.return_value.save.call_count == 2
+    journal.abort.assert_not_called()
+
+
+@mock.patch('api.api.CallRecord')
+def test_phone_call_journal_write_error(record_class, app, client):
+    """Test phone_call function aborting on the journal the records that were not saved."""
+    journal = mock.Mock()
+    journal.append.return_value = 'token'
+    app.extensions['journal'] = journal
+    data = [{'type': 'end', 'timestamp': '2018-11-10T12:25:32', 'call_id': call_id} for call_id in (10, 11, 12)]
+    set_record_keys(record_class)
+    record_class.return_value.validate.return_value = []
+    record_class.return_value.save.side_effect = [True, WriteError('database is locked')]
+    result = client.post(PHONE_CALL_ENDPOINT, json=data)
+
+    assert result.status_code == 503
+    journal.abort.assert_called_once_with('token', [1, 2])
+
+
+@mock.patch('api.api.find_orphans')
+def test_reconcile(find_orphans, client):
+    """Test reconcile function listing the records without partner."""
+    find_orphans.return_value = [{'call_identifier': 1, 'record_type': 'end', 'age': 7200}]
+    result = client.get(RECONCILE_ENDPOINT + '?min_age=60&limit=10')
+
+    assert result.json == {'success': True, 'orphans': find_orphans.return_value}
+    find_orphans.assert_called_once_with(60, 10)
+
+
+@mock.patch('api.api.find_orphans')
+def test_reconcile_invalid(find_orphans, client):
+    """Test reconcile function with invalid parameters."""
+    result = client.get(RECONCILE_ENDPOINT + '?min_age=abc&limit=-1')
+
+    assert not result.json.get('success')
+    assert result.json.get('errors') == [
+        'The field min_age has an invalid value.', 'The field limit has an invalid value.'
+    ]
+    find_orphans.assert_not_called()
+
+
+def test_query_budgets(app, client):
+    """Test the statements executed by the endpoints staying inside their budgets."""
+    app.config.update(DATABASE_QUERY_LOG=True, DATABASE_QUERY_BUDGETS={
+        'api.phone_call': 120,
+        'api.phone_bill': 40,
+    })
+    data = []
+    for call_id in range(1, 11):
+        data.append({'type': 'start', 'timestamp': '2018-10-10T10:00:00', 'call_id': call_id,
+                     'source': '14981227001', 'destination': '1434567890'})
+        data.append({'type': 'end', 'timestamp': '2018-10-10T10:05:00', 'call_id': call_id})
+
+    assert client.post(PHONE_CALL_ENDPOINT, json=data).json.get('processed') == 20
+    for _ in range(2):
+        result = client.get(PHONE_BILL_ENDPOINT, query_string={'subscriber': '14981227001', 'period': '10/2018'})
+        assert len(result.json['data']['calls']) == 10
@@ -0,0 +1,168 @@
+"""Tests for archive.py file."""
+import os
+
+import mock
+import pytest
+
+from api import archive
+from api.db import get_db
+from api.models import CallRecord, PhoneBill
+
+
+CALLS = (
+    (1, '14981227001', '2018-09-30T23:50:00', '2018-10-01T00:10:00'),
+    (2, '14981227001', '2018-10-10T10:00:00', '2018-10-10T10:05:00'),
+    (3, '14981227002', '2018-10-11T10:00:00', '2018-10-11T10:07:00'),
+    (4, '14981227001', '2018-10-31T23:50:00', '2018-11-01T00:10:00'),
+)
+
+
+@pytest.fixture
+def archive_app(app, tmpdir):
+    """Fixture to return an app with the calls of the period 10/2018 and the bill of one subscriber saved."""
+    app.config['ARCHIVE_DIRECTORY'] = str(tmpdir.join('archive'))
+    with app.app_context():
+        db = get_db()
+        for call_identifier, origin, start, end in CALLS:
+            for record_type, timestamp in (('start', start), ('end', end)):
+                CallRecord.from_row({
+                    'record_id': None,
+                    'record_type': record_type,
+                    'record_timestamp': timestamp,
+                    'call_identifier': call_identifier,
+                    'origin_number': origin if record_type == 'start' else None,
+                    'destination_number': '1434567890' if record_type == 'start' else None,
+                }).write(db)
+        db.commit()
+
+        phone_bill = PhoneBill('14981227001', '10/2018')
+        phone_bill.calculate_phone_bill()
+        phone_bill.save()
+
+    return app
+
+
+def bill_dict(app, phone_number):
+    """Return the bill of the subscriber on the period 10/2018 as a dict, without saving it."""
+    with app.app_context():
+        phone_bill = PhoneBill(phone_number, '10/2018')
+        phone_bill.calculate_phone_bill()
+        result = phone_bill.to_dict()
+
+    # the bill id is not loaded with the saved calls of the database
+    for call in result['calls']:
+        call.pop('bill_id')
+    return result
+
+
+@pytest.mark.parametrize('period, expected_result', [
+    ('10/2018', (10, 2018)),
+    ('1/2019', (1, 2019)),
+    ('13/2018', None),
+    ('2018', None),
+    (None, None),
+])
+def test_parse_period(period, expected_result):
+    """Test parse_period function."""
+    assert archive.parse_period(period) == expected_result
+
+
+def test_archive_period(archive_app, runner):
+    """Test archive-period command moving the records of the period to the archive."""
+    bills_before = [bill_dict(archive_app, number) for number in ('14981227001', '14981227002')]
+
+    result = runner.invoke(args=['archive-period', '10/2018'])
+
+    assert 'Archived 3 end records, 3 start records and 2 rated calls' in result.output
+    path = archive.archive_path(archive_app.config['ARCHIVE_DIRECTORY'], 10, 2018)
+    assert os.path.exists(path)
+
+    with archive_app.app_context():
+        db = get_db()
+        rows = db.execute('SELECT record_type, call_identifier FROM phone_call ORDER BY record_id').fetchall()
+        assert [tuple(row) for row in rows] == [('start', 4), ('end', 4)]
+        assert db.execute('SELECT COUNT(*) FROM phone_bill_call').fetchone()[0] == 0
+
+    # the saved bill is read from the archived rated calls, the other one is rated with the archived records
+    assert [bill_dict(archive_app, number) for number in ('14981227001', '14981227002')] == bills_before
+    with archive_app.app_context():
+        phone_bill = PhoneBill('14981227002', '10/2018')
+        phone_bill.calculate_phone_bill()
+        assert phone_bill.save()
+        assert get_db().execute('SELECT COUNT(*) FROM phone_bill_call').fetchone()[0] == 0
+
+
+def test_archive_period_already_archived(archive_app, runner):
+    """Test archive-period command with a period that was already archived."""
+    runner.invoke(args=['archive-period', '10/2018'])
+
+    result = runner.invoke(args=['archive-period', '10/2018'])
+
+    assert result.exit_code != 0
+    assert 'already archived' in result.output
+
+
+def test_archive_period_resumed(archive_app, runner):
+    """Test archive-period command resuming a run stopped after the archive was written."""
+    with mock.patch('api.archive.delete_period', side_effect=KeyboardInterrupt()):
+        runner.invoke(args=['archive-period', '10/2018'])
+    with archive_app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM phone_bill_call').fetchone()[0] == 2
+
+    result = runner.invoke(args=['archive-period', '10/2018'])
+
+    assert result.exit_code == 0
+    assert 'Resuming the archive of the period 10/2018' in result.output
+    with archive_app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM phone_bill_call').fetchone()[0] == 0
+
+
+def test_archive_period_resumed_missing(archive_app, runner):
+    """Test archive-period command refusing to delete the rows that are not on the existing archive."""
+    with mock.patch('api.archive.delete_period', side_effect=KeyboardInterrupt()):
+        runner.invoke(args=['archive-period', '10/2018'])
+    with archive_app.app_context():
+        CallRecord.from_row({
+            'record_id': None, 'record_type': 'end', 'record_timestamp': '2018-10-20T10:05:00',
+            'call_identifier': 5, 'origin_number': None, 'destination_number': None,
+        }).write(get_db())
+        get_db().commit()
+
+    result = runner.invoke(args=['archive-period', '10/2018'])
+
+    assert result.exit_code != 0
+    assert 'does not have 1 rows of the database' in result.output
+
+
+@pytest.mark.parametrize('period', ['13/2018', '12/2999'])
+def test_archive_period_invalid(archive_app, runner, period):
+    """Test archive-period command with invalid or open periods."""
+    result = runner.invoke(args=['archive-period', period])
+
+    assert result.exit_code != 0
+    assert 'The field period must be a closed period.' in result.output
+
+
+def test_open_period_not_archived(archive_app):
+    """Test open_period function with a period that was not archived."""
+    with archive_app.app_context():
+        assert archive.open_period('10/2018') is None
+
+
+def test_open_period_cached(archive_app, runner):
+    """Test open_period function returning the parsed archive of the cache until the file changes."""
+    runner.invoke(args=['archive-period', '10/2018'])
+    with archive_app.app_context():
+        period_archive = archive.open_period('10/2018')
+        period_archive.bill_calls(1, 14981227001)
+        with mock.patch('api.archive.zipfile.ZipFile') as zip_file:
+            assert archive.open_period('10/2018') is period_archive
+            assert len(period_archive.bill_calls(1, 14981227001)) == 2
+        zip_file.assert_not_called()
+
+        path = archive.archive_path(archive_app.config['ARCHIVE_DIRECTORY'], 10, 2018)
+        os.utime(path, ns=(0, 0))
+        assert archive.open_period('10/2018') is not period_archive
+
+        archive_app.extensions['archive_cache'] = None
+        assert archive.open_period('10/2018') is not archive.open_period('10/2018')
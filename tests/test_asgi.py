@@ -0,0 +1,195 @@
+"""Tests for asgi.py file."""
+import asyncio
+import json
+
+import mock
+import pytest
+
+from api.asgi import AsgiApp, build_environ
+
+
+def http_scope(method, path, query_string=b'', headers=None):
+    """Return the scope of an http request."""
+    return {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query_string,
+        'headers': headers or [],
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 5000),
+    }
+
+
+def call_asgi(asgi_app, scope, messages):
+    """Run the ASGI app with the received messages, returning the sent messages."""
+    sent = []
+    messages = list(messages)
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asgi_app(scope, receive, send))
+    finally:
+        loop.close()
+
+    return sent
+
+
+def response_body(sent):
+    """Return the complete body of the sent messages."""
+    return b''.join(message.get('body', b'') for message in sent if message['type'] == 'http.response.body')
+
+
+@pytest.fixture
+def asgi_app(app):
+    """Fixture to return the ASGI app of the app."""
+    asgi_app = AsgiApp(app, threads=2)
+    yield asgi_app
+    asgi_app.executor.shutdown()
+
+
+def test_build_environ():
+    """Test build_environ function converting the scope to the WSGI environ."""
+    scope = http_scope('POST', '/api/v1/phone_call', b'a=1', [
+        (b'content-type', b'application/json'),
+        (b'content-length', b'2'),
+        (b'x-forwarded-for', b'10.0.0.1'),
+        (b'x-forwarded-for', b'10.0.0.2'),
+    ])
+
+    environ = build_environ(scope, 'body')
+
+    assert environ['REQUEST_METHOD'] == 'POST'
+    assert environ['PATH_INFO'] == '/api/v1/phone_call'
+    assert environ['QUERY_STRING'] == 'a=1'
+    assert environ['CONTENT_TYPE'] == 'application/json'
+    assert environ['CONTENT_LENGTH'] == '2'
+    assert environ['HTTP_X_FORWARDED_FOR'] == '10.0.0.1,10.0.0.2'
+    assert environ['SERVER_NAME'] == 'testserver'
+    assert environ['wsgi.input'] == 'body'
+
+
+def test_asgi_phone_bill(asgi_app, client):
+    """Test the phone_bill endpoint served by the ASGI app with the same response of the WSGI app."""
+    scope = http_scope('GET', '/api/v1/phone_bill', b'subscriber=123&period=10/2018')
+
+    sent = call_asgi(asgi_app, scope, [{'type': 'http.request', 'body': b''}])
+
+    assert sent[0]['type'] == 'http.response.start'
+    assert sent[0]['status'] == 200
+    assert (b'content-type', b'application/json') in sent[0]['headers']
+    expected = client.get('/api/v1/phone_bill?subscriber=123&period=10/2018').json
+    assert json.loads(response_body(sent).decode('utf8')) == expected
+
+
+def test_asgi_phone_bill_streamed(app, asgi_app, client):
+    """Test the phone bill bigger than PHONE_BILL_SPOOL_SIZE sent in blocks of its spooled file."""
+    app.config['PHONE_BILL_SPOOL_SIZE'] = 0
+    scope = http_scope('GET', '/api/v1/phone_bill', b'subscriber=14981227001&period=10/2018')
+
+    with mock.patch('api.serializers.STREAM_BLOCK_SIZE', 16):
+        sent = call_asgi(asgi_app, scope, [{'type': 'http.request', 'body': b''}])
+
+    assert sent[0]['status'] == 200
+    assert len(sent) > 3
+    assert all(len(message['body']) <= 16 for message in sent[1:])
+    expected = client.get('/api/v1/phone_bill?subscriber=14981227001&period=10/2018').json
+    assert json.loads(response_body(sent).decode('utf8')) == expected
+
+
+def test_asgi_phone_call_chunked_body(asgi_app):
+    """Test the phone_call endpoint receiving the body in many chunks."""
+    data = json.dumps([{
+        'type': 'start',
+        'timestamp': '2018-10-10T10:00:00',
+        'call_id': 1,
+        'source': '14981227001',
+        'destination': '1434567890',
+    }]).encode('utf8')
+    scope = http_scope('POST', '/api/v1/phone_call', headers=[
+        (b'content-type', b'application/json'), (b'content-length', str(len(data)).encode('latin1')),
+    ])
+    messages = [
+        {'type': 'http.request', 'body': data[:10], 'more_body': True},
+        {'type': 'http.request', 'body': data[10:], 'more_body': False},
+    ]
+
+    sent = call_asgi(asgi_app, scope, messages)
+
+    assert json.loads(response_body(sent).decode('utf8')).get('success')
+
+
+def test_asgi_phone_call_without_content_length(asgi_app):
+    """Test the phone_call endpoint receiving a chunked body, without the Content-Length header."""
+    data = json.dumps([{
+        'type': 'start',
+        'timestamp': '2018-10-10T10:00:00',
+        'call_id': 1,
+        'source': '14981227001',
+        'destination': '1434567890',
+    }]).encode('utf8')
+    scope = http_scope('POST', '/api/v1/phone_call', headers=[
+        (b'content-type', b'application/json'), (b'transfer-encoding', b'chunked'),
+    ])
+    messages = [
+        {'type': 'http.request', 'body': data[:10], 'more_body': True},
+        {'type': 'http.request', 'body': data[10:], 'more_body': False},
+    ]
+
+    sent = call_asgi(asgi_app, scope, messages)
+
+    assert sent[0]['status'] == 200
+    assert json.loads(response_body(sent).decode('utf8')).get('success')
+
+
+def test_asgi_streaming_response(app):
+    """Test the ASGI app sending each chunk of a streamed response."""
+    @app.route('/stream')
+    def stream():
+        return app.response_class((chunk for chunk in (b'a', b'', b'b')), mimetype='text/plain')
+
+    asgi_app = AsgiApp(app, threads=1)
+    sent = call_asgi(asgi_app, http_scope('GET', '/stream'), [{'type': 'http.request', 'body': b''}])
+    asgi_app.executor.shutdown()
+
+    assert [message.get('body') for message in sent[1:]] == [b'a', b'b', b'']
+    assert [message.get('more_body', False) for message in sent[1:]] == [True, True, False]
+
+
+def test_asgi_body_too_large(app, asgi_app):
+    """Test the ASGI app refusing a body bigger than the MAX_CONTENT_LENGTH config."""
+    app.config['MAX_CONTENT_LENGTH'] = 5
+    messages = [
+        {'type': 'http.request', 'body': b'1234', 'more_body': True},
+        {'type': 'http.request', 'body': b'5678', 'more_body': False},
+    ]
+
+    sent = call_asgi(asgi_app, http_scope('POST', '/api/v1/phone_call'), messages)
+
+    assert sent[0]['status'] == 413
+
+
+def test_asgi_disconnect(asgi_app):
+    """Test the ASGI app ignoring a request whose client disconnected before sending the body."""
+    messages = [
+        {'type': 'http.request', 'body': b'[', 'more_body': True},
+        {'type': 'http.disconnect'},
+    ]
+
+    assert call_asgi(asgi_app, http_scope('POST', '/api/v1/phone_call'), messages) == []
+
+
+def test_asgi_lifespan(app):
+    """Test the ASGI app handling the startup and the shutdown of the server."""
+    asgi_app = AsgiApp(app, threads=1)
+    messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+
+    sent = call_asgi(asgi_app, {'type': 'lifespan'}, messages)
+
+    assert sent == [{'type': 'lifespan.startup.complete'}, {'type': 'lifespan.shutdown.complete'}]
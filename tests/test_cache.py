@@ -0,0 +1,96 @@
+"""Tests for cache.py file."""
+import sqlite3
+
+import mock
+
+from api import cache
+from api.models import CallRecord, get_by_id
+
+
+def test_lru_cache():
+    """Test LRUCache class discarding the least recently used entry."""
+    lru = cache.LRUCache(2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+
+    assert lru.get('a') == 1
+    lru.put('c', 3)
+
+    assert lru.get('b') is cache.MISSING
+    assert lru.get('c') == 3
+    assert lru.stats() == {'size': 2, 'maxsize': 2, 'hits': 2, 'misses': 1}
+
+
+def test_lookup_without_app_context():
+    """Test lookup function when there is no app context."""
+    cache.store('table', 'id', 1, {'a': 1})
+
+    assert cache.lookup('table', 'id', 1) is cache.MISSING
+
+
+def test_store_merge_fields(app):
+    """Test store function merging the fields already known of the row."""
+    with app.app_context():
+        cache.store('table', 'id', 1, {'a': 1})
+        cache.store('table', 'id', 1, {'b': 2})
+
+        assert cache.lookup('table', 'id', 1) == {'a': 1, 'b': 2}
+
+        cache.invalidate('table', 'id', 1)
+
+        assert cache.lookup('table', 'id', 1) is cache.MISSING
+
+
+def test_get_by_id_identity_map(app):
+    """Test get_by_id function reading the same id twice on the same request."""
+    with app.app_context():
+        with mock.patch('api.models.get_db') as get_db:
+            get_db.return_value.cursor.return_value.execute.return_value.fetchone.return_value = {'a': 1}
+
+            assert get_by_id('table', 'id', 33, ['a']) == {'a': 1}
+            assert get_by_id('table', 'id', 33, ['a']) == {'a': 1}
+
+        get_db.return_value.cursor.return_value.execute.assert_called_once()
+
+
+def test_get_by_id_process_cache(app):
+    """Test get_by_id function reading the same id on different requests."""
+    app.extensions['model_cache'] = cache.LRUCache(10)
+    with mock.patch('api.models.get_db') as get_db:
+        get_db.return_value.cursor.return_value.execute.return_value.fetchone.return_value = {'a': 1}
+        for _ in range(2):
+            with app.app_context():
+                assert get_by_id('table', 'id', 33, ['a']) == {'a': 1}
+
+    get_db.return_value.cursor.return_value.execute.assert_called_once()
+    assert app.extensions['model_cache'].stats()['hits'] == 1
+
+
+def test_call_record_save_invalidate(app):
+    """Test save function from CallRecord class removing the cached row."""
+    with app.app_context():
+        record = CallRecord(22, 'start', '2018-11-11T19:22:16', 1, '14981227001', '1434567890')
+
+        assert cache.lookup('phone_call', 'record_id', 22) is None
+
+        record.save()
+
+        assert cache.lookup('phone_call', 'record_id', 22) is cache.MISSING
+        assert get_by_id('phone_call', 'record_id', 22, ['call_identifier']) == {'call_identifier': 1}
+
+
+def test_process_cache_other_process(app):
+    """Test the process cache discarded when other connection commits on the database."""
+    app.extensions['model_cache'] = cache.LRUCache(10)
+    with app.app_context():
+        CallRecord(22, 'start', '2018-11-11T19:22:16', 1, '14981227001', '1434567890').save()
+        get_by_id('phone_call', 'record_id', 22, ['call_identifier'])
+    with app.app_context():
+        assert cache.lookup('phone_call', 'record_id', 22) == {'call_identifier': 1}
+
+    with sqlite3.connect(app.config['DATABASE']) as connection:
+        connection.execute('UPDATE phone_call SET call_identifier = 2 WHERE record_id = 22')
+
+    with app.app_context():
+        assert cache.lookup('phone_call', 'record_id', 22) is cache.MISSING
+        assert get_by_id('phone_call', 'record_id', 22, ['call_identifier']) == {'call_identifier': 2}
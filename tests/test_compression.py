@@ -0,0 +1,131 @@
+"""Tests for compression.py file."""
+import gzip
+import json
+
+import mock
+import pytest
+
+from api import compression
+
+
+class FakeCompressor:
+    """Compressor that only marks the chunks, used to check the negotiation of other encodings."""
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return data.upper()
+
+    def flush(self):
+        return b'.'
+
+
+@pytest.fixture
+def big_app(app):
+    """Fixture to return the app with views of big and small responses."""
+    @app.route('/big')
+    def big():
+        return compression.compress_response(app.response_class(b'a' * 2000, mimetype='application/json'))
+
+    @app.route('/small')
+    def small():
+        return compression.compress_response(app.response_class(b'a' * 10, mimetype='application/json'))
+
+    @app.route('/stream')
+    def stream():
+        response = app.response_class((chunk for chunk in (b'a' * 600, b'b' * 600)), mimetype='text/plain')
+        return compression.compress_response(response)
+
+    return app
+
+
+def test_compress_gzip(big_app):
+    """Test compress_response function compressing the response with gzip."""
+    response = big_app.test_client().get('/big', headers={'Accept-Encoding': 'gzip, deflate'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert int(response.headers['Content-Length']) == len(response.data)
+    assert gzip.decompress(response.data) == b'a' * 2000
+
+
+@pytest.mark.parametrize('path, headers', [
+    ('/big', {}),
+    ('/big', {'Accept-Encoding': 'gzip;q=0, deflate'}),
+    ('/small', {'Accept-Encoding': 'gzip'}),
+])
+def test_compress_not_compressed(big_app, path, headers):
+    """Test compress_response function sending the body as it is."""
+    response = big_app.test_client().get(path, headers=headers)
+
+    assert 'Content-Encoding' not in response.headers
+    assert response.data in (b'a' * 2000, b'a' * 10)
+
+
+def test_compress_disabled(big_app):
+    """Test compress_response function when the COMPRESS_ENCODINGS config is empty."""
+    big_app.config['COMPRESS_ENCODINGS'] = ()
+
+    response = big_app.test_client().get('/big', headers={'Accept-Encoding': 'gzip'})
+
+    assert 'Content-Encoding' not in response.headers
+    assert 'Vary' not in response.headers
+
+
+@mock.patch.dict('api.compression.COMPRESSORS', {'br': FakeCompressor})
+def test_compress_negotiation(big_app):
+    """Test compress_response function choosing the encoding with the quality of the client."""
+    client = big_app.test_client()
+
+    response = client.get('/big', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert response.data == b'A' * 2000 + b'.'
+
+    response = client.get('/big', headers={'Accept-Encoding': 'gzip, br;q=0.5'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+
+def test_compress_stream(big_app):
+    """Test compress_response function compressing the streamed response chunk by chunk."""
+    with mock.patch.dict('api.compression.COMPRESSORS', {'gzip': FakeCompressor}):
+        response = big_app.test_client().get('/stream', headers={'Accept-Encoding': 'gzip'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    assert response.data == b'A' * 600 + b'B' * 600 + b'.'
+
+
+def test_compress_stream_close():
+    """Test compress_stream function closing the iterable of the response."""
+    iterable = mock.MagicMock()
+    iterable.__iter__.return_value = iter([b'a', b'b'])
+
+    chunks = compression.compress_stream(FakeCompressor(1), iterable)
+
+    assert list(chunks) == [b'A', b'B', b'.']
+    iterable.close.assert_called_once_with()
+
+
+def test_compress_body_cache(app):
+    """Test compress_body function compressing the same body only once."""
+    with app.app_context(), mock.patch('api.compression.get_compressor') as get_compressor:
+        get_compressor.side_effect = lambda encoding: FakeCompressor(1)
+
+        assert compression.compress_body('gzip', b'abc') == b'ABC.'
+        assert compression.compress_body('gzip', b'abc') == b'ABC.'
+        assert compression.compress_body('gzip', b'abd') == b'ABD.'
+
+    assert get_compressor.call_count == 2
+    assert app.extensions['compression_cache'].stats()['hits'] == 1
+
+
+def test_compress_phone_bill(app, client):
+    """Test the phone_bill endpoint compressing the bill."""
+    app.config['COMPRESS_MIN_SIZE'] = 0
+    url = '/api/v1/phone_bill?subscriber=14981227001&period=10/2018'
+
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.data).decode('ascii')) == client.get(url).json
@@ -0,0 +1,158 @@
+"""Tests for db.py file."""
+import sqlite3
+
+import mock
+import pytest
+
+from api import db
+
+
+def test_fetch_chunks():
+    """Test fetch_chunks function."""
+    cursor = mock.Mock()
+    cursor.fetchmany.side_effect = [[1, 2], [3], []]
+
+    result = list(db.fetch_chunks(cursor, 2))
+
+    assert result == [[1, 2], [3]]
+    cursor.fetchmany.assert_has_calls([mock.call(2), mock.call(2), mock.call(2)])
+
+
+def test_get_db_persistent(app):
+    """Test get_db function reusing the connection of the thread on the next requests."""
+    with app.app_context():
+        first = db.get_db()
+    with app.app_context():
+        second = db.get_db()
+
+    assert first is second
+    assert app.extensions['db'].stats() == {'persistent': 1, 'opened': 1, 'closed': 0, 'failed_checks': 0}
+
+
+def test_get_db_not_persistent(app):
+    """Test get_db function opening and closing a connection by request."""
+    app.config['DATABASE_PERSISTENT'] = False
+    stats = app.extensions['db'].stats()
+    for _ in range(2):
+        with app.app_context():
+            db.get_db()
+
+    assert app.extensions['db'].stats()['opened'] == stats['opened'] + 2
+    assert app.extensions['db'].stats()['closed'] == stats['closed'] + 2
+
+
+def test_get_db_pragmas(app):
+    """Test get_db function applying the PRAGMAs of the config."""
+    with app.app_context():
+        connection = db.get_db()
+
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert connection.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert connection.execute('PRAGMA busy_timeout').fetchone()[0] == 5000
+
+
+def test_get_db_forked(app):
+    """Test get_db function discarding the connections inherited from other process."""
+    with app.app_context():
+        first = db.get_db()
+    app.extensions['db']._pid = -1
+    with app.app_context():
+        second = db.get_db()
+
+    assert first is not second
+    first.close()
+
+
+def test_get_db_failed_check(app):
+    """Test get_db function opening a new connection when the persistent one failed and is not usable."""
+    with pytest.raises(sqlite3.ProgrammingError), app.app_context():
+        connection = db.get_db()
+        connection.close()
+        connection.execute('SELECT 1')
+    with app.app_context():
+        connection = db.get_db()
+
+        assert connection.execute('SELECT 1').fetchone()[0] == 1
+    assert app.extensions['db'].stats()['failed_checks'] == 1
+
+
+def test_get_db_check_interval(app):
+    """Test get_db function checking the reused connections only once by DATABASE_CHECK_INTERVAL."""
+    manager = app.extensions['db']
+    with app.app_context():
+        db.get_db()
+    with mock.patch.object(manager, 'check', return_value=True) as check:
+        for _ in range(3):
+            with app.app_context():
+                db.get_db()
+        check.assert_not_called()
+
+        app.config['DATABASE_CHECK_INTERVAL'] = 0
+        with app.app_context():
+            db.get_db()
+        check.assert_called_once()
+
+
+def test_close_db_rollback(app):
+    """Test close_db function rolling back the transaction left open by the request."""
+    with app.app_context():
+        connection = db.get_db()
+        connection.execute("INSERT INTO phone_bill (phone_number, period) VALUES ('14981227001', '10/2018')")
+
+    assert not connection.in_transaction
+    with app.app_context():
+        assert db.get_db().execute('SELECT COUNT(*) FROM phone_bill').fetchone()[0] == 0
+
+
+def test_db_status_command(runner):
+    """Test db-status command."""
+    result = runner.invoke(args=['db-status'])
+
+    assert 'Connection: ok' in result.output
+    assert 'opened: 1' in result.output
+
+
+def test_get_db_readonly(app):
+    """Test get_db function returning a read only connection."""
+    with app.app_context():
+        connection = db.get_db(readonly=True)
+
+        assert connection is not db.get_db()
+        assert connection is db.get_db(readonly=True)
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute("INSERT INTO phone_bill (phone_number, period) VALUES ('14981227001', '10/2018')")
+
+
+def test_get_db_readonly_disabled(app):
+    """Test get_db function when the read only connections are disabled."""
+    app.config['DATABASE_READONLY'] = False
+    with app.app_context():
+        assert db.get_db(readonly=True) is db.get_db()
+
+
+def test_migrate_db_command(app, runner):
+    """Test migrate-db command adding the key columns and the missing tables to a database of the old schema."""
+    with app.app_context():
+        connection = db.get_db()
+        connection.executescript(
+            'DROP TABLE phone_call; DROP TABLE phone_bill; DROP TABLE pending_pair; DROP TABLE call_pair;'
+            'CREATE TABLE phone_call (record_id INTEGER PRIMARY KEY AUTOINCREMENT, record_type INTEGER NOT NULL,'
+            ' record_timestamp TIMESTAMP, call_identifier INTEGER, origin_number TEXT, destination_number TEXT);'
+            'CREATE TABLE phone_bill (id INTEGER PRIMARY KEY AUTOINCREMENT, phone_number TEXT, period TEXT);'
+            "INSERT INTO phone_call VALUES (1, 'start', '2018-10-10 10:00:00', 7, '(14) 98122-7001', '0119999999');"
+            "INSERT INTO phone_call VALUES (2, 'end', '2018-10-10 10:05:00', 7, NULL, NULL);"
+            "INSERT INTO phone_bill VALUES (1, '14981227001', '10/2018');"
+        )
+
+    result = runner.invoke(args=['migrate-db'])
+
+    assert 'Migrated the database.' in result.output
+    with app.app_context():
+        connection = db.get_db()
+        assert tuple(connection.execute('SELECT origin_key, destination_key FROM phone_call').fetchone()) == (
+            14981227001, -10119999999
+        )
+        assert connection.execute('SELECT phone_key FROM phone_bill').fetchone()[0] == 14981227001
+        assert tuple(connection.execute('SELECT origin_key, start_month FROM call_pair').fetchone()) == (
+            14981227001, 201810
+        )
@@ -0,0 +1,226 @@
+"""Tests for ingest.py file."""
+import os
+import threading
+
+import mock
+import pytest
+
+from api import create_app, ingest, shards
+from api.db import get_db, init_db, use_shard
+from api.models import CallRecord
+from api.utils import normalize_phone_number
+from api.writer import WriteError, run_write
+
+
+def new_record(app, record_id, call_identifier):
+    """Return a valid start record created on the app context."""
+    with app.app_context():
+        return CallRecord(record_id, 'start', '2018-10-10T10:00:00', call_identifier, '14981227001', '1434567890')
+
+
+def test_ingest_queue_flush_records(app):
+    """Test IngestQueue class committing the batches when INGEST_FLUSH_RECORDS records are pending."""
+    app.config['INGEST_FLUSH_RECORDS'] = 2
+    app.config['INGEST_FLUSH_INTERVAL'] = 60000
+    ingest_queue = ingest.IngestQueue(app)
+
+    try:
+        token = ingest_queue.append([new_record(app, None, 1), new_record(app, None, 2)])
+    finally:
+        ingest_queue.stop(timeout=5)
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT COUNT(*) FROM phone_call').fetchone()[0] == 2
+        assert ingest.get_batch_status(ingest_queue, db, token) == {'status': 'committed', 'records': 2}
+    assert ingest_queue.flushes == 1
+
+
+def test_ingest_queue_flush_interval(app):
+    """Test IngestQueue class committing the batches of many requests in one transaction."""
+    app.config['INGEST_FLUSH_INTERVAL'] = 1
+    ingest_queue = ingest.IngestQueue(app)
+
+    with mock.patch.object(ingest_queue, '_flush') as flush:
+        try:
+            first = ingest_queue.append([new_record(app, None, 1)])
+            assert ingest_queue.status(first) in ('pending', None)
+        finally:
+            ingest_queue.stop(timeout=5)
+
+    batches = [batch for call in flush.call_args_list for batch in call[0][1]]
+    assert [token for token, _ in batches] == [first]
+
+
+def test_ingest_queue_failed(app):
+    """Test IngestQueue class keeping the status of the batches that could not be committed, aborted on the journal."""
+    app.extensions['journal'] = mock.Mock()
+    ingest_queue = ingest.IngestQueue(app)
+    record = mock.Mock(TABLE_NAME='phone_call')
+    record.exists_call_id.return_value = False
+    record.write.side_effect = WriteError('database is locked')
+
+    try:
+        token = ingest_queue.append([record])
+    finally:
+        ingest_queue.stop(timeout=5)
+
+    assert ingest_queue.status(token) == 'failed'
+    app.extensions['journal'].abort.assert_called_once_with(token, None)
+    with app.app_context():
+        assert ingest.get_batch_status(ingest_queue, get_db(), token) == {'status': 'failed'}
+        assert get_db().execute('SELECT COUNT(*) FROM ingest_batch').fetchone()[0] == 0
+
+
+def test_ingest_queue_stopped(app):
+    """Test IngestQueue class refusing new batches after it was stopped."""
+    ingest_queue = ingest.IngestQueue(app)
+    ingest_queue.append([])
+    ingest_queue.stop(timeout=5)
+
+    with pytest.raises(WriteError):
+        ingest_queue.append([])
+
+
+def test_ingest_queue_forked(app):
+    """Test IngestQueue class starting a new committer, without the inherited batches, after a fork."""
+    ingest_queue = ingest.IngestQueue(app)
+    ingest_queue._pid = os.getpid() + 1
+    ingest_queue._pending = [('inherited', [])]
+
+    with mock.patch.object(ingest_queue, '_flush'):
+        try:
+            token = ingest_queue.append([])
+            assert ingest_queue.status('inherited') is None
+        finally:
+            ingest_queue.stop(timeout=5)
+
+    assert token != 'inherited'
+
+
+def test_get_batch_status_unknown(app):
+    """Test get_batch_status function with a token that was not appended."""
+    with app.app_context():
+        assert ingest.get_batch_status(None, get_db(), 'unknown') is None
+
+
+def test_ingest_queue_status_flushing(app):
+    """Test IngestQueue class reporting the batches being written as pending until their commit."""
+    app.config['INGEST_FLUSH_INTERVAL'] = 1
+    ingest_queue = ingest.IngestQueue(app)
+    started, release = threading.Event(), threading.Event()
+    flush = ingest_queue._flush
+
+    def slow_flush(db, batches):
+        started.set()
+        release.wait(5)
+        flush(db, batches)
+
+    with mock.patch.object(ingest_queue, '_flush', side_effect=slow_flush):
+        try:
+            token = ingest_queue.append([new_record(app, None, 1)])
+            assert started.wait(5)
+            assert ingest_queue._pending == []
+            with app.app_context():
+                assert ingest.get_batch_status(ingest_queue, get_db(), token) == {'status': 'pending'}
+            release.set()
+        finally:
+            ingest_queue.stop(timeout=5)
+
+    with app.app_context():
+        assert ingest.get_batch_status(ingest_queue, get_db(), token) == {'status': 'committed', 'records': 1}
+
+
+def test_get_batch_status_other_worker(app):
+    """Test get_batch_status function with a token unknown by the queue of the process, e.g. of other worker."""
+    with app.app_context():
+        assert ingest.get_batch_status(ingest.IngestQueue(app), get_db(), 'other') == {'status': 'unknown'}
+
+
+def test_ingest_queue_sharded(tmpdir):
+    """Test IngestQueue class writing the records of each shard in one transaction, aborting only the unsaved."""
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmpdir.join('phone_bills.sqlite')),
+        'DATABASE_SHARDS': 3,
+        'INGEST_FLUSH_INTERVAL': 60000,
+    })
+    with app.app_context():
+        init_db()
+        numbers = {}
+        for number in range(14981227001, 14981227100):
+            numbers.setdefault(shards.subscriber_shard(normalize_phone_number(str(number))), str(number))
+    app.extensions['journal'] = mock.Mock()
+    first, second = list(numbers.values())[:2]
+    records = [
+        CallRecord(None, 'start', '2018-10-10T10:00:00', call_identifier, origin, '1434567890')
+        for call_identifier, origin in ((1, first), (2, second), (3, first))
+    ]
+    transactions = []
+
+    def fail_second(job, get_connection):
+        transactions.append(job)
+        if len(transactions) > 1:
+            raise WriteError('database is locked')
+        return run_write(job, get_connection)
+
+    ingest_queue = ingest.IngestQueue(app)
+    with mock.patch('api.ingest.run_write', side_effect=fail_second):
+        try:
+            token = ingest_queue.append(records)
+        finally:
+            ingest_queue.stop(timeout=5)
+
+    assert len(transactions) == 2
+    assert ingest_queue.status(token) == 'failed'
+    app.extensions['journal'].abort.assert_called_once_with(token, [1])
+    with app.app_context(), use_shard(shards.subscriber_shard(normalize_phone_number(first))):
+        assert get_db().execute('SELECT COUNT(*) FROM phone_call').fetchone()[0] == 2
+    app.extensions['db'].close_all()
+
+
+def test_init_app(app):
+    """Test init_app function creating the queue only when INGEST_ASYNC is enabled."""
+    assert app.extensions['ingest_queue'] is None
+
+    app.config['INGEST_ASYNC'] = True
+    ingest.init_app(app)
+
+    assert isinstance(app.extensions['ingest_queue'], ingest.IngestQueue)
+
+
+def test_ingest_queue_duplicated(app):
+    """Test IngestQueue class refusing the records queued before, and skipping the ones saved on commit."""
+    app.config['INGEST_FLUSH_INTERVAL'] = 60000
+    ingest_queue = ingest.IngestQueue(app)
+    saved = new_record(app, None, 1)
+    with app.app_context():
+        saved.save()
+
+    try:
+        token = ingest_queue.append([new_record(app, None, 1), new_record(app, None, 2)])
+        with pytest.raises(ingest.DuplicatedRecordError):
+            ingest_queue.append([new_record(app, None, 2)])
+    finally:
+        ingest_queue.stop(timeout=5)
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute('SELECT COUNT(*) FROM phone_call').fetchone()[0] == 2
+        assert ingest.get_batch_status(ingest_queue, db, token) == {'status': 'committed', 'records': 1}
+    assert ingest_queue.duplicates == 1
+    assert ingest_queue._queued_keys == set()
+
+
+@mock.patch('api.ingest.atexit.register')
+def test_ingest_queue_exit(register, app):
+    """Test IngestQueue class committing the pending batches when the process exits."""
+    app.config['INGEST_FLUSH_INTERVAL'] = 60000
+    ingest_queue = ingest.IngestQueue(app)
+
+    token = ingest_queue.append([new_record(app, None, 1)])
+    stop, timeout = register.call_args[0]
+    stop(timeout)
+
+    with app.app_context():
+        assert ingest.get_batch_status(ingest_queue, get_db(), token) == {'status': 'committed', 'records': 1}
@@ -0,0 +1,185 @@
+"""Tests for journal.py file."""
+import os
+
+import mock
+import pytest
+
+from api import journal as journal_module
+from api.db import get_db
+from api.models import CallRecord
+from api.writer import WriteError
+
+
+def new_records(call_identifier):
+    """Return a start and an end records of the call, without querying the database."""
+    return [
+        CallRecord.from_row({
+            'record_id': None,
+            'record_type': 'start',
+            'record_timestamp': '2018-10-10T10:00:00',
+            'call_identifier': call_identifier,
+            'origin_number': '14981227001',
+            'destination_number': '1434567890',
+        }),
+        CallRecord.from_row({
+            'record_id': None,
+            'record_type': 'end',
+            'record_timestamp': '2018-10-10T10:05:00',
+            'call_identifier': call_identifier,
+            'origin_number': None,
+            'destination_number': None,
+        }),
+    ]
+
+
+@pytest.fixture
+def journal(tmpdir):
+    """Fixture to return an empty journal without fsync."""
+    return journal_module.Journal(str(tmpdir.join('journal')), fsync=False)
+
+
+def test_journal_append_read(journal):
+    """Test Journal class reading the batches in the order they were appended."""
+    journal.append(new_records(1))
+    journal.append(new_records(2)[:1])
+
+    batches = list(journal.read())
+
+    assert len(batches) == 2
+    assert [item['call_identifier'] for item in batches[0]] == [1, 1]
+    assert batches[0][0]['record_timestamp'] == '2018-10-10T10:00:00'
+    assert batches[1][0]['origin_number'] == '14981227001'
+
+
+def test_journal_abort(journal):
+    """Test Journal class not reading the records aborted after they were appended."""
+    first = journal.append(new_records(1))
+    second = journal.append(new_records(2))
+    journal.append(new_records(3))
+    journal.abort(first, [0])
+    journal.abort(second)
+
+    batches = list(journal.read())
+
+    assert [[(item['call_identifier'], item['record_type']) for item in batch] for batch in batches] == [
+        [(1, 'end')], [(3, 'start'), (3, 'end')]
+    ]
+    assert len(list(journal.read_entries())) == 5
+
+
+def test_journal_segments(journal):
+    """Test Journal class starting a new segment when the current one is full."""
+    journal.segment_size = 1
+
+    journal.append(new_records(1))
+    journal.append(new_records(2))
+
+    assert [os.path.basename(path) for path in journal.segments()] == ['00000001.journal', '00000002.journal']
+    assert len(list(journal.read())) == 2
+
+
+def test_journal_corrupted(journal):
+    """Test Journal class skipping the rest of the segment after a corrupted entry."""
+    journal.append(new_records(1))
+    path = journal.segments()[0]
+    size = os.path.getsize(path)
+    journal.append(new_records(2))
+    with open(path, 'r+b') as segment:
+        segment.seek(-3, os.SEEK_END)
+        segment.write(b'xxx')
+    on_corrupted = mock.Mock()
+
+    batches = list(journal.read(on_corrupted))
+
+    assert len(batches) == 1
+    on_corrupted.assert_called_once_with(path, size)
+
+
+def test_journal_truncated(journal):
+    """Test Journal class ignoring an entry truncated by a crash during the write."""
+    journal.append(new_records(1))
+    path = journal.segments()[0]
+    size = os.path.getsize(path)
+    journal.append(new_records(2))
+    with open(path, 'r+b') as segment:
+        segment.truncate(size + 5)
+    on_corrupted = mock.Mock()
+
+    assert len(list(journal.read(on_corrupted))) == 1
+    on_corrupted.assert_called_once_with(path, size)
+
+
+@mock.patch('api.journal.os.write')
+def test_journal_append_error(write, journal):
+    """Test Journal class raising WriteError when the entry can not be written."""
+    write.side_effect = OSError('No space left on device')
+
+    with pytest.raises(WriteError):
+        journal.append(new_records(1))
+
+
+def test_replay(app, journal):
+    """Test replay function rebuilding the phone_call table from the journal."""
+    journal.append(new_records(1))
+    journal.append(new_records(2))
+
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO phone_call (record_type, call_identifier) VALUES ('start', 99)")
+        db.commit()
+
+        assert journal_module.replay(journal, db, batch_size=1) == (2, 4)
+
+        rows = db.execute('SELECT record_id, call_identifier, origin_key FROM phone_call ORDER BY record_id').fetchall()
+        assert [tuple(row) for row in rows] == [(1, 1, 14981227001), (2, 1, None), (3, 2, 14981227001), (4, 2, None)]
+
+
+def test_replay_idempotent(app, journal):
+    """Test replay function skipping the records journaled twice, and replaying the same rows when run again."""
+    journal.append(new_records(1))
+    journal.append(new_records(1))
+    journal.append(new_records(2)[1:])
+
+    with app.app_context():
+        db = get_db()
+        assert journal_module.replay(journal, db) == (3, 3)
+        first = [tuple(row) for row in db.execute('SELECT * FROM phone_call ORDER BY record_id')]
+        assert journal_module.replay(journal, db) == (3, 3)
+
+        assert [tuple(row) for row in db.execute('SELECT * FROM phone_call ORDER BY record_id')] == first
+
+
+def test_replay_batches(app, journal):
+    """Test replay function writing each batch of entries with one check and one insert by table."""
+    for call_identifier in range(1, 4):
+        journal.append(new_records(call_identifier))
+
+    with app.app_context():
+        db = get_db()
+        with mock.patch('api.journal.replay_records', wraps=journal_module.replay_records) as replay_records:
+            assert journal_module.replay(journal, db, batch_size=2) == (3, 6)
+
+        assert [len(args[1]) for args, _ in replay_records.call_args_list] == [4, 2]
+        assert db.execute('SELECT COUNT(*) FROM call_pair').fetchone()[0] == 3
+        assert db.execute('SELECT COUNT(*) FROM pending_pair').fetchone()[0] == 0
+
+
+def test_replay_journal_command(app, runner):
+    """Test replay-journal command replaying the journal of the instance folder."""
+    app.config['JOURNAL_DIRECTORY'] = os.path.join(os.path.dirname(app.config['DATABASE']), 'test-journal')
+    journal = journal_module.get_journal(app)
+    try:
+        journal.append(new_records(1))
+
+        result = runner.invoke(args=['replay-journal'])
+
+        assert 'Replayed 2 records from 1 entries.' in result.output
+    finally:
+        for path in journal.segments() + [os.path.join(journal.directory, journal_module.LOCK_NAME)]:
+            os.unlink(path)
+        os.rmdir(journal.directory)
+
+
+def test_init_app(app):
+    """Test init_app function creating the journal only when JOURNAL is enabled."""
+    assert app.extensions['journal'] is None
@@ -0,0 +1,158 @@
+"""Tests for metrics.py file."""
+import json
+import os
+
+import mock
+import pytest
+
+from api import metrics
+from api.db import get_db
+
+
+METRICS_ENDPOINT = '/metrics'
+
+
+@pytest.fixture
+def metrics_app(app):
+    """Fixture to return the app with the METRICS config enabled."""
+    app.config['METRICS'] = True
+    metrics.init_app(app)
+    # the connections already open are not timed
+    app.extensions['db'].close_all()
+    return app
+
+
+def test_counter():
+    """Test Counter class keeping one value by labels."""
+    counter = metrics.Counter('requests', 'Requests.', ('route',))
+
+    counter.inc(1, ('/a',))
+    counter.inc(2, ('/a',))
+    counter.inc(1, ('/b',))
+
+    assert sorted(counter.samples()) == [[['/a'], 3], [['/b'], 1]]
+
+
+def test_histogram():
+    """Test Histogram class counting the values by bucket, with the sum of the values."""
+    histogram = metrics.Histogram('latency', 'Latency.', buckets=(0.1, 1))
+
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+
+    assert histogram.samples() == [[[], [2, 1, 1, pytest.approx(3.65)]]]
+
+
+def test_expose():
+    """Test expose function formatting the metrics on the text format of Prometheus."""
+    registry = metrics.Registry()
+    registry.counter('requests_total', 'Requests.', ('route',)).inc(2, ('/a"b',))
+    registry.histogram('latency_seconds', 'Latency.', buckets=(0.5, 1)).observe(0.25)
+
+    assert metrics.expose(registry.snapshot()).splitlines() == [
+        '# HELP requests_total Requests.',
+        '# TYPE requests_total counter',
+        'requests_total{route="/a\\"b"} 2',
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.5"} 1',
+        'latency_seconds_bucket{le="1"} 1',
+        'latency_seconds_bucket{le="+Inf"} 1',
+        'latency_seconds_sum 0.25',
+        'latency_seconds_count 1',
+    ]
+
+
+def test_merge_snapshots():
+    """Test merge_snapshots function adding the values of the processes with the same labels."""
+    first = metrics.Registry()
+    first.counter('requests_total', 'Requests.', ('route',)).inc(1, ('/a',))
+    first.histogram('latency_seconds', 'Latency.', buckets=(1,)).observe(0.5)
+    second = metrics.Registry()
+    second.counter('requests_total', 'Requests.', ('route',)).inc(2, ('/a',))
+    second.metrics['requests_total'].inc(1, ('/b',))
+    second.histogram('latency_seconds', 'Latency.', buckets=(1,)).observe(2)
+
+    merged = metrics.merge_snapshots([first.snapshot(), second.snapshot()])
+
+    assert merged['requests_total']['samples'] == [[['/a'], 3], [['/b'], 1]]
+    assert merged['latency_seconds']['samples'] == [[[], [1, 1, 2.5]]]
+
+
+def test_collect_processes(tmpdir):
+    """Test Registry.collect method adding the snapshots written by the other processes."""
+    registry = metrics.Registry(str(tmpdir))
+    registry.counter('requests_total', 'Requests.').inc(1)
+    other = metrics.Registry(str(tmpdir))
+    other.counter('requests_total', 'Requests.').inc(4)
+    with mock.patch('api.metrics.os.getpid', return_value=1):
+        other.write()
+
+    with mock.patch('api.metrics.threading.Thread'), mock.patch('api.metrics.atexit.register'):
+        collected = registry.collect()
+
+    assert collected['requests_total']['samples'] == [[[], 5]]
+    assert sorted(os.listdir(str(tmpdir))) == ['1.json', '{}.json'.format(os.getpid())]
+    with open(os.path.join(str(tmpdir), '1.json')) as f:
+        assert json.load(f)['requests_total']['samples'] == [[[], 4]]
+
+
+def test_add_hit_ratios():
+    """Test add_hit_ratios function computing the ratio of the hits of each cache."""
+    snapshot = {
+        metrics.CACHE_HITS: {'samples': [[['model'], 3], [['compression'], 0]]},
+        metrics.CACHE_MISSES: {'samples': [[['model'], 1], [['compression'], 0]]},
+    }
+
+    samples = metrics.add_hit_ratios(snapshot)[metrics.CACHE_HIT_RATIO]['samples']
+
+    assert samples == [[['model'], 0.75], [['compression'], 0]]
+
+
+@pytest.mark.parametrize('message, labels', [
+    ('The field record_type is mandatory.', ('mandatory_field', 'record_type')),
+    ('The field origin_number has an invalid value.', ('invalid_field', 'origin_number')),
+    ('Database already has a record with given call id 7 record type end with other record id.',
+     ('duplicated_call_id', 'call_identifier')),
+    ('Something else.', ('other', '')),
+])
+def test_error_labels(message, labels):
+    """Test error_labels function finding the type and the field of the validation errors."""
+    assert metrics.error_labels(message) == labels
+
+
+def test_query_metrics(metrics_app):
+    """Test the connections recording the latency of the statements by operation."""
+    app = metrics_app
+    with app.app_context():
+        get_db().execute('SELECT 1').fetchone()
+        get_db().executemany('DELETE FROM phone_call WHERE record_id = ?', [(1,), (2,)])
+
+    samples = app.extensions['metrics'].metrics[metrics.QUERY_SECONDS].samples()
+    counts = {labels[0]: sum(entry[:-1]) for labels, entry in samples}
+    assert counts['SELECT'] >= 1
+    assert counts['DELETE'] == 1
+
+
+def test_metrics_endpoint(metrics_app, client):
+    """Test the metrics endpoint returning the metrics of the requests, the records and the bills."""
+    client.post('/api/v1/phone_call', json=[{'type': 'start', 'timestamp': 'invalid', 'call_id': 1}])
+    client.get('/api/v1/phone_bill?subscriber=14981227001&period=10/2018')
+
+    result = client.get(METRICS_ENDPOINT)
+
+    assert result.status_code == 200
+    assert result.content_type == 'text/plain; version=0.0.4; charset=utf-8'
+    lines = result.data.decode('utf8').splitlines()
+    assert 'phone_bills_http_requests_total{route="/api/v1/phone_bill",method="GET",status="200"} 1' in lines
+    assert 'phone_bills_records_rejected_total{error="invalid_field",field="record_timestamp"} 1' in lines
+    assert 'phone_bills_rating_duration_seconds_count 1' in lines
+    assert 'phone_bills_cache_hit_ratio{cache="compression"} 0' in lines
+
+
+def test_metrics_disabled(app, client):
+    """Test the metrics endpoint when the METRICS config is disabled, as by default."""
+    result = client.get(METRICS_ENDPOINT)
+
+    assert result.status_code == 404
+    assert result.json.get('errors') == 'The metrics are disabled.'
@@ -2,9 +2,13 @@
 import mock
 import pytest
 
+import sqlite3
 from datetime import datetime
 
+from api import querylog
+from api.db import fetch_chunks, get_db
 from api.models import CallRecord, check_exists_id, get_by_id, PhoneBill, PhoneBillCall
+from api.records import CallBatch, CallRecordData
 
 
 VALID_CALL_RECORD_START = {
@@ -54,9 +58,8 @@ VALID_PHONE_BILL = {
 
 def test_call_record_validate_start(record_start):
     """Test validate function from CallRecord class with valid start data."""
-    record_start.exists_call_id = mock.Mock(return_value=False)
-
-    result = record_start.validate()
+    with mock.patch.object(CallRecord, 'exists_call_id', return_value=False):
+        result = record_start.validate()
 
     assert result == []
 
@@ -71,9 +74,8 @@ def test_call_record_validate_end(get_by_id):
         VALID_CALL_RECORD_END.get('record_timestamp'),
         VALID_CALL_RECORD_END.get('call_identifier'),
     )
-    obj.exists_call_id = mock.Mock(return_value=False)
-
-    result = obj.validate()
+    with mock.patch.object(CallRecord, 'exists_call_id', return_value=False):
+        result = obj.validate()
 
     assert result == []
 
@@ -90,9 +92,8 @@ def test_call_record_validate_mandatory(get_by_id):
         INVALID_CALL_RECORD_WITHOUT_MANDATORY.get('origin_number'),
         INVALID_CALL_RECORD_WITHOUT_MANDATORY.get('destination_number'),
     )
-    obj.exists_call_id = mock.Mock(return_value=False)
-
-    result = obj.validate()
+    with mock.patch.object(CallRecord, 'exists_call_id', return_value=False):
+        result = obj.validate()
 
     assert 'The field record_type is mandatory.' in result
     assert 'The field call_identifier is mandatory.' in result
@@ -110,9 +111,8 @@ def test_call_record_validate_mandatory_start(get_by_id):
         INVALID_CALL_RECORD_WITHOUT_MANDATORY_START.get('origin_number'),
         INVALID_CALL_RECORD_WITHOUT_MANDATORY_START.get('destination_number'),
     )
-    obj.exists_call_id = mock.Mock(return_value=False)
-
-    result = obj.validate()
+    with mock.patch.object(CallRecord, 'exists_call_id', return_value=False):
+        result = obj.validate()
 
     assert 'The field call_identifier is mandatory.' in result
     assert 'The field origin_number is mandatory.' in result
@@ -131,9 +131,8 @@ def test_call_record_validate_types(get_by_id):
         INVALID_CALL_RECORD_TYPES.get('origin_number'),
         INVALID_CALL_RECORD_TYPES.get('destination_number'),
     )
-    obj.exists_call_id = mock.Mock(return_value=False)
-
-    result = obj.validate()
+    with mock.patch.object(CallRecord, 'exists_call_id', return_value=False):
+        result = obj.validate()
 
     assert 'The field record_type has an invalid value.' in result
     assert 'The field record_timestamp has an invalid value.' in result
@@ -151,20 +150,28 @@ def test_call_record_validate_types_start(get_by_id):
         INVALID_CALL_RECORD_TYPES_START.get('origin_number'),
         INVALID_CALL_RECORD_TYPES_START.get('destination_number'),
     )
-    obj.exists_call_id = mock.Mock(return_value=False)
-
-    result = obj.validate()
+    with mock.patch.object(CallRecord, 'exists_call_id', return_value=False):
+        result = obj.validate()
 
     assert 'The field record_timestamp has an invalid value.' in result
     assert 'The field origin_number has an invalid value.' in result
     assert 'The field destination_number has an invalid value.' in result
 
 
+def test_call_record_validate_unicode_digits():
+    """Test validate function from CallRecord class with phone numbers of digits that are not ascii."""
+    obj = CallRecord(None, 'start', '2018-10-10T10:00:00', 1, '123456789\u00b2', '\u0661' * 10)
+    with mock.patch.object(CallRecord, 'exists_call_id', return_value=False):
+        result = obj.validate()
+
+    assert 'The field origin_number has an invalid value.' in result
+    assert 'The field destination_number has an invalid value.' in result
+
+
 def test_call_record_validate_duplicated(record_start):
     """Test validate function from CallRecord class with invalid data types of a start call."""
-    record_start.exists_call_id = mock.Mock(return_value=True)
-
-    result = record_start.validate()
+    with mock.patch.object(CallRecord, 'exists_call_id', return_value=True):
+        result = record_start.validate()
     duplicate_msg = 'Database already has a record with given call id {} record type {} with other record id.'.format(
         record_start.call_identifier,
         record_start.record_type
@@ -208,8 +215,8 @@ def test_call_record_exists_call_id_invalid_without_record_id(get_db):
 
     assert not result
     get_db.return_value.cursor.return_value.execute.assert_called_once_with(
-        'SELECT 1 FROM phone_call WHERE call_identifier = 1 AND record_type = ?',
-        [obj.record_type]
+        'SELECT 1 FROM phone_call WHERE call_identifier = ? AND record_type = ? AND record_id IS NOT ?',
+        [obj.call_identifier, obj.record_type, None]
     )
 
 
@@ -222,8 +229,8 @@ def test_call_record_exists_call_id_invalid_with_record_id(get_db, record_start)
 
     assert not result
     get_db.return_value.cursor.return_value.execute.assert_called_once_with(
-        'SELECT 1 FROM phone_call WHERE call_identifier = 1 AND record_type = ? AND record_id <> 22',
-        [record_start.record_type]
+        'SELECT 1 FROM phone_call WHERE call_identifier = ? AND record_type = ? AND record_id IS NOT ?',
+        [record_start.call_identifier, record_start.record_type, record_start.record_id]
     )
 
 
@@ -242,11 +249,12 @@ def test_call_record_save_insert(get_db, check_exists_id, record_start):
         (
             'INSERT INTO phone_call ('
             'record_type, record_timestamp, call_identifier, origin_number,'
-            ' destination_number, record_id) VALUES (?, ?, ?, ?, ?, ?)'
+            ' destination_number, origin_key, destination_key, record_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
         ),
         [
             record_start.record_type, record_start.record_timestamp, record_start.call_identifier,
-            record_start.origin_number, record_start.destination_number, record_start.record_id
+            record_start.origin_number, record_start.destination_number, 14981227001, 1434567890,
+            record_start.record_id
         ]
     )
 
@@ -266,12 +274,13 @@ def test_call_record_save_update(get_db, check_exists_id, record_start):
         (
             'UPDATE phone_call SET'
             ' record_type = ?, record_timestamp = ?, call_identifier = ?,'
-            ' origin_number = ?, destination_number = ?'
+            ' origin_number = ?, destination_number = ?, origin_key = ?, destination_key = ?'
             ' WHERE record_id = ?'
         ),
         [
             record_start.record_type, record_start.record_timestamp, record_start.call_identifier,
-            record_start.origin_number, record_start.destination_number, record_start.record_id
+            record_start.origin_number, record_start.destination_number, 14981227001, 1434567890,
+            record_start.record_id
         ]
     )
 
@@ -303,6 +312,19 @@ def test_phone_bill_validate_types(invalid_phone_bill):
     assert 'The field record_calls has an invalid value.' in result
 
 
+@pytest.mark.parametrize('phone_number, expected_result', [
+    (None, None),
+    ('14981227001', 14981227001),
+    ('(14) 98122-7001', 14981227001),
+    ('12312', None),
+])
+def test_phone_bill_phone_key(phone_number, expected_result):
+    """Test phone_key property from PhoneBill class."""
+    obj = PhoneBill(phone_number, VALID_PHONE_BILL.get('period'))
+
+    assert obj.phone_key == expected_result
+
+
 def test_phone_bill_to_dict():
     """Test to_dict function from PhoneBill class."""
     record_to_dict = mock.Mock()
@@ -401,23 +423,23 @@ def test_phone_bill_exists_period(get_db, phone_bill):
 
     assert result
     get_db.return_value.cursor.return_value.execute.assert_called_once_with(
-        'SELECT id FROM phone_bill WHERE period = ? AND phone_number = ?',
-        [phone_bill.period, phone_bill.phone_number]
+        'SELECT id FROM phone_bill WHERE period = ? AND phone_key = ?',
+        [phone_bill.period, 14981227001]
     )
 
 
-@mock.patch('api.models.CallRecord')
 @mock.patch('api.models.get_db')
-def test_phone_bill_get_phone_end_records(get_db, record_class, phone_bill):
+def test_phone_bill_get_phone_end_records(get_db, phone_bill):
     """Test get_phone_end_records function from PhoneBill class."""
     records_found = [
-        ['A', 'B', 'C', 'D', 'E', 'F'],
-        ['U', 'V', 'W', 'X', 'Y', 'Z'],
+        [25, 'end', datetime(2018, 10, 11, 20, 3, 43), 1, None, None],
+        [26, 'end', datetime(2018, 10, 12, 8, 0, 0), 2, None, None],
+    ]
+    get_db.return_value.cursor.return_value.execute.return_value.fetchmany.side_effect = [
+        records_found[:1], records_found[1:], []
     ]
-    get_db.return_value.cursor.return_value.execute.return_value.fetchall.return_value = records_found
-    record_class.TABLE_NAME = 'phone_call'
 
-    result = phone_bill.get_phone_end_records()
+    result = list(phone_bill.get_phone_end_records())
 
     get_db.return_value.cursor.return_value.execute.assert_called_once_with(
         'SELECT'
@@ -429,55 +451,19 @@ def test_phone_bill_get_phone_end_records(get_db, record_class, phone_bill):
         ['end', '%m', '10', '%Y', '2018']
     )
 
-    record_class.assert_has_calls([
-        mock.call(
-            records_found[0][0],
-            records_found[0][1],
-            records_found[0][2],
-            records_found[0][3],
-            records_found[0][4],
-            records_found[0][5]
-        ),
-        mock.call(
-            records_found[1][0],
-            records_found[1][1],
-            records_found[1][2],
-            records_found[1][3],
-            records_found[1][4],
-            records_found[1][5]
-        ),
-    ])
-
-    assert result == [
-        record_class(
-            records_found[0][0],
-            records_found[0][1],
-            records_found[0][2],
-            records_found[0][3],
-            records_found[0][4],
-            records_found[0][5]
-        ),
-        record_class(
-            records_found[1][0],
-            records_found[1][1],
-            records_found[1][2],
-            records_found[1][3],
-            records_found[1][4],
-            records_found[1][5]
-        ),
-    ]
+    assert len(result) == 2
+    assert isinstance(result[0], CallBatch)
+    assert list(result[0]) + list(result[1]) == [CallRecordData(*record) for record in records_found]
 
 
-@mock.patch('api.models.CallRecord')
 @mock.patch('api.models.get_db')
-def test_phone_bill_get_phone_start_records(get_db, record_class, phone_bill):
+def test_phone_bill_get_phone_start_records(get_db, phone_bill):
     """Test get_phone_start_records function from PhoneBill class."""
     records_found = [
-        ['A', 'B', 'C', 'D', 'E', 'F'],
-        ['U', 'V', 'W', 'X', 'Y', 'Z'],
+        [22, 'start', datetime(2018, 10, 11, 19, 22, 16), 1, '14981227001', '1434567890'],
+        [23, 'start', datetime(2018, 10, 12, 7, 58, 0), 2, '14981227001', '1434567891'],
     ]
-    get_db.return_value.cursor.return_value.execute.return_value.fetchall.return_value = records_found
-    record_class.TABLE_NAME = 'phone_call'
+    get_db.return_value.cursor.return_value.execute.return_value = iter(records_found)
     calls_ids = [1, 2, 3]
 
     result = phone_bill.get_phone_start_records(calls_ids)
@@ -486,39 +472,74 @@ def test_phone_bill_get_phone_start_records(get_db, record_class, phone_bill):
         'SELECT record_id, record_type, record_timestamp, call_identifier, origin_number, destination_number '
         'FROM phone_call WHERE'
         ' record_type = ? AND'
-        ' call_identifier IN (1, 2, 3)',
-        ['start']
+        ' origin_key = ? AND'
+        ' call_identifier IN (?, ?, ?, ?, ?, ?, ?, ?)',
+        ['start', 14981227001, 1, 2, 3, 3, 3, 3, 3, 3]
     )
 
-    record_class.assert_has_calls([
-        mock.call(
-            records_found[0][0], records_found[0][1], records_found[0][2],
-            records_found[0][3], records_found[0][4], records_found[0][5]
-        ),
+    assert isinstance(result, CallBatch)
+    assert list(result) == [CallRecordData(*record) for record in records_found]
+
+
+@mock.patch('api.queries.TEMP_TABLE_THRESHOLD', 2)
+@mock.patch('api.models.get_db')
+def test_phone_bill_get_phone_start_records_temp_table(get_db, phone_bill):
+    """Test get_phone_start_records function from PhoneBill class with a list of ids above the threshold."""
+    records_found = [
+        [22, 'start', datetime(2018, 10, 11, 19, 22, 16), 1, '14981227001', '1434567890'],
+    ]
+    execute = get_db.return_value.cursor.return_value.execute
+    execute.return_value.fetchall.return_value = records_found
+    calls_ids = [1, 2, 3]
+
+    result = phone_bill.get_phone_start_records(calls_ids)
+
+    get_db.return_value.cursor.return_value.executemany.assert_called_once_with(
+        'INSERT OR IGNORE INTO temp_call_ids (call_identifier) VALUES (?)', mock.ANY
+    )
+    execute.assert_has_calls([
+        mock.call('CREATE TEMP TABLE IF NOT EXISTS temp_call_ids (call_identifier INTEGER PRIMARY KEY)'),
         mock.call(
-            records_found[1][0], records_found[1][1], records_found[1][2],
-            records_found[1][3], records_found[1][4], records_found[1][5]
+            'SELECT record_id, record_type, record_timestamp, call_identifier, origin_number, destination_number '
+            'FROM temp_call_ids CROSS JOIN phone_call USING (call_identifier) WHERE'
+            ' record_type = ? AND'
+            ' origin_key = ?',
+            ['start', 14981227001]
         ),
+        mock.call().fetchall(),
+        mock.call('DELETE FROM temp_call_ids'),
     ])
+    assert list(result) == [CallRecordData(*record) for record in records_found]
 
-    assert result == [
-        record_class(
-            records_found[0][0], records_found[0][1], records_found[0][2],
-            records_found[0][3], records_found[0][4], records_found[0][5]
-        ),
-        record_class(
-            records_found[1][0], records_found[1][1], records_found[1][2],
-            records_found[1][3], records_found[1][4], records_found[1][5]
-        ),
-    ]
+
+@mock.patch('api.queries.TEMP_TABLE_THRESHOLD', 2)
+def test_phone_bill_get_phone_start_records_temp_table_error(app, phone_bill):
+    """Test get_phone_start_records function clearing the temporary table when the query fails."""
+    with app.app_context():
+        db = get_db(readonly=True)
+        with mock.patch('api.queries.select_start_records_temp_table', return_value='SELECT missing'), \
+                pytest.raises(sqlite3.OperationalError):
+            phone_bill.get_phone_start_records([1, 2, 3])
+
+        assert db.execute('SELECT COUNT(*) FROM temp_call_ids').fetchone()[0] == 0
+
+
+@mock.patch('api.models.get_db')
+def test_phone_bill_get_phone_start_records_without_ids(get_db, phone_bill):
+    """Test get_phone_start_records function from PhoneBill class without calls ids."""
+    result = phone_bill.get_phone_start_records([])
+
+    assert len(result) == 0
+    get_db.assert_not_called()
 
 
 @mock.patch('api.models.get_by_id')
 @mock.patch('api.models.PhoneBillCall')
 def test_phone_bill_calculate_phone_bill(bill_call_class, get_by_id, phone_bill, record_start):
     """Test calculate_phone_bill function from PhoneBill class."""
-    phone_bill.get_phone_end_records = mock.Mock(return_value=[record_start])
+    phone_bill.get_phone_end_records = mock.Mock(return_value=[[record_start]])
     phone_bill.get_phone_start_records = mock.Mock(return_value=[record_start])
+    phone_bill.get_rated_calls = mock.Mock(return_value={})
     get_by_id.return_value = None
     bill_call_record = PhoneBillCall(
         record_start.destination_number,
@@ -526,12 +547,13 @@ def test_phone_bill_calculate_phone_bill(bill_call_class, get_by_id, phone_bill,
         record_start.record_timestamp,
         record_start.record_timestamp
     )
-    bill_call_class.return_value = bill_call_record
+    bill_call_class.from_values.return_value = bill_call_record
 
     phone_bill.calculate_phone_bill()
 
     phone_bill.get_phone_end_records.assert_called_once()
     phone_bill.get_phone_start_records.assert_called_once_with([1])
+    phone_bill.get_rated_calls.assert_called_once_with([1])
 
     assert phone_bill.record_calls == [bill_call_record]
 
@@ -547,8 +569,8 @@ def test_phone_bill_save(get_db, phone_bill):
     assert result
 
     get_db.return_value.cursor.return_value.execute.assert_called_once_with(
-        'INSERT INTO phone_bill (phone_number, period) VALUES (?, ?)',
-        [phone_bill.phone_number, phone_bill.period]
+        'INSERT INTO phone_bill (phone_number, period, phone_key) VALUES (?, ?, ?)',
+        [phone_bill.phone_number, phone_bill.period, 14981227001]
     )
 
 
@@ -568,6 +590,26 @@ def test_phone_bill_call_to_dict(phone_bill_call):
     }
 
 
+def test_phone_bill_call_from_row():
+    """Test from_row function from PhoneBillCall class."""
+    row = {
+        'id': 3,
+        'destination_number': '1434567890',
+        'bill_id': 1,
+        'call_identifier': 7,
+        'call_start': datetime(2018, 10, 11, 19, 22, 16),
+        'call_end': datetime(2018, 10, 11, 19, 24, 16),
+        'duration': '0:02:00',
+        'price': 0.54,
+    }
+
+    with mock.patch('api.models.get_by_id') as get_by_id:
+        result = PhoneBillCall.from_row(row)
+
+    get_by_id.assert_not_called()
+    assert result.to_dict() == row
+
+
 def test_phone_bill_call_validate(phone_bill_call):
     """Test validate function from PhoneBillCall class."""
     result = phone_bill_call.validate()
@@ -676,7 +718,7 @@ def test_check_exists_id():
     result = check_exists_id(cursor, table_name, id_field, id_value)
 
     assert result
-    cursor.execute.assert_called_once_with('SELECT 1 FROM table WHERE id_of_table = 33')
+    cursor.execute.assert_called_once_with('SELECT 1 FROM table WHERE id_of_table = ?', [33])
 
 
 @mock.patch('api.models.get_db')
@@ -693,7 +735,7 @@ def test_get_by_id(get_db):
     assert result
 
     get_db.return_value.cursor.return_value.execute.assert_called_once_with(
-        'SELECT * FROM table WHERE id_of_table = 33'
+        'SELECT * FROM table WHERE id_of_table = ?', [33]
     )
 
 
@@ -739,8 +781,9 @@ def test_calculate_phone_bill_with_data(get_by_id, phone_bill):
         CallRecord(None, 'start', '2018-10-30T05:30:04', 20, '14981226543', '1345632789')
     ]
 
-    phone_bill.get_phone_end_records = mock.Mock(return_value=end_records)
-    phone_bill.get_phone_start_records = mock.Mock(return_value=start_records)
+    phone_bill.get_phone_end_records = mock.Mock(return_value=[end_records[:6], end_records[6:]])
+    phone_bill.get_phone_start_records = mock.Mock(side_effect=[start_records[:6], start_records[6:]])
+    phone_bill.get_rated_calls = mock.Mock(return_value={})
     get_by_id.return_value = None
 
     phone_bill.calculate_phone_bill()
@@ -757,3 +800,51 @@ def test_calculate_phone_bill_with_data(get_by_id, phone_bill):
     assert phone_bill.record_calls[7].price == 11.43
     assert phone_bill.record_calls[8].price == 9.72
     assert phone_bill.record_calls[9].price == 3.15
+
+
+def test_calculate_phone_bill_rated_calls(query_log_app):
+    """Test calculate_phone_bill function reading the calls already rated with one query by chunk."""
+    with query_log_app.test_request_context():
+        for call_id in range(1, 51):
+            CallRecord(None, 'start', '2018-10-10T10:00:00', call_id, '14981227001', '1434567890').save()
+            CallRecord(None, 'end', '2018-10-10T10:05:00', call_id).save()
+        first = PhoneBill('14981227001', '10/2018')
+        first.calculate_phone_bill()
+        first.save()
+
+        with querylog.track_queries() as query_log:
+            second = PhoneBill('14981227001', '10/2018')
+            second.calculate_phone_bill()
+
+    assert len(second.record_calls) == 50
+    assert all(call.id for call in second.record_calls)
+    assert second.total == first.total
+    assert query_log.shapes['SELECT * FROM phone_bill_call WHERE call_identifier IN (?, ...)'][0] == 1
+    # the end records, the start records and the rated calls of the only chunk, the partitions are cached
+    assert query_log.count == 3
+
+
+@mock.patch('api.models.fetch_chunks', lambda cursor: fetch_chunks(cursor, 20))
+def test_iter_rated_chunks(app):
+    """Test iter_rated_chunks function rating and saving the bill chunk by chunk, without keeping the calls."""
+    with app.test_request_context():
+        for call_id in range(1, 51):
+            CallRecord(None, 'start', '2018-10-10T10:00:00', call_id, '14981227001', '1434567890').save()
+            CallRecord(None, 'end', '2018-10-10T10:05:00', call_id).save()
+        phone_bill = PhoneBill('14981227001', '10/2018')
+        chunks = []
+        for phone_bill_calls in phone_bill.iter_rated_chunks():
+            assert phone_bill.save_calls(phone_bill_calls)
+            chunks.append(len(phone_bill_calls))
+
+        saved = PhoneBill('14981227001', '10/2018')
+        saved.calculate_phone_bill()
+        empty = PhoneBill('14981227002', '10/2018')
+        empty_chunks = list(empty.iter_rated_chunks())
+
+    assert chunks == [20, 20, 10]
+    assert phone_bill.record_calls == []
+    assert phone_bill.total == saved.total
+    assert len({call.bill_id for call in saved.record_calls}) == 1
+    assert all(call.id for call in saved.record_calls)
+    assert empty_chunks == [[]]
@@ -0,0 +1,96 @@
+"""Tests for pairs.py file."""
+from datetime import datetime
+
+import pytest
+
+from api import pairs
+from api.db import get_db
+from api.models import CallRecord
+
+
+def write_record(db, call_identifier, record_type, timestamp):
+    """Write a call record without committing."""
+    CallRecord.from_row({
+        'record_id': None,
+        'record_type': record_type,
+        'record_timestamp': timestamp,
+        'call_identifier': call_identifier,
+        'origin_number': '14981227001' if record_type == 'start' else None,
+        'destination_number': '1434567890' if record_type == 'start' else None,
+    }).write(db)
+
+
+def pending(db):
+    """Return the pending pairs as tuples of call id and record type."""
+    return sorted(tuple(row) for row in db.execute('SELECT call_identifier, record_type FROM pending_pair'))
+
+
+@pytest.fixture
+def db(app):
+    """Fixture to return the connection of the database with a complete call and two orphan records."""
+    with app.app_context():
+        db = get_db()
+        write_record(db, 1, 'start', '2018-10-10T10:00:00')
+        write_record(db, 1, 'end', '2018-10-10T10:05:00')
+        write_record(db, 2, 'end', '2018-10-11T10:05:00')
+        write_record(db, 3, 'start', '2018-10-12T10:00:00')
+        db.commit()
+        yield db
+
+
+@pytest.mark.parametrize('record_type, expected_result', [
+    ('start', 'end'),
+    ('end', 'start'),
+])
+def test_partner_type(record_type, expected_result):
+    """Test partner_type function."""
+    assert pairs.partner_type(record_type) == expected_result
+
+
+def test_track_record(db):
+    """Test track_record function keeping only the records without partner."""
+    assert pending(db) == [(2, 'end'), (3, 'start')]
+
+    write_record(db, 2, 'start', '2018-10-11T10:00:00')
+
+    assert pending(db) == [(3, 'start')]
+
+
+def test_track_record_call_pair(db):
+    """Test track_record function storing the months of the calls with both records."""
+    write_record(db, 2, 'start', '2018-09-30T23:50:00')
+
+    rows = db.execute('SELECT * FROM call_pair ORDER BY call_identifier').fetchall()
+    assert [tuple(row) for row in rows] == [(1, 14981227001, 201810, 201810), (2, 14981227001, 201809, 201810)]
+
+
+def test_untrack_record(db):
+    """Test untrack_record function making the partner of a deleted record pending again."""
+    db.execute('DELETE FROM phone_call WHERE call_identifier = 1 AND record_type = ?', ['end'])
+    pairs.untrack_record(db, 1, 'end')
+    pairs.untrack_record(db, 3, 'start')
+
+    assert pending(db) == [(1, 'start'), (2, 'end')]
+    assert db.execute('SELECT COUNT(*) FROM call_pair').fetchone()[0] == 0
+
+
+def test_rebuild_pairs(db):
+    """Test rebuild_pairs function building the pending pairs with the phone_call table."""
+    db.execute('DROP TABLE pending_pair')
+    db.execute('DROP TABLE call_pair')
+    pairs.rebuild_pairs(db)
+
+    assert pending(db) == [(2, 'end'), (3, 'start')]
+    assert [row[0] for row in db.execute('SELECT call_identifier FROM call_pair')] == [1]
+
+
+def test_list_orphans(db):
+    """Test list_orphans function returning the orphan records older than the minimum age."""
+    base_date = datetime(2018, 10, 12, 12, 0, 0)
+
+    assert pairs.list_orphans(db, 3600, 10, base_date) == [
+        {'call_identifier': 2, 'record_type': 'end', 'record_timestamp': datetime(2018, 10, 11, 10, 5), 'age': 93300},
+        {'call_identifier': 3, 'record_type': 'start', 'record_timestamp': datetime(2018, 10, 12, 10), 'age': 7200},
+    ]
+    assert [orphan['call_identifier'] for orphan in pairs.list_orphans(db, 86400, 10, base_date)] == [2]
+    assert [orphan['call_identifier'] for orphan in pairs.list_orphans(db, 0, 1, base_date)] == [2]
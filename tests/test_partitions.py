@@ -0,0 +1,176 @@
+"""Tests for partitions.py file."""
+from datetime import datetime
+
+import pytest
+
+from api import partitions, querylog
+from api.db import get_db, init_db
+from api.models import CallRecord, PhoneBill
+
+
+def write_call(db, call_identifier, start, end):
+    """Write the start and the end records of a call."""
+    for record_type, timestamp, origin, destination in (
+        ('start', start, '14981227001', '1434567890'),
+        ('end', end, None, None),
+    ):
+        record = CallRecord.from_row({
+            'record_id': None,
+            'record_type': record_type,
+            'record_timestamp': timestamp,
+            'call_identifier': call_identifier,
+            'origin_number': origin,
+            'destination_number': destination,
+        })
+        record.write(db)
+    db.commit()
+
+
+@pytest.fixture
+def db(query_log_app):
+    """Fixture to return the connection of a partitioned database with calls of two months."""
+    with query_log_app.app_context():
+        db = get_db()
+        write_call(db, 1, '2018-09-30T23:50:00', '2018-10-01T00:10:00')
+        write_call(db, 2, '2018-10-10T10:00:00', '2018-10-10T10:05:00')
+        partitions.partition_calls(db)
+        db.commit()
+        yield db
+
+
+def test_partition_calls(db):
+    """Test partition_calls function moving the records to the partitions of their months."""
+    assert partitions.is_partitioned(db)
+    assert partitions.list_partitions(db) == ['phone_call_201809', 'phone_call_201810']
+    assert db.execute('SELECT COUNT(*) FROM phone_call_201809').fetchone()[0] == 1
+    assert db.execute('SELECT COUNT(*) FROM phone_call_201810').fetchone()[0] == 3
+    assert db.execute('SELECT COUNT(*) FROM phone_call_default').fetchone()[0] == 0
+    assert [row[0] for row in db.execute('SELECT record_id FROM phone_call ORDER BY record_id')] == [1, 2, 3, 4]
+
+
+def test_write_partitioned(db):
+    """Test CallRecord write on a partitioned database creating the partition and continuing the ids."""
+    write_call(db, 3, '2018-11-30T10:00:00', '2018-12-01T10:00:00')
+
+    assert partitions.list_partitions(db)[-2:] == ['phone_call_201811', 'phone_call_201812']
+    rows = db.execute('SELECT record_id, call_identifier FROM phone_call_201812').fetchall()
+    assert [tuple(row) for row in rows] == [(6, 3)]
+    assert db.execute('SELECT COUNT(*) FROM phone_call').fetchone()[0] == 6
+
+
+def test_write_cached_partitions(app, db):
+    """Test CallRecord write reading the partitions from sqlite_master only once by connection."""
+    partitions.get_partitions(db)
+    with app.test_request_context():
+        with querylog.track_queries() as query_log:
+            write_call(db, 3, '2018-10-11T10:00:00', '2018-10-11T10:05:00')
+            write_call(db, 4, '2018-10-12T10:00:00', '2018-10-12T10:05:00')
+
+    assert query_log.count > 0
+    assert not [shape for shape in query_log.shapes if 'sqlite_master' in shape]
+    assert db.execute('SELECT COUNT(*) FROM phone_call_201810').fetchone()[0] == 7
+
+
+def test_invalidate(db):
+    """Test invalidate function discarding the partitions cached on the connection and on all of them."""
+    assert partitions.get_partitions(db) == {'phone_call_201809', 'phone_call_201810'}
+    db.partition_state = (db.partition_state[0], None)
+    assert not partitions.is_partitioned(db)
+
+    partitions.invalidate(db)
+    assert partitions.is_partitioned(db)
+
+    db.partition_state = (db.partition_state[0], None)
+    partitions.invalidate()
+    assert partitions.is_partitioned(db)
+
+
+def test_write_update_moved(db):
+    """Test CallRecord write moving an updated record to the partition of its new month."""
+    record = CallRecord.from_row({
+        'record_id': 4,
+        'record_type': 'end',
+        'record_timestamp': '2018-11-10T10:05:00',
+        'call_identifier': 2,
+        'origin_number': None,
+        'destination_number': None,
+    })
+    record.write(db)
+    db.commit()
+
+    assert [row[0] for row in db.execute('SELECT record_id FROM phone_call_201810')] == [2, 3]
+    assert [row[0] for row in db.execute('SELECT record_id FROM phone_call_201811')] == [4]
+    assert partitions.record_table(db, 4) == 'phone_call_201811'
+    assert partitions.record_table(db, 99) is None
+
+
+def test_billing_tables(db):
+    """Test end_tables and start_tables functions reading only the month and the previous one."""
+    write_call(db, 3, '2018-11-30T10:00:00', '2018-12-01T10:00:00')
+
+    assert partitions.end_tables(db, 2018, 10) == ['phone_call_201810']
+    assert partitions.start_tables(db, 2018, 10) == ['phone_call_201809', 'phone_call_201810']
+    assert partitions.end_tables(db, 2019, 1) == []
+    assert partitions.start_tables(db, 2019, 1) == ['phone_call_201812']
+
+
+def test_billing_tables_not_partitioned(app):
+    """Test end_tables and start_tables functions on a database without partitions."""
+    with app.app_context():
+        db = get_db()
+        assert not partitions.is_partitioned(db)
+        assert partitions.end_tables(db, 2018, 10) == ['phone_call']
+        assert partitions.start_tables(db, 2018, 10) == ['phone_call']
+
+
+def test_phone_bill_partitioned(app, db):
+    """Test PhoneBill reading the calls that started on the previous partition."""
+    phone_bill = PhoneBill('14981227001', '10/2018')
+    phone_bill.calculate_phone_bill()
+
+    assert [call.call_identifier for call in phone_bill.record_calls] == [1, 2]
+    assert phone_bill.record_calls[0].call_start == datetime(2018, 9, 30, 23, 50)
+
+
+def test_phone_bill_boundary_index(app, db):
+    """Test PhoneBill reading the calls started on the previous partition only by the index of the call pairs."""
+    db.execute('DELETE FROM call_pair WHERE call_identifier = 1')
+    db.commit()
+
+    phone_bill = PhoneBill('14981227001', '10/2018')
+    phone_bill.calculate_phone_bill()
+
+    assert [call.call_identifier for call in phone_bill.record_calls] == [2]
+
+
+def test_previous_table(app, db):
+    """Test previous_table function returning the partition of the month before."""
+    assert partitions.previous_table(db, 2018, 10) == 'phone_call_201809'
+    assert partitions.previous_table(db, 2018, 9) is None
+
+
+def test_clear_calls(db):
+    """Test clear_calls function removing the partitions and restarting the ids."""
+    partitions.clear_calls(db)
+    write_call(db, 3, '2018-11-30T10:00:00', '2018-11-30T10:10:00')
+
+    assert partitions.list_partitions(db) == ['phone_call_201811']
+    assert [row[0] for row in db.execute('SELECT record_id FROM phone_call ORDER BY record_id')] == [1, 2]
+
+
+def test_init_db_partitioned(app, db):
+    """Test init_db function recreating the schema of a partitioned database."""
+    init_db()
+
+    assert not partitions.is_partitioned(db)
+    assert partitions.list_partitions(db) == []
+
+
+def test_partition_calls_command(app, runner):
+    """Test partition-calls command."""
+    with app.app_context():
+        write_call(get_db(), 1, '2018-10-10T10:00:00', '2018-10-10T10:05:00')
+
+    result = runner.invoke(args=['partition-calls'])
+
+    assert 'phone_call_201810: 2 records' in result.output
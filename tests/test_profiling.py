@@ -0,0 +1,85 @@
+"""Tests for profiling.py file."""
+import os
+import pstats
+import threading
+
+import mock
+import pytest
+
+from api import profiling
+
+
+PHONE_BILL_ENDPOINT = '/api/v1/phone_bill?subscriber=14981227001&period=10/2018'
+
+
+@pytest.fixture
+def profile_app(app, tmpdir):
+    """Fixture to return the app with the profiling enabled, writing the profiles on a temporary directory."""
+    app.config.update(PROFILE=True, PROFILE_DIRECTORY=str(tmpdir), PROFILE_INTERVAL=0.001)
+    return app
+
+
+def test_token(app):
+    """Test create_token and is_valid_token functions."""
+    token = profiling.create_token(app)
+
+    assert profiling.is_valid_token(app, token)
+    assert not profiling.is_valid_token(app, token + 'x')
+    assert not profiling.is_valid_token(app, 'profile')
+
+    app.config['PROFILE_TOKEN_MAX_AGE'] = -1
+    assert not profiling.is_valid_token(app, token)
+
+
+def test_stack_sampler():
+    """Test StackSampler class counting the stacks of the thread as collapsed stacks."""
+    sampler = profiling.StackSampler(threading.get_ident(), 1)
+
+    sampler.sample()
+    sampler.sample()
+
+    stack, count = sampler.collapsed().rsplit(' ', 1)
+    assert count == '2\n'
+    assert stack.split(';')[-1].startswith('sample (profiling.py:')
+    assert 'test_stack_sampler (test_profiling.py:' in stack
+
+
+def test_profile_token(profile_app, client, tmpdir):
+    """Test the request with a valid token profiled, with the files tagged by route, subscriber and period."""
+    client.get(PHONE_BILL_ENDPOINT)
+    assert os.listdir(str(tmpdir)) == []
+
+    client.get(PHONE_BILL_ENDPOINT, headers={profiling.PROFILE_HEADER: profiling.create_token(profile_app)})
+
+    names = sorted(os.listdir(str(tmpdir)))
+    assert [os.path.splitext(name)[1] for name in names] == ['.collapsed', '.pstats']
+    assert names[0].endswith('-api-v1-phone-bill-14981227001-10-2018.collapsed')
+    stats = pstats.Stats(os.path.join(str(tmpdir), names[1]))
+    assert any(function[2] == 'iter_rated_chunks' for function in stats.stats)
+
+
+def test_profile_sample(profile_app, client, tmpdir):
+    """Test one in every PROFILE_SAMPLE requests profiled."""
+    profile_app.config['PROFILE_SAMPLE'] = 3
+
+    with mock.patch('api.profiling._requests', iter(range(1, 10))):
+        for _ in range(6):
+            client.get(PHONE_BILL_ENDPOINT)
+
+    assert len(os.listdir(str(tmpdir))) == 4
+
+
+def test_profile_disabled(app, client, tmpdir):
+    """Test the requests not profiled when the PROFILE config is disabled, even with a valid token."""
+    app.config.update(PROFILE_DIRECTORY=str(tmpdir), PROFILE_SAMPLE=1)
+
+    client.get(PHONE_BILL_ENDPOINT, headers={profiling.PROFILE_HEADER: profiling.create_token(app)})
+
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_profile_token_command(app, runner):
+    """Test profile-token command creating a valid token."""
+    result = runner.invoke(args=['profile-token'])
+
+    assert profiling.is_valid_token(app, result.output.strip())
@@ -0,0 +1,41 @@
+"""Tests for queries.py file."""
+import pytest
+
+from api import queries
+
+
+@pytest.mark.parametrize('values, expected_result', [
+    ([], []),
+    ([5], [[5]]),
+    ([1, 2], [[1, 2, 2, 2, 2, 2, 2, 2]]),
+    (list(range(8)), [list(range(8))]),
+    (list(range(300)), [list(range(256)), list(range(256, 300)) + [299] * 84]),
+])
+def test_in_list_chunks(values, expected_result):
+    """Test in_list_chunks function."""
+    result = queries.in_list_chunks(values)
+
+    assert result == expected_result
+
+
+def test_select_start_records():
+    """Test select_start_records function."""
+    result = queries.select_start_records(2)
+
+    assert result == (
+        'SELECT record_id, record_type, record_timestamp, call_identifier, origin_number, destination_number '
+        'FROM phone_call WHERE record_type = ? AND origin_key = ? AND call_identifier IN (?, ?)'
+    )
+    assert queries.select_start_records(2) is result
+
+
+def test_insert_update():
+    """Test insert and update functions."""
+    assert queries.insert('table', ('a', 'b')) == 'INSERT INTO table (a, b) VALUES (?, ?)'
+    assert queries.update('table', ('a', 'b'), 'id') == 'UPDATE table SET a = ?, b = ? WHERE id = ?'
+
+
+def test_select_by_id():
+    """Test select_by_id function."""
+    assert queries.select_by_id('table', 'id') == 'SELECT * FROM table WHERE id = ?'
+    assert queries.select_by_id('table', 'id', ('a', 'b')) == 'SELECT a, b FROM table WHERE id = ?'
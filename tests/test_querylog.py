@@ -0,0 +1,95 @@
+"""Tests for querylog.py file."""
+import logging
+
+import pytest
+
+from api import querylog
+from api.db import get_db
+
+
+PHONE_BILL_ENDPOINT = '/api/v1/phone_bill?subscriber=14981227001&period=10/2018'
+
+
+@pytest.mark.parametrize('sql, shape', [
+    ('SELECT 1 FROM phone_call WHERE record_id = ?', 'SELECT ? FROM phone_call WHERE record_id = ?'),
+    ("SELECT *\n    FROM phone_call_201810\n    WHERE origin_key = '14981227001'",
+     'SELECT * FROM phone_call_201810 WHERE origin_key = ?'),
+    ('SELECT * FROM phone_call WHERE call_identifier IN (?, ?,?)',
+     'SELECT * FROM phone_call WHERE call_identifier IN (?, ...)'),
+    ("UPDATE phone_bill SET total = 1.5, period = 'it''s' WHERE id = 3",
+     'UPDATE phone_bill SET total = ?, period = ? WHERE id = ?'),
+])
+def test_normalize_statement(sql, shape):
+    """Test normalize_statement function collapsing the values and the lists of parameters."""
+    assert querylog.normalize_statement(sql) == shape
+
+
+def test_query_log():
+    """Test QueryLog class recording the statements by shape."""
+    query_log = querylog.QueryLog()
+
+    for record_id in range(3):
+        entry = query_log.record('SELECT * FROM phone_call WHERE record_id = {}'.format(record_id), 0.002)
+        query_log.add_rows(entry, 1)
+    query_log.record('DELETE FROM phone_call', 0.004, rows=5)
+
+    assert query_log.count == 4
+    assert query_log.rows == 8
+    assert query_log.summary() == '4 / 10ms'
+    assert query_log.shapes['SELECT * FROM phone_call WHERE record_id = ?'] == [3, pytest.approx(0.006), 3]
+    assert query_log.repeated(2) == [('SELECT * FROM phone_call WHERE record_id = ?', 3)]
+    assert query_log.repeated(3) == []
+
+
+def test_track_queries(query_log_app):
+    """Test track_queries function recording the statements of the block, with the rows read and written."""
+    with query_log_app.app_context():
+        db = get_db()
+        db.execute('CREATE TEMP TABLE numbers (value INTEGER)')
+        with querylog.track_queries() as query_log:
+            db.executemany('INSERT INTO numbers VALUES (?)', [(1,), (2,), (3,)])
+            assert len(db.execute('SELECT value FROM numbers').fetchall()) == 3
+            assert [row[0] for row in get_db().execute('SELECT value FROM numbers WHERE value > 1')] == [2, 3]
+            assert db.execute('SELECT value FROM numbers WHERE value = 9').fetchone() is None
+        db.execute('SELECT value FROM numbers').fetchall()
+
+    assert query_log.count == 4
+    assert query_log.rows == 8
+    assert query_log.shapes['SELECT value FROM numbers'][2] == 3
+
+
+def test_query_log_header(app, client, caplog):
+    """Test the requests returning the summary of their statements, and logging the repeated statements."""
+    app.config.update(DATABASE_QUERY_LOG=True, DATABASE_REPEATED_STATEMENTS=0)
+
+    with caplog.at_level(logging.INFO):
+        result = client.get(PHONE_BILL_ENDPOINT)
+
+    count, duration = result.headers['X-DB-Queries'].split(' / ')
+    assert int(count) > 0
+    assert duration.endswith('ms')
+    assert any('Statement repeated' in record.getMessage() for record in caplog.records)
+
+
+def test_query_log_disabled(client):
+    """Test the requests without the summary of the statements when the query log is disabled."""
+    assert 'X-DB-Queries' not in client.get(PHONE_BILL_ENDPOINT).headers
+
+
+def test_query_budget_exceeded(app, client):
+    """Test the requests over the budget of their endpoint failing when testing."""
+    app.config.update(DATABASE_QUERY_LOG=True, DATABASE_QUERY_BUDGETS={'api.phone_bill': 1})
+
+    with pytest.raises(querylog.QueryBudgetExceeded):
+        client.get(PHONE_BILL_ENDPOINT)
+
+
+def test_query_budget_logged(app, client, caplog):
+    """Test the requests over the budget of their endpoint being logged out of the tests."""
+    app.config.update(DATABASE_QUERY_LOG=True, DATABASE_QUERY_BUDGETS={'api.phone_bill': 1})
+    app.testing = False
+
+    result = client.get(PHONE_BILL_ENDPOINT)
+
+    assert result.status_code == 200
+    assert any('over its budget of 1' in record.getMessage() for record in caplog.records)
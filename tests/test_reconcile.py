@@ -0,0 +1,45 @@
+"""Tests for reconcile.py file."""
+from api.db import get_db
+from api.models import CallRecord
+from api.reconcile import find_orphans
+
+
+def save_records(app):
+    """Save a complete call and an end record without start."""
+    with app.app_context():
+        CallRecord(None, 'start', '2018-10-10T10:00:00', 1, '14981227001', '1434567890').save()
+        CallRecord(None, 'end', '2018-10-10T10:05:00', 1).save()
+        CallRecord(None, 'end', '2018-10-11T10:05:00', 2).save()
+
+
+def test_find_orphans(app):
+    """Test find_orphans function listing the records without partner."""
+    save_records(app)
+
+    with app.app_context():
+        orphans = find_orphans(0, 10)
+
+    assert [(orphan['call_identifier'], orphan['record_type']) for orphan in orphans] == [(2, 'end')]
+
+
+def test_reconcile_command(app, runner):
+    """Test reconcile command listing the orphan records."""
+    save_records(app)
+
+    result = runner.invoke(args=['reconcile', '--min-age', '0'])
+
+    assert '2 end 2018-10-11 10:05:00' in result.output
+    assert '1 records without the start or the end record.' in result.output
+
+
+def test_reconcile_command_rebuild(app, runner):
+    """Test reconcile command rebuilding the index of a database without it."""
+    save_records(app)
+    with app.app_context():
+        db = get_db()
+        db.execute('DROP TABLE pending_pair')
+        db.commit()
+
+    result = runner.invoke(args=['reconcile', '--min-age', '0', '--rebuild'])
+
+    assert '1 records without the start or the end record.' in result.output
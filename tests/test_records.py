@@ -0,0 +1,45 @@
+"""Tests for records.py file."""
+from datetime import datetime
+
+from api.records import CallBatch, CallRecordData, from_epoch_seconds, to_epoch_seconds
+
+
+ROWS = [
+    [22, 'start', datetime(2018, 10, 11, 19, 22, 16), 1, '14981227001', '1434567890'],
+    [23, 'start', '2018-10-12T07:58:00', 2, '14981227001', '1434567891'],
+]
+
+
+def test_epoch_seconds():
+    """Test to_epoch_seconds and from_epoch_seconds functions."""
+    value = datetime(2018, 10, 11, 19, 22, 16)
+
+    assert to_epoch_seconds(value) == 1539285736
+    assert from_epoch_seconds(to_epoch_seconds(value)) == value
+
+
+def test_call_batch_from_rows():
+    """Test from_rows function from CallBatch class."""
+    batch = CallBatch.from_rows('start', ROWS)
+
+    assert len(batch) == 2
+    assert list(batch.call_identifiers) == [1, 2]
+    assert batch[1] == CallRecordData(23, 'start', datetime(2018, 10, 12, 7, 58), 2, '14981227001', '1434567891')
+    assert batch.origin_numbers[0] is batch.origin_numbers[1]
+
+
+def test_call_batch_end_records():
+    """Test CallBatch class with records without phone numbers."""
+    batch = CallBatch('end')
+    batch.append(25, datetime(2018, 10, 11, 20, 3, 43), 1)
+
+    assert list(batch) == [CallRecordData(25, 'end', datetime(2018, 10, 11, 20, 3, 43), 1)]
+
+
+def test_call_batch_extend():
+    """Test extend function from CallBatch class."""
+    batch = CallBatch.from_rows('start', ROWS[:1])
+    batch.extend(CallBatch.from_rows('start', ROWS[1:]))
+
+    assert len(batch) == 2
+    assert sorted(batch.by_call_identifier()) == [1, 2]
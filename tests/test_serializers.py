@@ -0,0 +1,135 @@
+"""Tests for serializers.py file."""
+import io
+from datetime import date, datetime, timedelta, timezone
+
+import mock
+import pytest
+from flask import jsonify
+from werkzeug.http import http_date
+
+from api import serializers
+from api.models import PhoneBill, PhoneBillCall
+
+
+@pytest.fixture
+def bill():
+    """Fixture to return a calculated phone bill with two calls, without querying the database."""
+    phone_bill = PhoneBill('14981227001', '10/2018')
+    for call_identifier, start, end, price in ((1, '2018-10-05T06:00:00', '2018-10-05T06:00:02', 0.36),
+                                                (2, '2018-10-25T19:56:23', '2018-10-25T22:00:00', 11.43)):
+        call = PhoneBillCall.__new__(PhoneBillCall)
+        call.id = call_identifier
+        call.bill_id = None
+        call.call_identifier = call_identifier
+        call.destination_number = '1943536785'
+        call.call_start = datetime.strptime(start, '%Y-%m-%dT%H:%M:%S')
+        call.call_end = datetime.strptime(end, '%Y-%m-%dT%H:%M:%S')
+        call.duration = str(call.call_end - call.call_start)
+        call.price = price
+        phone_bill.record_calls.append(call)
+    phone_bill.total = 11.79
+
+    return phone_bill
+
+
+@pytest.mark.parametrize('value', [
+    datetime(2018, 10, 5, 6, 0, 2),
+    datetime(2020, 2, 29, 23, 59, 59, 999999),
+    datetime(1999, 12, 31),
+    date(2018, 1, 1),
+    datetime(2018, 10, 5, 6, 0, 2, tzinfo=timezone(timedelta(hours=-3))),
+])
+def test_format_http_date(value):
+    """Test format_http_date function formatting as werkzeug http_date."""
+    assert serializers.format_http_date(value) == http_date(value)
+
+
+def test_dumps_phone_bill(app, bill):
+    """Test dumps function encoding the bill with the same bytes of jsonify."""
+    value = {'success': True, 'data': bill}
+
+    with app.test_request_context():
+        expected = jsonify({'success': True, 'data': bill.to_dict()}).get_data()
+
+    assert serializers.dumps(value) + b'\n' == expected
+
+
+@mock.patch('api.serializers.orjson', None)
+def test_dumps_python_encoders(app):
+    """Test dumps function with the python encoders for all the json types."""
+    value = {
+        'b': [1, 2.5, None, True, False, (3, 'x')],
+        'a': {'text': 'ação "quoted"\n', 'date': date(2018, 10, 1), 'number': -0.1 + 0.3},
+    }
+
+    with app.test_request_context():
+        expected = jsonify(value).get_data()
+
+    assert serializers.dumps(value) + b'\n' == expected
+
+
+def test_dumps_to_dict(app):
+    """Test dumps function encoding the objects without encoder by their to_dict method."""
+    value = mock.Mock()
+    value.to_dict.return_value = {'b': 1, 'a': 2}
+
+    assert serializers.dumps([value]) == b'[{"a":2,"b":1}]'
+
+
+@mock.patch('api.serializers.orjson', None)
+def test_dumps_invalid_type():
+    """Test dumps function with a type that can not be encoded."""
+    with pytest.raises(TypeError):
+        serializers.dumps({'value': object()})
+
+
+def test_json_response(app, bill):
+    """Test json_response function returning the same response of jsonify."""
+    with app.test_request_context():
+        response = serializers.json_response({'success': True, 'data': bill})
+        expected = jsonify({'success': True, 'data': bill.to_dict()})
+
+    assert response.get_data() == expected.get_data()
+    assert response.mimetype == 'application/json'
+
+
+def test_json_response_debug(app, bill):
+    """Test json_response function keeping the indented documents of jsonify on the debug mode."""
+    app.debug = True
+    with app.test_request_context():
+        response = serializers.json_response({'success': True, 'data': bill})
+        expected = jsonify({'success': True, 'data': bill.to_dict()})
+
+    assert response.get_data() == expected.get_data()
+
+
+@pytest.mark.parametrize('chunks', [[[0], [], [1]], [[0, 1]], [[], [0, 1], []]])
+def test_bill_writer(app, bill, chunks):
+    """Test BillWriter writing the bill chunk by chunk with the same bytes of jsonify."""
+    body = io.BytesIO()
+    writer = serializers.BillWriter(body, bill)
+    for chunk in chunks:
+        writer.write_calls([bill.record_calls[index] for index in chunk])
+    writer.finish()
+
+    with app.test_request_context():
+        expected = jsonify({'success': True, 'data': bill.to_dict()}).get_data()
+
+    assert body.getvalue() == expected
+
+
+def test_file_response(app):
+    """Test file_response function reading the small bodies and streaming the big ones from the file."""
+    with app.test_request_context():
+        small_body = io.BytesIO()
+        small_body.write(b'{"a":1}\n')
+        small = serializers.file_response(small_body, 8)
+        big_body = io.BytesIO()
+        big_body.write(b'{"a":1}\n' * 3)
+        big = serializers.file_response(big_body, 8)
+
+    assert not small.is_streamed
+    assert small.get_data() == b'{"a":1}\n'
+    assert big.is_streamed
+    assert big.content_length == 24
+    assert big.get_data() == b'{"a":1}\n' * 3
@@ -0,0 +1,250 @@
+"""Tests for shards.py file."""
+import os
+import sqlite3
+
+import mock
+import pytest
+
+from api import create_app, journal as journal_module, shards
+from api.db import get_db, init_db, shard_names, shard_path, use_shard
+from api.models import CallRecord, PhoneBill
+from api.utils import normalize_phone_number
+
+
+@pytest.fixture
+def sharded_app(tmpdir):
+    """Fixture to return an app with the records stored on 3 shards."""
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': str(tmpdir.join('phone_bills.sqlite')),
+        'DATABASE_SHARDS': 3,
+    })
+
+    with app.app_context():
+        init_db()
+
+    yield app
+
+    app.extensions['db'].close_all()
+
+
+def count_records(app, name, call_identifier):
+    """Return the number of records of the call on the shard, read directly from its file."""
+    with sqlite3.connect(shard_path(app, name)) as connection:
+        query = 'SELECT COUNT(*) FROM phone_call WHERE call_identifier = ?'
+        return connection.execute(query, [call_identifier]).fetchone()[0]
+
+
+def save_call(call_identifier, origin, start='2018-10-10T10:00:00', end='2018-10-10T10:05:00', end_first=False):
+    """Save the start and the end records of the call."""
+    records = [
+        CallRecord(None, 'start', start, call_identifier, origin, '1434567890'),
+        CallRecord(None, 'end', end, call_identifier),
+    ]
+    for record in reversed(records) if end_first else records:
+        record.save()
+
+
+def test_shard_ring_distribution():
+    """Test ShardRing spreading the keys and moving few keys when a shard is added."""
+    ring = shards.ShardRing(shard_names(3))
+    keys = ['subscriber:{}'.format(number) for number in range(3000)]
+
+    counts = {name: 0 for name in ring.names}
+    for key in keys:
+        counts[ring.get(key)] += 1
+    assert all(count > 600 for count in counts.values())
+
+    bigger_ring = shards.ShardRing(shard_names(4))
+    moved = [key for key in keys if ring.get(key) != bigger_ring.get(key)]
+    assert len(moved) < len(keys) / 2
+    assert all(bigger_ring.get(key) == 'shard3' for key in moved)
+
+
+def test_shard_path(app):
+    """Test shard_path function placing the shards next to the database file."""
+    root, _ = os.path.splitext(app.config['DATABASE'])
+
+    assert shard_path(app, 'shard1') == root + '.shard1.sqlite'
+
+
+def test_sharding_disabled(app):
+    """Test the routing functions when the sharding is disabled."""
+    with app.app_context():
+        assert shards.get_ring() is None
+        assert shards.record_shard('start', 1, '14981227001') is None
+        assert shards.scatter(lambda db: db.execute('SELECT 1').fetchone()[0]) == [1]
+
+
+def test_init_db_shards(sharded_app):
+    """Test init_db function creating the schema on all the shards."""
+    for name in shard_names(3):
+        assert count_records(sharded_app, name, 1) == 0
+
+
+def test_save_on_subscriber_shard(sharded_app):
+    """Test CallRecord save storing the records of the call on the shard of the subscriber."""
+    with sharded_app.app_context():
+        save_call(1, '14981227001')
+        shard = shards.subscriber_shard(normalize_phone_number('14981227001'))
+
+    for name in shard_names(3):
+        assert count_records(sharded_app, name, 1) == (2 if name == shard else 0)
+
+
+def test_claim_pending_end(sharded_app):
+    """Test the end record received before the start record being moved to the shard of the subscriber."""
+    with sharded_app.app_context():
+        shard = shards.subscriber_shard(normalize_phone_number('14981227001'))
+        call_identifier = next(value for value in range(1, 100) if shards.pending_shard(value) != shard)
+        pending = shards.pending_shard(call_identifier)
+
+        CallRecord(None, 'end', '2018-10-10T10:05:00', call_identifier).save()
+        assert count_records(sharded_app, pending, call_identifier) == 1
+
+        CallRecord(None, 'start', '2018-10-10T10:00:00', call_identifier, '14981227001', '1434567890').save()
+
+    assert count_records(sharded_app, pending, call_identifier) == 0
+    assert count_records(sharded_app, shard, call_identifier) == 2
+    for name in (pending, shard):
+        with sqlite3.connect(shard_path(sharded_app, name)) as connection:
+            assert connection.execute('SELECT COUNT(*) FROM pending_pair').fetchone()[0] == 0
+
+
+def test_settle_pending_end(sharded_app):
+    """Test the end record routed before its start record was saved being moved after it is saved."""
+    with sharded_app.app_context():
+        shard = shards.subscriber_shard(normalize_phone_number('14981227001'))
+        call_identifier = next(value for value in range(1, 100) if shards.pending_shard(value) != shard)
+        pending = shards.pending_shard(call_identifier)
+
+        end_record = CallRecord(None, 'end', '2018-10-10T10:05:00', call_identifier)
+        assert end_record.route() == pending
+        CallRecord(None, 'start', '2018-10-10T10:00:00', call_identifier, '14981227001', '1434567890').save()
+        end_record.save()
+        assert end_record.route() == shard
+
+    assert count_records(sharded_app, pending, call_identifier) == 0
+    assert count_records(sharded_app, shard, call_identifier) == 2
+
+
+def test_route_resolved_once(sharded_app):
+    """Test CallRecord route looking for the start record on the shards only once by record."""
+    with sharded_app.app_context():
+        save_call(1, '14981227001')
+        end_record = CallRecord(None, 'end', '2018-10-10T10:05:00', 1)
+        with mock.patch('api.shards.find_start_shard', wraps=shards.find_start_shard) as find_start_shard:
+            assert end_record.exists_call_id()
+            assert end_record.validate()
+            end_record.route()
+
+    find_start_shard.assert_called_once_with(1)
+
+
+def test_find_start_shard_cached(sharded_app):
+    """Test find_start_shard function querying the cached shard of the start, and all the shards when not cached."""
+    with sharded_app.app_context():
+        shard = shards.subscriber_shard(normalize_phone_number('14981227001'))
+        CallRecord(None, 'start', '2018-10-10T10:00:00', 7, '14981227001', '1434567890').save()
+
+        with mock.patch('api.shards.use_shard', wraps=use_shard) as mock_use_shard:
+            assert shards.find_start_shard(7) == shard
+        assert [args for args, _ in mock_use_shard.call_args_list] == [(shard,)]
+
+        sharded_app.extensions['start_shards'].discard()
+        with mock.patch('api.shards.use_shard', wraps=use_shard) as mock_use_shard:
+            assert shards.find_start_shard(7) == shard
+            assert shards.find_start_shard(8) is None
+        assert mock_use_shard.call_count == shard_names(3).index(shard) + 1 + 3
+        assert sharded_app.extensions['start_shards'].get(7) == shard
+
+
+def test_reconcile_pending(sharded_app):
+    """Test reconcile command moving the end records left on their pending shards."""
+    with sharded_app.app_context():
+        shard = shards.subscriber_shard(normalize_phone_number('14981227001'))
+        call_identifier = next(value for value in range(1, 100) if shards.pending_shard(value) != shard)
+        pending = shards.pending_shard(call_identifier)
+        with mock.patch('api.shards.settle_pending_end', side_effect=lambda call_identifier, shard: shard):
+            CallRecord(None, 'start', '2018-10-10T10:00:00', call_identifier, '14981227001', '1434567890').save()
+            with mock.patch('api.shards.find_start_shard', return_value=None):
+                CallRecord(None, 'end', '2018-10-10T10:05:00', call_identifier).save()
+    assert count_records(sharded_app, pending, call_identifier) == 1
+
+    result = sharded_app.test_cli_runner().invoke(args=['reconcile', '--pending'])
+
+    assert '1 pending end records moved.' in result.output
+    assert count_records(sharded_app, pending, call_identifier) == 0
+    assert count_records(sharded_app, shard, call_identifier) == 2
+
+
+def test_replay_sharded(sharded_app, tmpdir):
+    """Test replay function writing the records on their shards, the end records replayed before their starts."""
+    journal = journal_module.Journal(str(tmpdir.join('journal')), fsync=False)
+    with sharded_app.app_context():
+        shard = shards.subscriber_shard(normalize_phone_number('14981227001'))
+        call_identifier = next(value for value in range(1, 100) if shards.pending_shard(value) != shard)
+        journal.append([CallRecord(None, 'end', '2018-10-10T10:05:00', call_identifier)])
+        journal.append([CallRecord(None, 'start', '2018-10-10T10:00:00', call_identifier, '14981227001', '1434567890')])
+
+        assert journal_module.replay(journal, get_db(), batch_size=1) == (2, 2)
+
+    for name in shard_names(3):
+        assert count_records(sharded_app, name, call_identifier) == (2 if name == shard else 0)
+
+
+def test_phone_bill_sharded(sharded_app):
+    """Test PhoneBill calculated and saved on the shard of the subscriber."""
+    with sharded_app.app_context():
+        save_call(1, '14981227001')
+        save_call(2, '14981227001', end_first=True)
+        save_call(3, '14981227002')
+
+        phone_bill = PhoneBill('14981227001', '10/2018')
+        phone_bill.calculate_phone_bill()
+        assert phone_bill.save()
+        assert [call.call_identifier for call in phone_bill.record_calls] == [1, 2]
+
+        with use_shard(shards.subscriber_shard(phone_bill.phone_key)):
+            assert phone_bill.exists_period() == phone_bill.id
+
+
+def test_rebalance_shards_command(sharded_app):
+    """Test rebalance-shards command moving the subscribers after a shard is added."""
+    numbers = ['149812270{:02}'.format(index) for index in range(12)]
+    with sharded_app.app_context():
+        for index, number in enumerate(numbers, 1):
+            save_call(index, number)
+        PhoneBill(numbers[0], '10/2018').save()
+
+    sharded_app.config['DATABASE_SHARDS'] = 4
+    shards.init_app(sharded_app)
+    result = sharded_app.test_cli_runner().invoke(args=['rebalance-shards', '--previous', '3'])
+
+    assert 'shard3: created.' in result.output
+    with sharded_app.app_context():
+        for index, number in enumerate(numbers, 1):
+            shard = shards.subscriber_shard(normalize_phone_number(number))
+            for name in shard_names(4):
+                assert count_records(sharded_app, name, index) == (2 if name == shard else 0)
+
+            phone_bill = PhoneBill(number, '10/2018')
+            phone_bill.calculate_phone_bill()
+            assert [call.call_identifier for call in phone_bill.record_calls] == [index]
+
+
+def test_rebalance_shards_disabled(runner):
+    """Test rebalance-shards command when the sharding is disabled."""
+    result = runner.invoke(args=['rebalance-shards', '--previous', '2'])
+
+    assert 'The sharding is disabled' in result.output
+
+
+def test_get_db_shard(sharded_app):
+    """Test get_db returning the connection of the selected shard."""
+    with sharded_app.app_context():
+        main = get_db()
+        with use_shard('shard1'):
+            assert get_db() is not main
+            assert get_db() is get_db()
+        assert get_db() is main
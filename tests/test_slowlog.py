@@ -0,0 +1,151 @@
+"""Tests for slowlog.py file."""
+import json
+import tracemalloc
+
+import mock
+import pytest
+
+from api import slowlog
+
+
+PHONE_CALL_ENDPOINT = '/api/v1/phone_call'
+PHONE_BILL_ENDPOINT = '/api/v1/phone_bill?subscriber=14981227001&period=10/2018'
+ENTRIES = [
+    {'route': '/api/v1/phone_bill', 'subscriber': '14981227001', 'duration': 2.0, 'memory': 1048576, 'calls': 10},
+    {'route': '/api/v1/phone_bill', 'subscriber': '14981227002', 'duration': 1.5, 'memory': 8388608, 'calls': 900},
+    {'route': '/api/v1/phone_bill', 'subscriber': '14981227001', 'duration': 3.0, 'memory': None, 'calls': 20},
+    {'route': '/api/v1/phone_call', 'subscriber': None, 'duration': 1.0, 'memory': 0, 'calls': None},
+]
+
+
+@pytest.fixture
+def slowlog_app(app, tmpdir):
+    """Fixture to return the app logging all the requests as slow, on a temporary file."""
+    app.config.update(SLOW_REQUEST_THRESHOLD=1e-9, SLOW_REQUEST_FILE=str(tmpdir.join('slow.jsonl')))
+    # the connections already open do not record the statements
+    app.extensions['db'].close_all()
+    return app
+
+
+def read_entries(app):
+    """Return the entries of the slow request log of the app."""
+    return list(slowlog.read_log(slowlog.get_path(app)))
+
+
+def test_slow_bill(slowlog_app, client):
+    """Test the slow phone bill logged with its parameters, its statements, its calls and its memory."""
+    client.post(PHONE_CALL_ENDPOINT, json=[
+        {'type': 'start', 'timestamp': '2018-10-10T10:00:00', 'call_id': 1,
+         'source': '14981227001', 'destination': '1434567890'},
+        {'type': 'end', 'timestamp': '2018-10-10T10:05:00', 'call_id': 1},
+    ])
+
+    result = client.get(PHONE_BILL_ENDPOINT)
+
+    assert 'X-DB-Queries' not in result.headers
+    ingestion, bill = read_entries(slowlog_app)
+    assert ingestion['records'] == 2
+    assert ingestion['payload_size'] > 0
+    assert ingestion['rows_written'] >= 2
+    assert bill['route'] == '/api/v1/phone_bill'
+    assert bill['status'] == 200
+    assert (bill['subscriber'], bill['period'], bill['calls']) == ('14981227001', '10/2018', 1)
+    assert bill['queries'] > 0
+    assert bill['rows_read'] > 0
+    assert bill['memory_source'] == 'rss'
+    assert bill['memory'] >= 0
+
+
+def test_fast_request(slowlog_app, client):
+    """Test the requests under the threshold not logged."""
+    slowlog_app.config['SLOW_REQUEST_THRESHOLD'] = 60
+
+    client.get(PHONE_BILL_ENDPOINT)
+
+    with pytest.raises(IOError):
+        read_entries(slowlog_app)
+
+
+def test_failed_request(slowlog_app, client):
+    """Test the failed requests logged with their error."""
+    with mock.patch('api.api.PhoneBill.iter_rated_chunks', side_effect=MemoryError()), \
+            pytest.raises(MemoryError):
+        client.get(PHONE_BILL_ENDPOINT)
+
+    entry, = read_entries(slowlog_app)
+    assert entry['status'] == 500
+    assert entry['error'] == 'MemoryError()'
+
+
+def test_tracemalloc(slowlog_app, client):
+    """Test the memory of the request traced by tracemalloc when it is tracing."""
+    tracemalloc.start()
+    try:
+        client.get(PHONE_BILL_ENDPOINT)
+    finally:
+        tracemalloc.stop()
+
+    entry, = read_entries(slowlog_app)
+    assert entry['memory_source'] == 'tracemalloc'
+    assert entry['memory'] > 0
+
+
+def test_memory_concurrent_requests():
+    """Test the memory reported only for the requests that did not overlap other requests."""
+    tracemalloc.start()
+    try:
+        first = slowlog.start_memory()
+        second = slowlog.start_memory()
+        assert slowlog.finish_memory(*first) is None
+        assert slowlog.finish_memory(*second) is None
+
+        alone = slowlog.start_memory()
+        data = bytearray(1048576)
+        del data
+        assert slowlog.finish_memory(*alone) > 1000000
+    finally:
+        tracemalloc.stop()
+
+
+def test_note(app):
+    """Test note function adding the values only to the entries of the measured requests."""
+    with app.test_request_context():
+        slowlog.note(calls=1)
+
+        slowlog.g.slow_request = {}
+        slowlog.note(calls=2)
+        assert slowlog.g.slow_request == {'calls': 2}
+        del slowlog.g.slow_request
+
+    slowlog.note(calls=3)
+
+
+def test_aggregate():
+    """Test aggregate function grouping the entries and ordering the groups by the maximum of the field."""
+    by_memory = slowlog.aggregate(ENTRIES, 'subscriber', 'memory', 10)
+    by_duration = slowlog.aggregate(ENTRIES, 'subscriber', 'duration', 1)
+
+    assert [group['subscriber'] for group in by_memory] == ['14981227002', '14981227001', '-']
+    assert by_memory[1] == {
+        'subscriber': '14981227001', 'requests': 2, 'total_duration': 5.0,
+        'duration': 3.0, 'memory': 1048576, 'calls': 20, 'queries': None, 'rows_read': None,
+        'rows_written': None,
+    }
+    assert [group['subscriber'] for group in by_duration] == ['14981227001']
+
+
+def test_slow_requests_command(app, runner, tmpdir):
+    """Test slow-requests command listing the top offenders of the log."""
+    path = tmpdir.join('slow.jsonl')
+    path.write(''.join(json.dumps(entry) + '\n' for entry in ENTRIES) + '{"partial')
+
+    result = runner.invoke(args=['slow-requests', '--file', str(path), '--by', 'route', '--sort', 'calls'])
+
+    lines = result.output.splitlines()
+    assert lines[0].split()[:2] == ['route', 'requests']
+    assert lines[1].split() == ['/api/v1/phone_bill', '3', '6.500', '3.000', '8.0', '900', '-', '-', '-']
+    assert lines[2].split()[:2] == ['/api/v1/phone_call', '1']
+
+    result = runner.invoke(args=['slow-requests', '--file', str(tmpdir.join('missing.jsonl'))])
+    assert result.exit_code != 0
+    assert 'does not exist' in result.output
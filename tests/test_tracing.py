@@ -0,0 +1,131 @@
+"""Tests for tracing.py file."""
+import json
+
+import mock
+import pytest
+
+from api import tracing
+
+
+PHONE_CALL_ENDPOINT = '/api/v1/phone_call'
+PHONE_BILL_ENDPOINT = '/api/v1/phone_bill?subscriber=14981227001&period=10/2018'
+TRACES_ENDPOINT = '/api/v1/traces'
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+TRACEPARENT = '00-{}-00f067aa0ba902b7-01'.format(TRACE_ID)
+
+
+@pytest.fixture
+def tracing_app(app):
+    """Fixture to return the app with the tracing enabled."""
+    app.config['TRACING'] = True
+    tracing.init_app(app)
+    return app
+
+
+@pytest.mark.parametrize('value, expected', [
+    (TRACEPARENT, (TRACE_ID, '00f067aa0ba902b7', True)),
+    ('00-{}-00f067aa0ba902b7-00'.format(TRACE_ID.upper()), (TRACE_ID, '00f067aa0ba902b7', False)),
+    ('00-{}-00f067aa0ba902b7-01'.format('0' * 32), None),
+    ('00-{}-{}-01'.format(TRACE_ID, '0' * 16), None),
+    ('invalid', None),
+    (None, None),
+])
+def test_parse_traceparent(value, expected):
+    """Test parse_traceparent function."""
+    assert tracing.parse_traceparent(value) == expected
+
+
+def test_span(app):
+    """Test span function recording the nested spans on the trace of the request."""
+    with app.test_request_context():
+        with tracing.span('outside') as span:
+            assert span is None
+
+        trace = tracing.Trace(TRACE_ID, 'parent')
+        tracing.g.trace = trace
+        with tracing.span('outer', a=1) as outer:
+            with pytest.raises(ValueError), tracing.span('inner'):
+                raise ValueError()
+        del tracing.g.trace
+
+    inner = trace.spans[0]
+    assert [span.name for span in trace.spans] == ['inner', 'outer']
+    assert inner.parent_id == outer.span_id
+    assert outer.parent_id == 'parent'
+    assert outer.attributes == {'a': 1}
+    assert outer.duration >= inner.duration >= 0
+    assert trace.stack == ['parent']
+
+
+def test_traced_bill(tracing_app, client):
+    """Test the stages of each chunk of the phone bill traced as children of the request."""
+    client.post(PHONE_CALL_ENDPOINT, json=[
+        {'type': 'start', 'timestamp': '2018-10-10T10:00:00', 'call_id': 1,
+         'source': '14981227001', 'destination': '1434567890'},
+        {'type': 'end', 'timestamp': '2018-10-10T10:05:00', 'call_id': 1},
+    ])
+
+    result = client.get(PHONE_BILL_ENDPOINT, headers={'traceparent': TRACEPARENT})
+
+    assert result.headers[tracing.TRACE_ID_HEADER] == TRACE_ID
+    spans = client.get(TRACES_ENDPOINT, query_string={'trace_id': TRACE_ID}).json['spans']
+    by_name = {span['name']: span for span in spans}
+    root = by_name['GET /api/v1/phone_bill']
+    assert root['parent_id'] == '00f067aa0ba902b7'
+    assert root['attributes'] == {'status': 200, 'route': '/api/v1/phone_bill'}
+    assert by_name['bill.validate']['parent_id'] == root['span_id']
+    for name in ('bill.end_records', 'bill.start_records', 'bill.rated_calls', 'bill.pairing', 'bill.rating'):
+        assert by_name[name]['parent_id'] == root['span_id']
+    assert by_name['bill.rating']['attributes'] == {'calls': 1}
+    assert by_name['bill.save']['parent_id'] == root['span_id']
+
+
+def test_traced_ingestion(tracing_app, client):
+    """Test the validation and the persistence of the records traced as one span by stage."""
+    result = client.post(PHONE_CALL_ENDPOINT, json=[
+        {'type': 'end', 'timestamp': '2018-10-10T10:05:00', 'call_id': call_id} for call_id in (1, 2)
+    ])
+
+    spans = tracing_app.extensions['tracer'].list_spans(result.headers[tracing.TRACE_ID_HEADER])
+    assert [span['name'] for span in spans] == ['records.validate', 'records.save', 'POST /api/v1/phone_call']
+    assert [span['attributes'] for span in spans[:2]] == [{'records': 2}, {'records': 2}]
+
+
+def test_not_sampled(tracing_app, client):
+    """Test the requests not traced by the sample, or by the sampled flag of the header."""
+    tracing_app.config['TRACING_SAMPLE'] = 2
+
+    with mock.patch('api.tracing._requests', iter(range(1, 5))):
+        results = [client.get(PHONE_BILL_ENDPOINT) for _ in range(4)]
+    results.append(client.get(PHONE_BILL_ENDPOINT, headers={'traceparent': TRACEPARENT[:-2] + '00'}))
+
+    assert [tracing.TRACE_ID_HEADER in result.headers for result in results] == [False, True, False, True, False]
+
+
+def test_tracing_file(app, client, tmpdir):
+    """Test the spans appended as json lines to the TRACING_FILE."""
+    app.config.update(TRACING=True, TRACING_FILE=str(tmpdir.join('spans.jsonl')))
+    tracing.init_app(app)
+
+    client.get(PHONE_BILL_ENDPOINT)
+    client.get(PHONE_BILL_ENDPOINT)
+
+    spans = [json.loads(line) for line in tmpdir.join('spans.jsonl').read().splitlines()]
+    assert [span['name'] for span in spans].count('GET /api/v1/phone_bill') == 2
+    assert spans[-1]['name'] == 'GET /api/v1/phone_bill'
+
+
+def test_traces_endpoint(tracing_app, client):
+    """Test the traces endpoint limiting the spans."""
+    client.get(PHONE_BILL_ENDPOINT)
+
+    assert len(client.get(TRACES_ENDPOINT, query_string={'limit': 2}).json['spans']) == 2
+    assert not client.get(TRACES_ENDPOINT, query_string={'limit': 'x'}).json['success']
+
+
+def test_traces_disabled(client):
+    """Test the traces endpoint when the tracing is disabled."""
+    result = client.get(TRACES_ENDPOINT)
+
+    assert result.status_code == 404
+    assert result.json.get('errors') == 'The tracing is disabled.'
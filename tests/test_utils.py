@@ -35,6 +35,29 @@ def test_get_int_or_none(value, expected_result):
     assert result == expected_result
 
 
+@pytest.mark.parametrize('number, expected_result', [
+    (None, None),
+    ('', None),
+    (1234567890, 1234567890),
+    ('14981227001', 14981227001),
+    ('(14) 98122-7001', 14981227001),
+    ('+14 98122.7001', 14981227001),
+    ('123456789', None),
+    ('123456789012', None),
+    ('14a81227001', None),
+    ('0119999999', -10119999999),
+    ('00119999999', -100119999999),
+    ('(011) 999-9999', -10119999999),
+    ('123456789\u00b2', None),
+    ('\u0661\u0664\u0669\u0668\u0661\u0662\u0662\u0667\u0660\u0660\u0661', None),
+    ('1498122700\uff11', None),
+])
+def test_normalize_phone_number(number, expected_result):
+    """Test normalize_phone_number function."""
+    result = utils.normalize_phone_number(number)
+    assert result == expected_result
+
+
 @pytest.mark.parametrize('number, expected_result', [
     (None, False),
     ('', False),
@@ -0,0 +1,152 @@
+"""Tests for writer.py file."""
+import os
+import queue
+import sqlite3
+
+import mock
+import pytest
+
+from api import writer
+from api.db import get_db
+
+
+def test_run_with_retry():
+    """Test run_with_retry function committing the job."""
+    db = mock.Mock()
+    job = mock.Mock(return_value=True)
+
+    result = writer.run_with_retry(job, db)
+
+    assert result
+    job.assert_called_once_with(db)
+    db.commit.assert_called_once_with()
+
+
+@mock.patch('api.writer.time.sleep')
+def test_run_with_retry_locked(sleep):
+    """Test run_with_retry function retrying while the database is locked."""
+    db = mock.Mock()
+    on_retry = mock.Mock()
+    job = mock.Mock(side_effect=[sqlite3.OperationalError('database is locked'), True])
+
+    result = writer.run_with_retry(job, db, retries=2, backoff=0.1, on_retry=on_retry)
+
+    assert result
+    assert job.call_count == 2
+    db.rollback.assert_called_once_with()
+    on_retry.assert_called_once_with()
+    assert 0 <= sleep.call_args[0][0] <= 0.1
+
+
+@mock.patch('api.writer.time.sleep')
+def test_run_with_retry_locked_exhausted(sleep):
+    """Test run_with_retry function when the database stays locked after all the retries."""
+    job = mock.Mock(side_effect=sqlite3.OperationalError('database is locked'))
+
+    with pytest.raises(writer.WriteError):
+        writer.run_with_retry(job, mock.Mock(), retries=3)
+
+    assert job.call_count == 4
+    assert sleep.call_count == 3
+
+
+def test_run_with_retry_other_error():
+    """Test run_with_retry function not retrying the errors that are not caused by locks."""
+    job = mock.Mock(side_effect=sqlite3.OperationalError('no such table: phone_call'))
+
+    with pytest.raises(sqlite3.OperationalError):
+        writer.run_with_retry(job, mock.Mock())
+
+    job.assert_called_once()
+
+
+def test_run_with_retry_rollback():
+    """Test run_with_retry function rolling back the writes of the jobs that fail with any error."""
+    db = mock.Mock()
+
+    with pytest.raises(ValueError):
+        writer.run_with_retry(mock.Mock(side_effect=ValueError), db)
+
+    db.rollback.assert_called_once_with()
+    db.commit.assert_not_called()
+
+
+def test_write_coordinator(app):
+    """Test WriteCoordinator class executing the writes on the writer thread."""
+    coordinator = writer.WriteCoordinator(app)
+
+    def job(db):
+        db.execute("INSERT INTO phone_bill (phone_number, period) VALUES ('14981227001', '10/2018')")
+        return 'done'
+
+    try:
+        assert coordinator.run(job) == 'done'
+    finally:
+        coordinator.stop()
+
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM phone_bill').fetchone()[0] == 1
+    assert coordinator.stats()['completed'] == 1
+    assert coordinator.stats()['submitted'] == 1
+
+
+@mock.patch('api.writer.atexit.register')
+def test_write_coordinator_stop(register, app):
+    """Test WriteCoordinator class writing the jobs already on the queue when it is stopped on the exit."""
+    coordinator = writer.WriteCoordinator(app)
+
+    def job(db):
+        db.execute("INSERT INTO phone_bill (phone_number, period) VALUES ('14981227001', '10/2018')")
+
+    futures = [coordinator.submit(job) for _ in range(20)]
+    register.assert_called_once_with(coordinator.stop)
+    coordinator.stop()
+
+    assert all(future.done() for future in futures)
+    assert not coordinator._thread.is_alive()
+    with app.app_context():
+        assert get_db().execute('SELECT COUNT(*) FROM phone_bill').fetchone()[0] == 20
+
+
+def test_write_coordinator_error(app):
+    """Test WriteCoordinator class raising the error of the job on the caller."""
+    coordinator = writer.WriteCoordinator(app)
+
+    try:
+        with pytest.raises(ValueError):
+            coordinator.run(mock.Mock(side_effect=ValueError))
+    finally:
+        coordinator.stop()
+
+    assert coordinator.stats()['failed'] == 1
+
+
+def test_write_coordinator_queue_full(app):
+    """Test WriteCoordinator class when the queue stays full."""
+    app.config['WRITE_TIMEOUT'] = 0.01
+    coordinator = writer.WriteCoordinator(app)
+    # queue without a writer thread consuming it
+    coordinator._pid = os.getpid()
+    coordinator._queue = queue.Queue(1)
+
+    coordinator.submit(mock.Mock())
+
+    with pytest.raises(writer.WriteError):
+        coordinator.submit(mock.Mock())
+
+    assert coordinator.stats()['queue_depth'] == 1
+    assert coordinator.stats()['timeouts'] == 1
+
+
+def test_run_write_coordinator(app):
+    """Test run_write function sending the job to the coordinator when it is enabled."""
+    coordinator = mock.Mock()
+    app.extensions['write_coordinator'] = coordinator
+    job = mock.Mock()
+    get_connection = mock.Mock()
+
+    with app.app_context():
+        writer.run_write(job, get_connection)
+
+    coordinator.run.assert_called_once_with(job)
+    get_connection.assert_not_called()